@@ -0,0 +1,899 @@
+"""Backends de stockage des comptes utilisateurs (crédits, compteurs, mot de passe global)."""
+import atexit
+import copy
+import json
+import os
+import threading
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from storage import ParsedFileCache, SqliteDatabase, atomic_write_json, read_json
+
+DEFAULT_GLOBAL_PASSWORD = "skool-empire-25"
+
+STAT_FIELDS = ("users", "credits", "active_users", "total_scripts", "total_hooks")
+DAILY_FIELDS = ("new_users", "removed_users", "scripts", "hooks", "credits_spent", "credits_added", "logins", "users", "credits")
+DAILY_RETENTION_DAYS = 400
+USER_SORTS = ("username", "credits", "last_login", "last_activity", "total_scripts", "total_hooks")
+
+
+def new_user(credits):
+    return {
+        "credits": credits,
+        "created_at": datetime.now().isoformat(),
+        "last_login": None,
+        "last_activity": None,
+        "total_scripts": 0,
+        "total_hooks": 0
+    }
+
+
+def _stat_values(user):
+    """Contribution d'un utilisateur (None: absent) à chaque champ de STAT_FIELDS"""
+    if user is None:
+        return (0, 0, 0, 0, 0)
+    return (
+        1, user.get("credits", 0), 1 if user.get("last_login") else 0,
+        user.get("total_scripts", 0), user.get("total_hooks", 0)
+    )
+
+
+def compute_user_stats(users):
+    """Agrégats recalculés par un parcours complet (initialisation et import seulement)"""
+    totals = [0] * len(STAT_FIELDS)
+    for user in users.values():
+        for i, value in enumerate(_stat_values(user)):
+            totals[i] += value
+    return dict(zip(STAT_FIELDS, totals))
+
+
+def record_user_change(data, before, after):
+    """Reporte le passage de `before` à `after` (None: absent) dans data["stats"] et data["daily"]"""
+    stats = data["stats"]
+    for field, old, new in zip(STAT_FIELDS, _stat_values(before), _stat_values(after)):
+        stats[field] += new - old
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    daily = data["daily"]
+    if today not in daily:
+        daily[today] = dict.fromkeys(DAILY_FIELDS, 0)
+        for day in sorted(daily)[:-DAILY_RETENTION_DAYS]:
+            del daily[day]
+    day = daily[today]
+    if before is None and after is not None:
+        day["new_users"] += 1
+    elif after is None and before is not None:
+        day["removed_users"] += 1
+    elif before is not None:
+        credits = after.get("credits", 0) - before.get("credits", 0)
+        day["credits_spent"] += max(-credits, 0)
+        day["credits_added"] += max(credits, 0)
+        day["scripts"] += max(after.get("total_scripts", 0) - before.get("total_scripts", 0), 0)
+        day["hooks"] += max(after.get("total_hooks", 0) - before.get("total_hooks", 0), 0)
+        if after.get("last_login") and after.get("last_login") != before.get("last_login"):
+            day["logins"] += 1
+    day["users"] = stats["users"]
+    day["credits"] = stats["credits"]
+
+
+class UsernameIndex:
+    """Noms d'utilisateurs d'un document triés sans casse, pour la recherche et la pagination.
+
+    La recherche par préfixe est une bisection sur la liste triée; les autres
+    tris (crédits, dates, compteurs) sont calculés une fois par version du
+    document puis réutilisés comme rangs.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.keys = sorted((username.lower(), username) for username in users)
+        self._ranks = {}
+
+    def matching(self, query, mode="prefix"):
+        """Noms correspondant à `query` (préfixe ou sous-chaîne, sans casse), par ordre alphabétique"""
+        query = query.lower()
+        if not query:
+            return [username for _, username in self.keys]
+        if mode == "prefix":
+            start = bisect_left(self.keys, (query,))
+            end = bisect_left(self.keys, (query + "\uffff",))
+            return [username for _, username in self.keys[start:end]]
+        return [username for key, username in self.keys if query in key]
+
+    def rank(self, sort):
+        if sort not in self._ranks:
+            # Dates ISO: l'ordre lexicographique est l'ordre chronologique
+            empty = "" if sort in TIMESTAMP_FIELDS else 0
+            ordered = sorted(
+                (username for _, username in self.keys),
+                key=lambda username: self.users[username].get(sort) or empty
+            )
+            self._ranks[sort] = {username: i for i, username in enumerate(ordered)}
+        return self._ranks[sort]
+
+    def page(self, query="", mode="prefix", sort="username", descending=False, offset=0, limit=50):
+        names = self.matching(query, mode)
+        if sort != "username":
+            names.sort(key=self.rank(sort).__getitem__)
+        if descending:
+            names.reverse()
+        return [(username, self.users[username]) for username in names[offset:offset + limit]], len(names)
+
+
+class UserStore:
+    """Interface commune des backends utilisateurs"""
+
+    # Les lectures / écritures passent par io_counters (fichiers JSON)
+    counts_io = True
+
+    def load_document(self):
+        """Document complet au format users.json ({"global_password", "users"})"""
+        raise NotImplementedError
+
+    def replace_document(self, data):
+        raise NotImplementedError
+
+    def get_global_password(self):
+        raise NotImplementedError
+
+    def set_global_password(self, password):
+        raise NotImplementedError
+
+    def get_user(self, username):
+        raise NotImplementedError
+
+    def get_all_users(self):
+        raise NotImplementedError
+
+    def add_user(self, username, credits):
+        raise NotImplementedError
+
+    def remove_user(self, username):
+        raise NotImplementedError
+
+    def set_credits(self, username, credits):
+        raise NotImplementedError
+
+    def deduct_credits(self, username, amount):
+        """Débite `amount` si le solde suffit, renvoie False sinon"""
+        raise NotImplementedError
+
+    def add_credits(self, username, amount):
+        """Crédit relatif (remboursement): pas d'écrasement d'un solde lu plus tôt"""
+        raise NotImplementedError
+
+    def increment_counter(self, username, field):
+        raise NotImplementedError
+
+    def touch(self, username, field):
+        """Horodate `field` (last_login, last_activity) à maintenant"""
+        raise NotImplementedError
+
+    def apply_activity(self, counters, timestamps):
+        """Applique en une écriture des incréments {user: {champ: n}} et horodatages {user: {champ: iso}}"""
+        raise NotImplementedError
+
+    def get_stats(self):
+        """Agrégats tenus à jour à chaque écriture: {users, credits, active_users, total_scripts, total_hooks}"""
+        raise NotImplementedError
+
+    def get_daily_stats(self, days=30):
+        """Cumuls par jour des `days` derniers jours (DAILY_FIELDS), du plus ancien au plus récent"""
+        raise NotImplementedError
+
+    def list_users(self, query="", mode="prefix", sort="username", descending=False, offset=0, limit=50):
+        """Une page d'utilisateurs ([(username, user)], nombre total de correspondances).
+
+        `mode`: "prefix" ou "contains" (sans casse); `sort`: un champ de USER_SORTS.
+        """
+        raise NotImplementedError
+
+
+class JsonUserStore(UserStore):
+    """users.json relu et réécrit en entier à chaque opération.
+
+    Le document porte aussi les agrégats ("stats") et les cumuls par jour
+    ("daily"), mis à jour dans la même écriture que l'utilisateur modifié.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Sérialise les lecture-modification-écriture des sessions du processus
+        self._lock = threading.RLock()
+        # UsernameIndex et agrégats (stats, daily) de la version courante du fichier
+        self._index = ParsedFileCache()
+        self._aggregates = ParsedFileCache()
+
+        # Initialiser le fichier utilisateurs s'il n'existe pas
+        if not os.path.exists(self.path):
+            atomic_write_json(self.path, {"global_password": DEFAULT_GLOBAL_PASSWORD, "users": {}})
+
+    def load_document(self):
+        try:
+            return read_json(self.path)
+        except:
+            return {"global_password": DEFAULT_GLOBAL_PASSWORD, "users": {}}
+
+    def replace_document(self, data):
+        with self._lock:
+            data = dict(data, stats=compute_user_stats(data["users"]))
+            if "daily" not in data:
+                data["daily"] = self.load_document().get("daily", {})
+            self._write(data)
+
+    def _write(self, data):
+        """Écrit le document et met ses agrégats en cache: la console admin les relit sans reparser le fichier"""
+        atomic_write_json(self.path, data)
+        if "stats" in data:
+            self._aggregates.put(self.path, copy.deepcopy({"stats": data["stats"], "daily": data.get("daily", {})}))
+        else:
+            self._aggregates.invalidate(self.path)
+
+    def _cached_aggregates(self):
+        cached = self._aggregates.get(self.path)
+        if cached is None:
+            # Fichier modifié hors de ce store (ou premier accès): un seul parcours
+            with self._lock:
+                signature = self._aggregates.signature(self.path)
+                data = self.load_document()
+                cached = {
+                    "stats": data.get("stats") or compute_user_stats(data["users"]),
+                    "daily": data.get("daily", {}),
+                }
+                self._aggregates.put(self.path, cached, signature)
+        return cached
+
+    def _load_for_update(self):
+        data = self.load_document()
+        if "stats" not in data:
+            # Fichier antérieur aux agrégats: un seul parcours complet
+            data["stats"] = compute_user_stats(data["users"])
+        data.setdefault("daily", {})
+        return data
+
+    def _update(self, username, apply):
+        with self._lock:
+            data = self._load_for_update()
+            user = data["users"].get(username)
+            if user is None:
+                return False
+            before = dict(user)
+            if apply(user) is False:
+                return False
+            record_user_change(data, before, user)
+            self._write(data)
+            return True
+
+    def get_global_password(self):
+        return self.load_document().get("global_password", "")
+
+    def set_global_password(self, password):
+        with self._lock:
+            data = self.load_document()
+            data["global_password"] = password
+            self._write(data)
+
+    def get_user(self, username):
+        return self.load_document()["users"].get(username)
+
+    def get_all_users(self):
+        return self.load_document()["users"]
+
+    def add_user(self, username, credits):
+        with self._lock:
+            data = self._load_for_update()
+            if username in data["users"]:
+                return False
+            data["users"][username] = new_user(credits)
+            record_user_change(data, None, data["users"][username])
+            self._write(data)
+            return True
+
+    def remove_user(self, username):
+        with self._lock:
+            data = self._load_for_update()
+            if username not in data["users"]:
+                return False
+            record_user_change(data, data["users"].pop(username), None)
+            self._write(data)
+            return True
+
+    def set_credits(self, username, credits):
+        def apply(user):
+            user["credits"] = credits
+        return self._update(username, apply)
+
+    def deduct_credits(self, username, amount):
+        def apply(user):
+            if user["credits"] < amount:
+                return False
+            user["credits"] -= amount
+            user["last_activity"] = datetime.now().isoformat()
+        return self._update(username, apply)
+
+    def add_credits(self, username, amount):
+        def apply(user):
+            user["credits"] += amount
+        return self._update(username, apply)
+
+    def increment_counter(self, username, field):
+        def apply(user):
+            user[field] = user.get(field, 0) + 1
+        return self._update(username, apply)
+
+    def touch(self, username, field):
+        def apply(user):
+            user[field] = datetime.now().isoformat()
+        return self._update(username, apply)
+
+    def apply_activity(self, counters, timestamps):
+        with self._lock:
+            data = self._load_for_update()
+            for username in set(counters) | set(timestamps):
+                user = data["users"].get(username)
+                if user is None:
+                    continue
+                before = dict(user)
+                for field, count in counters.get(username, {}).items():
+                    user[field] = user.get(field, 0) + count
+                user.update(timestamps.get(username, {}))
+                record_user_change(data, before, user)
+            self._write(data)
+
+    def get_stats(self):
+        return dict(self._cached_aggregates()["stats"])
+
+    def get_daily_stats(self, days=30):
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        daily = self._cached_aggregates()["daily"]
+        return [dict(daily[day], day=day) for day in sorted(daily) if day > cutoff]
+
+    def list_users(self, query="", mode="prefix", sort="username", descending=False, offset=0, limit=50):
+        if sort not in USER_SORTS:
+            raise ValueError(f"Tri inconnu: {sort}")
+        index = self._index.get(self.path)
+        if index is None:
+            signature = self._index.signature(self.path)
+            index = UsernameIndex(self.load_document()["users"])
+            self._index.put(self.path, index, signature)
+        return index.page(query, mode, sort, descending, offset, limit)
+
+
+SQLITE_USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    credits INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    last_login TEXT,
+    last_activity TEXT,
+    total_scripts INTEGER NOT NULL DEFAULT 0,
+    total_hooks INTEGER NOT NULL DEFAULT 0
+);
+
+-- Recherche par préfixe sans casse et tris de la liste admin
+CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
+CREATE INDEX IF NOT EXISTS idx_users_credits ON users(credits);
+CREATE INDEX IF NOT EXISTS idx_users_last_login ON users(last_login);
+CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity);
+CREATE INDEX IF NOT EXISTS idx_users_total_scripts ON users(total_scripts);
+CREATE INDEX IF NOT EXISTS idx_users_total_hooks ON users(total_hooks);
+
+-- Agrégats de la console admin, tenus à jour par triggers dans la transaction de chaque écriture
+CREATE TABLE IF NOT EXISTS user_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    credits INTEGER NOT NULL DEFAULT 0,
+    active_users INTEGER NOT NULL DEFAULT 0,
+    total_scripts INTEGER NOT NULL DEFAULT 0,
+    total_hooks INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS user_stats_daily (
+    day TEXT PRIMARY KEY,
+    new_users INTEGER NOT NULL DEFAULT 0,
+    removed_users INTEGER NOT NULL DEFAULT 0,
+    scripts INTEGER NOT NULL DEFAULT 0,
+    hooks INTEGER NOT NULL DEFAULT 0,
+    credits_spent INTEGER NOT NULL DEFAULT 0,
+    credits_added INTEGER NOT NULL DEFAULT 0,
+    logins INTEGER NOT NULL DEFAULT 0,
+    users INTEGER NOT NULL DEFAULT 0,
+    credits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users BEGIN
+    UPDATE user_stats SET
+        users = users + 1,
+        credits = credits + NEW.credits,
+        active_users = active_users + (NEW.last_login IS NOT NULL),
+        total_scripts = total_scripts + NEW.total_scripts,
+        total_hooks = total_hooks + NEW.total_hooks
+    WHERE id = 1;
+    INSERT OR IGNORE INTO user_stats_daily (day) VALUES (date('now', 'localtime'));
+    UPDATE user_stats_daily SET
+        new_users = new_users + 1,
+        users = (SELECT users FROM user_stats WHERE id = 1),
+        credits = (SELECT credits FROM user_stats WHERE id = 1)
+    WHERE day = date('now', 'localtime');
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users BEGIN
+    UPDATE user_stats SET
+        users = users - 1,
+        credits = credits - OLD.credits,
+        active_users = active_users - (OLD.last_login IS NOT NULL),
+        total_scripts = total_scripts - OLD.total_scripts,
+        total_hooks = total_hooks - OLD.total_hooks
+    WHERE id = 1;
+    INSERT OR IGNORE INTO user_stats_daily (day) VALUES (date('now', 'localtime'));
+    UPDATE user_stats_daily SET
+        removed_users = removed_users + 1,
+        users = (SELECT users FROM user_stats WHERE id = 1),
+        credits = (SELECT credits FROM user_stats WHERE id = 1)
+    WHERE day = date('now', 'localtime');
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_stats_update
+AFTER UPDATE OF credits, last_login, total_scripts, total_hooks ON users BEGIN
+    UPDATE user_stats SET
+        credits = credits + NEW.credits - OLD.credits,
+        active_users = active_users + (NEW.last_login IS NOT NULL) - (OLD.last_login IS NOT NULL),
+        total_scripts = total_scripts + NEW.total_scripts - OLD.total_scripts,
+        total_hooks = total_hooks + NEW.total_hooks - OLD.total_hooks
+    WHERE id = 1;
+    INSERT OR IGNORE INTO user_stats_daily (day) VALUES (date('now', 'localtime'));
+    UPDATE user_stats_daily SET
+        credits_spent = credits_spent + MAX(OLD.credits - NEW.credits, 0),
+        credits_added = credits_added + MAX(NEW.credits - OLD.credits, 0),
+        scripts = scripts + MAX(NEW.total_scripts - OLD.total_scripts, 0),
+        hooks = hooks + MAX(NEW.total_hooks - OLD.total_hooks, 0),
+        logins = logins + (NEW.last_login IS NOT NULL AND NEW.last_login IS NOT OLD.last_login),
+        users = (SELECT users FROM user_stats WHERE id = 1),
+        credits = (SELECT credits FROM user_stats WHERE id = 1)
+    WHERE day = date('now', 'localtime');
+END;
+"""
+
+USER_COLUMNS = ("credits", "created_at", "last_login", "last_activity", "total_scripts", "total_hooks")
+COUNTER_FIELDS = ("total_scripts", "total_hooks")
+TIMESTAMP_FIELDS = ("last_login", "last_activity")
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+class SqliteUserStore(UserStore):
+    """Comptes dans SQLite: chaque opération est une transaction ligne à ligne.
+
+    Le débit est un UPDATE conditionnel (`credits >= ?`) dans une transaction
+    BEGIN IMMEDIATE: deux sessions concurrentes ne peuvent ni perdre une mise à
+    jour ni passer le solde en négatif.
+    """
+
+    counts_io = False
+
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.db = SqliteDatabase.shared(path)
+        self.db.executescript(SQLITE_USERS_SCHEMA)
+
+        if self.db.get_meta("users_json_migrated_at") is None:
+            data = None
+            if legacy_path and os.path.exists(legacy_path):
+                try:
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            with self.db.transaction():
+                if data is not None:
+                    self._import(data)
+                elif self.db.get_meta("global_password") is None:
+                    self.db.set_meta("global_password", DEFAULT_GLOBAL_PASSWORD)
+                self.db.set_meta("users_json_migrated_at", datetime.now().isoformat())
+
+        with self.db.transaction() as conn:
+            if conn.execute("SELECT 1 FROM user_stats WHERE id = 1").fetchone() is None:
+                # Base antérieure aux agrégats: un seul parcours complet
+                self._rebuild_stats(conn)
+
+    def _rebuild_stats(self, conn):
+        conn.execute("DELETE FROM user_stats")
+        conn.execute(
+            "INSERT INTO user_stats (id, users, credits, active_users, total_scripts, total_hooks) "
+            "SELECT 1, COUNT(*), COALESCE(SUM(credits), 0), COUNT(last_login), "
+            "COALESCE(SUM(total_scripts), 0), COALESCE(SUM(total_hooks), 0) FROM users"
+        )
+
+    def _import(self, data, replace=False):
+        with self.db.transaction() as conn:
+            # Un import n'est pas de l'activité: les cumuls du jour sont restaurés après coup
+            today = conn.execute(
+                "SELECT * FROM user_stats_daily WHERE day = date('now', 'localtime')"
+            ).fetchone()
+            if replace:
+                conn.execute("DELETE FROM users")
+            self.db.set_meta("global_password", data.get("global_password", DEFAULT_GLOBAL_PASSWORD))
+            conn.executemany(
+                f"INSERT OR REPLACE INTO users (username, {', '.join(USER_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in USER_COLUMNS)})",
+                [
+                    (username, user.get("credits", 0), user.get("created_at"), user.get("last_login"),
+                     user.get("last_activity"), user.get("total_scripts", 0), user.get("total_hooks", 0))
+                    for username, user in data.get("users", {}).items()
+                ]
+            )
+            # INSERT OR REPLACE ne déclenche pas les triggers de suppression: on recalcule
+            self._rebuild_stats(conn)
+            conn.execute("DELETE FROM user_stats_daily WHERE day = date('now', 'localtime')")
+            if today is not None:
+                conn.execute(
+                    f"INSERT INTO user_stats_daily ({', '.join(today.keys())}) "
+                    f"VALUES ({', '.join('?' for _ in today.keys())})",
+                    tuple(today)
+                )
+                conn.execute(
+                    "UPDATE user_stats_daily SET users = (SELECT users FROM user_stats WHERE id = 1), "
+                    "credits = (SELECT credits FROM user_stats WHERE id = 1) WHERE day = date('now', 'localtime')"
+                )
+
+    def _row_to_user(self, row):
+        return {column: row[column] for column in USER_COLUMNS}
+
+    def load_document(self):
+        return {"global_password": self.get_global_password(), "users": self.get_all_users()}
+
+    def replace_document(self, data):
+        self._import(data, replace=True)
+
+    def get_global_password(self):
+        return self.db.get_meta("global_password") or ""
+
+    def set_global_password(self, password):
+        self.db.set_meta("global_password", password)
+
+    def get_user(self, username):
+        with self.db.lock:
+            row = self.db.conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        return self._row_to_user(row) if row else None
+
+    def get_all_users(self):
+        with self.db.lock:
+            rows = self.db.conn.execute("SELECT * FROM users ORDER BY rowid").fetchall()
+        return {row["username"]: self._row_to_user(row) for row in rows}
+
+    def add_user(self, username, credits):
+        user = new_user(credits)
+        with self.db.transaction() as conn:
+            return conn.execute(
+                f"INSERT OR IGNORE INTO users (username, {', '.join(USER_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in USER_COLUMNS)})",
+                (username,) + tuple(user[column] for column in USER_COLUMNS)
+            ).rowcount == 1
+
+    def remove_user(self, username):
+        with self.db.transaction() as conn:
+            return conn.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount == 1
+
+    def set_credits(self, username, credits):
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "UPDATE users SET credits = ? WHERE username = ?", (credits, username)
+            ).rowcount == 1
+
+    def deduct_credits(self, username, amount):
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "UPDATE users SET credits = credits - ?, last_activity = ? "
+                "WHERE username = ? AND credits >= ?",
+                (amount, datetime.now().isoformat(), username, amount)
+            ).rowcount == 1
+
+    def add_credits(self, username, amount):
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "UPDATE users SET credits = credits + ? WHERE username = ?", (amount, username)
+            ).rowcount == 1
+
+    def increment_counter(self, username, field):
+        if field not in COUNTER_FIELDS:
+            raise ValueError(f"Compteur inconnu: {field}")
+        with self.db.transaction() as conn:
+            return conn.execute(
+                f"UPDATE users SET {field} = {field} + 1 WHERE username = ?", (username,)
+            ).rowcount == 1
+
+    def touch(self, username, field):
+        if field not in TIMESTAMP_FIELDS:
+            raise ValueError(f"Horodatage inconnu: {field}")
+        with self.db.transaction() as conn:
+            return conn.execute(
+                f"UPDATE users SET {field} = ? WHERE username = ?",
+                (datetime.now().isoformat(), username)
+            ).rowcount == 1
+
+    def apply_activity(self, counters, timestamps):
+        with self.db.transaction() as conn:
+            for username, fields in counters.items():
+                for field, count in fields.items():
+                    if field not in COUNTER_FIELDS:
+                        raise ValueError(f"Compteur inconnu: {field}")
+                    conn.execute(
+                        f"UPDATE users SET {field} = {field} + ? WHERE username = ?", (count, username)
+                    )
+            for username, fields in timestamps.items():
+                for field, value in fields.items():
+                    if field not in TIMESTAMP_FIELDS:
+                        raise ValueError(f"Horodatage inconnu: {field}")
+                    conn.execute(f"UPDATE users SET {field} = ? WHERE username = ?", (value, username))
+
+    def get_stats(self):
+        with self.db.lock:
+            row = self.db.conn.execute("SELECT * FROM user_stats WHERE id = 1").fetchone()
+        return {field: row[field] for field in STAT_FIELDS} if row else dict.fromkeys(STAT_FIELDS, 0)
+
+    def list_users(self, query="", mode="prefix", sort="username", descending=False, offset=0, limit=50):
+        if sort not in USER_SORTS:
+            raise ValueError(f"Tri inconnu: {sort}")
+        # lower() de SQLite ne convertit que l'ASCII: même conversion pour la recherche
+        query = query.translate(ASCII_LOWER)
+        where, params = "", ()
+        if query and mode == "prefix":
+            where, params = "WHERE lower(username) >= ? AND lower(username) < ?", (query, query + "\uffff")
+        elif query:
+            where, params = "WHERE instr(lower(username), ?) > 0", (query,)
+        direction = "DESC" if descending else "ASC"
+        order = f"lower(username) {direction}" if sort == "username" else f"{sort} {direction}, lower(username) {direction}"
+        with self.db.lock:
+            total = self.db.conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+            rows = self.db.conn.execute(
+                f"SELECT * FROM users {where} ORDER BY {order} LIMIT ? OFFSET ?", params + (limit, offset)
+            ).fetchall()
+        return [(row["username"], self._row_to_user(row)) for row in rows], total
+
+    def get_daily_stats(self, days=30):
+        with self.db.lock:
+            rows = self.db.conn.execute(
+                "SELECT * FROM user_stats_daily WHERE day > date('now', 'localtime', ?) ORDER BY day",
+                (f"-{int(days)} days",)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+class ActivityAggregator:
+    """Write-behind des compteurs d'usage et horodatages d'activité.
+
+    Les incréments (total_scripts, total_hooks) et horodatages (last_login)
+    sont cumulés en mémoire et écrits par lots: toutes les `flush_interval`
+    secondes, dès `flush_events` événements, et à l'arrêt du processus.
+    `merge` ajoute les valeurs en attente aux données lues pour l'affichage.
+    """
+
+    def __init__(self, store, flush_interval=5.0, flush_events=50):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self._counters = {}
+        self._timestamps = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="activity-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _recorded(self):
+        self._events += 1
+        if self._events >= self.flush_events:
+            self._wake.set()
+
+    def increment(self, username, field, count=1):
+        with self._lock:
+            fields = self._counters.setdefault(username, {})
+            fields[field] = fields.get(field, 0) + count
+            self._recorded()
+
+    def touch(self, username, field):
+        with self._lock:
+            self._timestamps.setdefault(username, {})[field] = datetime.now().isoformat()
+            self._recorded()
+
+    def discard(self, username):
+        """Oublie les valeurs en attente d'un utilisateur supprimé"""
+        with self._lock:
+            self._counters.pop(username, None)
+            self._timestamps.pop(username, None)
+
+    def merge(self, username, user):
+        """Copie de `user` avec les valeurs en attente appliquées"""
+        if user is None:
+            return None
+        with self._lock:
+            counters = dict(self._counters.get(username, {}))
+            timestamps = dict(self._timestamps.get(username, {}))
+        if not counters and not timestamps:
+            return user
+        merged = dict(user)
+        for field, count in counters.items():
+            merged[field] = merged.get(field, 0) + count
+        merged.update(timestamps)
+        return merged
+
+    def merge_all(self, users):
+        return {username: self.merge(username, user) for username, user in users.items()}
+
+    def pending_totals(self):
+        """Somme par compteur des incréments pas encore écrits (à ajouter aux agrégats du store)"""
+        totals = {}
+        with self._lock:
+            for fields in self._counters.values():
+                for field, count in fields.items():
+                    totals[field] = totals.get(field, 0) + count
+        return totals
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                counters, self._counters = self._counters, {}
+                timestamps, self._timestamps = self._timestamps, {}
+                self._events = 0
+            if not counters and not timestamps:
+                return
+            try:
+                self.store.apply_activity(counters, timestamps)
+            except Exception:
+                # Remettre le lot en attente pour le prochain essai
+                with self._lock:
+                    for username, fields in counters.items():
+                        pending = self._counters.setdefault(username, {})
+                        for field, count in fields.items():
+                            pending[field] = pending.get(field, 0) + count
+                    for username, fields in timestamps.items():
+                        pending = self._timestamps.setdefault(username, {})
+                        for field, value in fields.items():
+                            pending.setdefault(field, value)
+                raise
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+class CreditReservation:
+    """Crédits mis de côté pendant une génération, débités seulement au commit"""
+
+    def __init__(self, ledger, username, amount):
+        self.ledger = ledger
+        self.username = username
+        self.amount = amount
+        self.done = False
+
+    def commit(self, counter, write=None):
+        """Débit + compteur + `write()` (sauvegarde du contenu), voir CreditLedger
+        pour l'atomicité selon les backends"""
+        try:
+            return self.ledger.commit(self, counter, write)
+        finally:
+            self.release()
+
+    def release(self):
+        if not self.done:
+            self.done = True
+            self.ledger.release(self)
+
+
+class CreditLedger:
+    """Réservation puis débit des crédits de génération.
+
+    `reserve` ne fait aucune écriture: les crédits sont retenus en mémoire le
+    temps de la génération (et déduits du solde affiché). `commit` applique le
+    débit, le compteur d'usage et la sauvegarde du contenu ensemble: dans une
+    seule transaction quand comptes et conversations partagent la même base
+    SQLite, sinon par débit conditionnel puis écriture, avec un re-crédit
+    relatif si l'écriture échoue. Un échec de génération n'écrit donc rien et
+    il n'y a plus de remboursement par valeur absolue.
+
+    Limite hors SQLite partagée: débit, écriture du contenu et re-crédit sont
+    trois écritures distinctes, pas une transaction. Un arrêt du processus
+    entre le débit et l'écriture (ou entre un échec d'écriture et le re-crédit)
+    laisse les crédits débités sans contenu sauvegardé; il faut alors les
+    rendre depuis la console admin. Le compteur d'usage, lui, n'est compté
+    qu'après une écriture réussie.
+    """
+
+    def __init__(self, store, activity, conversation_store=None):
+        self.store = store
+        self.activity = activity
+        self.conversation_store = conversation_store
+        self._holds = {}
+        self._lock = threading.Lock()
+
+    def held(self, username):
+        with self._lock:
+            return self._holds.get(username, 0)
+
+    def available(self, username):
+        user = self.store.get_user(username)
+        if user is None:
+            return 0
+        return user.get("credits", 0) - self.held(username)
+
+    def reserve(self, username, amount):
+        """CreditReservation, ou None si le solde disponible est insuffisant"""
+        user = self.store.get_user(username)
+        if user is None:
+            return None
+        with self._lock:
+            if user.get("credits", 0) - self._holds.get(username, 0) < amount:
+                return None
+            self._holds[username] = self._holds.get(username, 0) + amount
+        return CreditReservation(self, username, amount)
+
+    def reserve_batch(self, username, amount, count):
+        """`count` réservations de `amount` crédits prises ensemble (toutes ou aucune)"""
+        user = self.store.get_user(username)
+        if user is None:
+            return None
+        with self._lock:
+            if user.get("credits", 0) - self._holds.get(username, 0) < amount * count:
+                return None
+            self._holds[username] = self._holds.get(username, 0) + amount * count
+        return [CreditReservation(self, username, amount) for _ in range(count)]
+
+    def release(self, reservation):
+        with self._lock:
+            remaining = self._holds.get(reservation.username, 0) - reservation.amount
+            if remaining > 0:
+                self._holds[reservation.username] = remaining
+            else:
+                self._holds.pop(reservation.username, None)
+
+    def _shared_db(self):
+        db = getattr(self.store, "db", None)
+        if db is not None and db is getattr(self.conversation_store, "db", None):
+            return db
+        return None
+
+    def commit(self, reservation, counter, write=None):
+        username, amount = reservation.username, reservation.amount
+        db = self._shared_db()
+        if db is not None:
+            try:
+                with db.transaction():
+                    if not self.store.deduct_credits(username, amount):
+                        raise _Rollback()
+                    self.store.increment_counter(username, counter)
+                    if write is not None and not write():
+                        raise _Rollback()
+            except _Rollback:
+                return False
+            return True
+
+        if not self.store.deduct_credits(username, amount):
+            return False
+        try:
+            written = write() if write is not None else True
+        except Exception:
+            self.store.add_credits(username, amount)
+            raise
+        if not written:
+            self.store.add_credits(username, amount)
+            return False
+        self.activity.increment(username, counter)
+        return True
+
+
+class _Rollback(Exception):
+    pass
+
+
+def open_user_store(backend, json_path="users.json", sqlite_path="app.db"):
+    """Construit le backend configuré (`json` par défaut, ou `sqlite`)"""
+    if backend == "sqlite":
+        return SqliteUserStore(sqlite_path, legacy_path=json_path)
+    if backend == "json":
+        return JsonUserStore(json_path)
+    raise ValueError(f"Backend utilisateurs inconnu: {backend}")
@@ -1,15 +1,28 @@
 import streamlit as st
 import anthropic
+import httpx
+import functools
 import json
+import logging
 import uuid
-import os
 import time
 import random
 import pyperclip
-from datetime import datetime, timedelta
+from datetime import datetime
+from accounts import ActivityAggregator, CreditLedger, open_user_store
+from jobs import JobRunner
+from metrics import METRIC_COLUMNS, GenerationMetrics, GenerationTrace
+from pool import POOL_USERNAME, ScriptPool
+from profiling import RerunProfiler
+from prompts import HOOK_MAX_TOKENS, MODEL, SCRIPT_MAX_TOKENS, TEMPERATURE, CacheUsageLog, HookContextBuilder, PromptTemplate
+from storage import ExpirySweeper, StoreLockedError, open_conversation_store
+from streaming import AttemptLog, LatencyStats, RenderStats, StreamRenderer, resilient_stream
 
 CONVERSATION_TIME = 7 * 24 * 60 * 60
 
+# Journal applicatif (décisions de contexte des hooks, etc.) sur la sortie du serveur
+logging.basicConfig(level=st.secrets.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
 # Configuration de la page
 st.set_page_config(
     page_title="Generator",
@@ -18,32 +31,275 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+@st.cache_resource
+def get_conversation_store():
+    """Backend de conversations partagé par toutes les sessions (CONVERSATION_BACKEND: json, sharded, journal ou sqlite)"""
+    backend = st.secrets.get("CONVERSATION_BACKEND", "json")
+    try:
+        store = open_conversation_store(
+            backend, CONVERSATION_TIME,
+            journal_compact_bytes=int(st.secrets.get("JOURNAL_COMPACT_BYTES", 1024 * 1024))
+        )
+    except StoreLockedError as e:
+        # Rien n'est mis en cache: le prochain run réessaie
+        st.error(f"❌ {e}. Réessayez à la fin de la génération en masse (bulk.py).")
+        st.stop()
+    # L'expiration tourne en tâche de fond au lieu d'être recalculée à chaque accès
+    if st.secrets.get("EXPIRY_SWEEPER", True):
+        ExpirySweeper(store).start()
+    return store
+
+@st.cache_resource
+def get_user_store():
+    """Backend des comptes partagé par toutes les sessions (USER_BACKEND: json ou sqlite)"""
+    return open_user_store(st.secrets.get("USER_BACKEND", "json"))
+
+@st.cache_resource
+def get_activity_aggregator():
+    """Compteurs d'usage et horodatages écrits par lots, hors du chemin des requêtes"""
+    return ActivityAggregator(
+        get_user_store(),
+        flush_interval=float(st.secrets.get("ACTIVITY_FLUSH_SECONDS", 5)),
+        flush_events=int(st.secrets.get("ACTIVITY_FLUSH_EVENTS", 50))
+    )
+
+@st.cache_resource
+def get_anthropic_client(api_key):
+    """Client Anthropic partagé (une instance par clé et par process) pour réutiliser connexions et sessions TLS.
+    
+    Construit avec le client HTTP du SDK (mêmes réglages par défaut que le SDK).
+    """
+    http_client = anthropic.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=int(st.secrets.get("ANTHROPIC_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections=int(st.secrets.get("ANTHROPIC_MAX_KEEPALIVE", 10)),
+            keepalive_expiry=float(st.secrets.get("ANTHROPIC_KEEPALIVE_EXPIRY", 60))
+        ),
+        timeout=httpx.Timeout(
+            float(st.secrets.get("ANTHROPIC_READ_TIMEOUT", 120)),
+            connect=float(st.secrets.get("ANTHROPIC_CONNECT_TIMEOUT", 10))
+        )
+    )
+    return anthropic.Anthropic(
+        api_key=api_key,
+        # ANTHROPIC_BASE_URL: serveur compatible (ex: faux serveur de loadtest.py)
+        base_url=st.secrets.get("ANTHROPIC_BASE_URL") or None,
+        http_client=http_client,
+        max_retries=int(st.secrets.get("ANTHROPIC_MAX_RETRIES", 2))
+    )
+
+@st.cache_resource
+def get_ttft_stats():
+    """Time-to-first-token des dernières générations"""
+    return LatencyStats()
+
+@st.cache_resource
+def get_cache_usage_log():
+    """Tokens d'entrée lus / écrits dans le cache de prompt, par appel"""
+    return CacheUsageLog()
+
+@st.cache_resource
+def get_generation_metrics():
+    """Table locale des mesures par génération (METRICS_DB), purgée au-delà de METRICS_RETENTION_DAYS"""
+    return GenerationMetrics(
+        st.secrets.get("METRICS_DB", "metrics.db"),
+        retention_days=int(st.secrets.get("METRICS_RETENTION_DAYS", 90))
+    )
+
+@st.cache_resource
+def get_profiler():
+    """Profilage des reruns (PROFILE_RERUNS), None si désactivé"""
+    if not st.secrets.get("PROFILE_RERUNS", False):
+        return None
+    return RerunProfiler(
+        window=int(st.secrets.get("PROFILE_WINDOW", 50)),
+        trace_path=st.secrets.get("PROFILE_TRACE_PATH") or None
+    )
+
+def profiled(category, name=None):
+    """Chronomètre la fonction dans le rerun en cours quand le profilage est actif.
+    
+    Le profiler est résolu au premier appel, pas à chaque appel.
+    """
+    def decorator(func):
+        label = name or func.__name__
+        resolved = []
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not resolved:
+                resolved.append(get_profiler())
+            profiler = resolved[0]
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.span(label, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def profiled_store(store, category):
+    """Store dont les appels sont chronométrés (durée, octets lus / écrits) quand le profilage est actif"""
+    profiler = get_profiler()
+    return store if profiler is None else profiler.instrument(store, category)
+
+@st.cache_resource
+def get_render_stats():
+    """Compteurs de rendus des flux de génération (morceaux reçus / rendus effectués)"""
+    return RenderStats()
+
+@st.cache_resource
+def get_job_runner():
+    """Pool de générations en arrière-plan: au plus GENERATION_WORKERS appels à l'API en parallèle, file équitable par utilisateur"""
+    return JobRunner("jobs", max_workers=int(st.secrets.get("GENERATION_WORKERS", 4)))
+
+@st.cache_resource
+def get_credit_ledger():
+    """Réservations de crédits en cours, partagées par toutes les sessions"""
+    return CreditLedger(get_user_store(), get_activity_aggregator(), get_conversation_store())
+
+TRANSIENT_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+def is_transient_error(error):
+    """Erreurs qui justifient une nouvelle tentative: surcharge, limite de débit, connexion coupée"""
+    if isinstance(error, (anthropic.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    # Erreurs SSE en cours de flux (ex: overloaded_error) sans code HTTP exploitable
+    return "overloaded" in str(error).lower()
+
+def stream_claude(client, kind, content, max_tokens, ttft_stats, usage_log, attempt_log, attempts=3, base_delay=1.0,
+                  metrics=None, username=None, animal=None):
+    """Morceaux de texte d'une génération Claude, avec TTFT et usage (cache compris) enregistrés.
+    
+    Une coupure transitoire relance l'appel avec le texte déjà reçu en début de
+    réponse de l'assistant (prefill): la génération reprend là où elle s'était arrêtée.
+    Avec `metrics`, une ligne de mesures (latences, débit, tokens) est écrite à la fin du flux.
+    """
+    trace = GenerationTrace(kind, username, animal, MODEL, max_tokens)
+    
+    def open_stream(partial):
+        trace.attempt()
+        messages = [{"role": "user", "content": content}]
+        # L'API refuse un prefill terminé par des espaces: ils sont déjà affichés, on ne les renvoie pas
+        prefill = partial.rstrip()
+        if prefill:
+            messages.append({"role": "assistant", "content": prefill})
+        skip_space = len(partial) > len(prefill)
+        
+        with client.messages.stream(
+            model=MODEL,
+            max_tokens=max_tokens,
+            temperature=TEMPERATURE,
+            messages=messages
+        ) as stream:
+            for text in stream.text_stream:
+                if skip_space:
+                    text = text.lstrip()
+                    skip_space = not text
+                if not text:
+                    continue
+                if trace.first_token is None:
+                    ttft_stats.record(time.monotonic() - trace.started)
+                trace.chunk()
+                yield text
+            
+            usage = stream.get_final_message().usage
+            usage_log.record(kind, usage)
+            trace.usage(usage)
+    
+    chunks = resilient_stream(
+        open_stream, is_transient_error, kind=kind,
+        attempts=attempts, base_delay=base_delay, log=attempt_log
+    )
+    if metrics is None:
+        return chunks
+    
+    def traced():
+        status = "error"
+        try:
+            yield from chunks
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            metrics.record(trace.finish(status))
+    
+    return traced()
+
+@st.cache_resource
+def get_attempt_log():
+    """Tentatives de streaming (succès, reprises, échecs) des dernières générations"""
+    return AttemptLog()
+
+def stream_retry_settings():
+    """Nombre de tentatives et délai de base du backoff (STREAM_MAX_ATTEMPTS, STREAM_RETRY_BASE_DELAY)"""
+    return {
+        "attempts": int(st.secrets.get("STREAM_MAX_ATTEMPTS", 3)),
+        "base_delay": float(st.secrets.get("STREAM_RETRY_BASE_DELAY", 1.0))
+    }
+
+def load_animals_list():
+    """ANIMALS_LIST des secrets: liste JSON ou un animal par ligne"""
+    animals_list = st.secrets.get("ANIMALS_LIST", "")
+    if not animals_list:
+        return []
+    try:
+        return json.loads(animals_list)
+    except json.JSONDecodeError:
+        return [line.strip() for line in animals_list.split('\n') if line.strip()]
+
+@st.cache_resource
+def get_script_pool():
+    """Réserve de scripts pré-générés (SCRIPT_POOL), None si désactivée"""
+    api_key = st.secrets.get("ANTHROPIC_API_KEY")
+    template = PromptTemplate(
+        st.secrets.get("SCRIPT_PROMPT", ""), "{{ANIMAL}}", "animal",
+        rewrite=bool(st.secrets.get("PROMPT_CACHE_REWRITE", False))
+    )
+    if not st.secrets.get("SCRIPT_POOL", False) or not api_key or "{{ANIMAL}}" not in template.template:
+        return None
+    
+    client = get_anthropic_client(api_key)
+    ttft_stats = get_ttft_stats()
+    usage_log = get_cache_usage_log()
+    attempt_log = get_attempt_log()
+    metrics = get_generation_metrics()
+    retry = stream_retry_settings()
+    sizes = st.secrets.get("SCRIPT_POOL_SIZES", {})
+    if isinstance(sizes, str):
+        sizes = json.loads(sizes)
+    
+    return ScriptPool(
+        get_job_runner(),
+        lambda animal: stream_claude(
+            client, "pool", template.content(animal), SCRIPT_MAX_TOKENS, ttft_stats, usage_log, attempt_log, **retry,
+            metrics=metrics, username=POOL_USERNAME, animal=animal
+        ),
+        load_animals_list(),
+        size=int(st.secrets.get("SCRIPT_POOL_SIZE", 2)),
+        sizes=dict(sizes),
+        max_age=float(st.secrets.get("SCRIPT_POOL_MAX_AGE_HOURS", 24)) * 3600,
+        top_n=int(st.secrets.get("SCRIPT_POOL_TOP_N", 20)),
+        save_interval=float(st.secrets.get("SCRIPT_POOL_SAVE_SECONDS", 30))
+    )
+
 class AuthManager:
+    @profiled("init", "AuthManager()")
     def __init__(self):
-        self.users_file = "users.json"
+        self.store = profiled_store(get_user_store(), "users")
+        self.activity = get_activity_aggregator()
+        self.ledger = get_credit_ledger()
         self.admin_username = st.secrets.get("ADMIN_USERNAME")
         self.admin_password = st.secrets.get("ADMIN_PASSWORD")
-        
-        # Initialiser le fichier utilisateurs s'il n'existe pas
-        if not os.path.exists(self.users_file):
-            initial_data = {
-                "global_password": "skool-empire-25",
-                "users": {}
-            }
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(initial_data, f, ensure_ascii=False, indent=2)
     
     def _load_users(self):
-        try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {"global_password": "skool-empire-25", "users": {}}
+        return self.store.load_document()
     
     def _save_users(self, data):
         try:
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.store.replace_document(data)
         except Exception as e:
             st.error(f"❌ Erreur lors de la sauvegarde: {str(e)}")
             raise e
@@ -52,110 +308,99 @@ class AuthManager:
         return username == self.admin_username and password == self.admin_password
     
     def authenticate_user(self, username, password):
-        data = self._load_users()
-        return username in data["users"] and password == data["global_password"]
+        return self.store.get_user(username) is not None and password == self.store.get_global_password()
     
     def get_user_credits(self, username):
-        data = self._load_users()
-        return data["users"].get(username, {}).get("credits", 0)
+        """Crédits disponibles (hors crédits réservés par une génération en cours)"""
+        return self.ledger.available(username)
+    
+    def get_stored_credits(self, username):
+        """Solde enregistré, réservations en cours comprises: c'est lui que l'admin remplace"""
+        user = self.store.get_user(username)
+        return user["credits"] if user else 0
     
     def update_user_credits(self, username, new_credits):
-        data = self._load_users()
-        if username in data["users"]:
-            data["users"][username]["credits"] = new_credits
-            self._save_users(data)
-            return True
-        return False
+        return self.store.set_credits(username, new_credits)
     
     def deduct_credits(self, username, amount):
-        data = self._load_users()
-        if username in data["users"]:
-            current_credits = data["users"][username]["credits"]
-            if current_credits >= amount:
-                data["users"][username]["credits"] = current_credits - amount
-                data["users"][username]["last_activity"] = datetime.now().isoformat()
-                self._save_users(data)
-                return True
-        return False
+        return self.store.deduct_credits(username, amount)
+    
+    def reserve_credits(self, username, amount):
+        """Réserve des crédits avant une génération; rien n'est écrit avant commit_generation"""
+        return self.ledger.reserve(username, amount)
+    
+    def reserve_credits_batch(self, username, amount, count):
+        """Réserve d'un coup les crédits de `count` générations (liste de réservations, ou None)"""
+        return self.ledger.reserve_batch(username, amount, count)
+    
+    def commit_generation(self, username, reservation, counter, write=None):
+        """Enregistre une génération réussie: débit, compteur et sauvegarde du contenu ensemble"""
+        if reservation is not None:
+            return reservation.commit(counter, write)
+        if write is not None and not write():
+            return False
+        self.activity.increment(username, counter)
+        return True
     
     def add_user(self, username, credits=30):
-        data = self._load_users()
-        if username not in data["users"]:
-            data["users"][username] = {
-                "credits": credits,
-                "created_at": datetime.now().isoformat(),
-                "last_login": None,
-                "last_activity": None,
-                "total_scripts": 0,
-                "total_hooks": 0
-            }
-            self._save_users(data)
-            return True
-        return False
+        return self.store.add_user(username, credits)
     
     def remove_user(self, username):
-        data = self._load_users()
-        if username in data["users"]:
-            del data["users"][username]
-            self._save_users(data)
-            
+        if self.store.remove_user(username):
+            self.activity.discard(username)
             try:
-                with open("conversations.json", 'r', encoding='utf-8') as f:
-                    conv_data = json.load(f)
-                
-                if username in conv_data:
-                    del conv_data[username]
-                
-                with open("conversations.json", 'w', encoding='utf-8') as f:
-                    json.dump(conv_data, f, ensure_ascii=False, indent=2)
+                profiled_store(get_conversation_store(), "conversations").delete_user(username)
             except:
                 pass
             
             return True
         return False
     
+    def get_global_password(self):
+        return self.store.get_global_password()
+    
     def update_global_password(self, new_password):
-        data = self._load_users()
-        data["global_password"] = new_password
-        self._save_users(data)
+        self.store.set_global_password(new_password)
     
     def get_all_users(self):
-        data = self._load_users()
-        return data["users"]
+        return self.activity.merge_all(self.store.get_all_users())
+    
+    def get_admin_stats(self):
+        """Totaux de la console admin, lus sans parcourir les utilisateurs (compteurs en attente inclus)"""
+        stats = dict(self.store.get_stats())
+        for field, count in self.activity.pending_totals().items():
+            stats[field] = stats.get(field, 0) + count
+        return stats
+    
+    def get_daily_stats(self, days=30):
+        return self.store.get_daily_stats(days)
+    
+    def list_users(self, query="", mode="prefix", sort="username", descending=False, offset=0, limit=50):
+        """Une page d'utilisateurs et le nombre total de correspondances.
+        
+        Seule la page est chargée et complétée par les compteurs en attente;
+        le tri se fait sur les valeurs déjà écrites.
+        """
+        page, total = self.store.list_users(query, mode, sort, descending, offset, limit)
+        return [(username, self.activity.merge(username, user)) for username, user in page], total
     
     def update_last_login(self, username):
-        data = self._load_users()
-        if username in data["users"]:
-            data["users"][username]["last_login"] = datetime.now().isoformat()
-            self._save_users(data)
+        self.activity.touch(username, "last_login")
     
     def increment_script_count(self, username):
-        """Incrémente le compteur de scripts générés"""
-        data = self._load_users()
-        if username in data["users"]:
-            if "total_scripts" not in data["users"][username]:
-                data["users"][username]["total_scripts"] = 0
-            data["users"][username]["total_scripts"] += 1
-            self._save_users(data)
-            return True
-        return False
+        """Incrémente le compteur de scripts générés (écrit par lot)"""
+        self.activity.increment(username, "total_scripts")
+        return True
     
     def increment_hook_count(self, username):
-        """Incrémente le compteur de hooks générés"""
-        data = self._load_users()
-        if username in data["users"]:
-            if "total_hooks" not in data["users"][username]:
-                data["users"][username]["total_hooks"] = 0
-            data["users"][username]["total_hooks"] += 1
-            self._save_users(data)
-            return True
-        return False
+        """Incrémente le compteur de hooks générés (écrit par lot)"""
+        self.activity.increment(username, "total_hooks")
+        return True
     
     def get_user_stats(self, username):
         """Récupère les statistiques d'un utilisateur"""
-        data = self._load_users()
-        if username in data["users"]:
-            user_data = data["users"][username]
+        user_data = self.activity.merge(username, self.store.get_user(username))
+        if user_data is not None:
             return {
                 "credits": user_data.get("credits", 0),
                 "total_scripts": user_data.get("total_scripts", 0),
@@ -166,77 +411,46 @@ class AuthManager:
         return None
 
 class ViralScriptGenerator:
+    @profiled("init", "ViralScriptGenerator()")
     def __init__(self, username=None):
         self.username = username
 
         self.api_key = st.secrets.get("ANTHROPIC_API_KEY")
         if self.api_key:
-            self.client = anthropic.Anthropic(api_key=self.api_key)
-        self.db_file = "conversations.json"
-        
-        # Initialiser le fichier de base de données s'il n'existe pas
-        if not os.path.exists(self.db_file):
-            initial_data = {}
-            with open(self.db_file, 'w', encoding='utf-8') as f:
-                json.dump(initial_data, f, ensure_ascii=False, indent=2)
+            self.client = get_anthropic_client(self.api_key)
+        self.ttft_stats = get_ttft_stats()
+        self.attempt_log = get_attempt_log()
+        self.metrics = get_generation_metrics()
+        self.retry = stream_retry_settings()
+        self.store = profiled_store(get_conversation_store(), "conversations")
         
         # Charger les prompts depuis les secrets Streamlit
         self.script_prompt = st.secrets.get("SCRIPT_PROMPT", "")
         self.hook_prompt = st.secrets.get("HOOK_PROMPT", "")
         self.animals_list = st.secrets.get("ANIMALS_LIST", "")
-    
-    def _load_prompt(self, file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read().strip()
-        except FileNotFoundError:
-            st.error(f"❌ Fichier non trouvé: {file_path}")
-            return ""
+        self._attachments = []
+        
+        # Préfixes statiques des prompts envoyés avec cache_control
+        rewrite = bool(st.secrets.get("PROMPT_CACHE_REWRITE", False))
+        self.script_template = PromptTemplate(self.script_prompt, "{{ANIMAL}}", "animal", rewrite=rewrite)
+        self.hook_template = PromptTemplate(self.hook_prompt, "{{SCRIPT}}", "scripts", rewrite=rewrite)
+        self.hook_context = HookContextBuilder(
+            self.hook_template,
+            budget=int(st.secrets.get("HOOK_TOKEN_BUDGET", 12000)),
+            only_new=bool(st.secrets.get("HOOK_ONLY_NEW_SCRIPTS", False))
+        )
+        self.usage_log = get_cache_usage_log()
     
     def _load_conversations(self):
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+        return self.store.load_all()
     
     def _save_conversations(self, data):
         try:
-            with open(self.db_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.store.replace_all(data)
         except Exception as e:
             st.error(f"❌ Erreur lors de la sauvegarde: {str(e)}")
             raise e
     
-    def _cleanup_old_conversations(self, data):
-        """Supprime les conversations de plus de 10 minutes"""
-        current_time = datetime.now()
-        cleaned_data = data.copy()
-        
-        for username in list(cleaned_data.keys()):
-            if "conversations" in cleaned_data[username]:
-                # Filtrer les conversations récentes
-                recent_conversations = []
-                for conv in cleaned_data[username]["conversations"]:
-                    if "created_at" in conv:
-                        try:
-                            conv_time = datetime.fromisoformat(conv["created_at"])
-                            # Garder seulement les conversations de moins de 24 heures
-                            if (current_time - conv_time).total_seconds() < CONVERSATION_TIME:  # 24 heures = 86400 secondes
-                                recent_conversations.append(conv)
-                        except:
-                            # Si erreur de parsing, garder la conversation
-                            recent_conversations.append(conv)
-                    else:
-                        # Si pas de timestamp, supprimer (ancien format)
-                        continue
-                
-                cleaned_data[username]["conversations"] = recent_conversations
-        
-        return cleaned_data
-    
     def get_conversation_time_info(self, conversation):
         if "created_at" not in conversation:
             return None
@@ -270,161 +484,49 @@ class ViralScriptGenerator:
     
     def force_cleanup(self):
         """Force le nettoyage des anciennes conversations"""
-        data = self._load_conversations()
-        cleaned_data = self._cleanup_old_conversations(data)
-        self._save_conversations(cleaned_data)
-        return cleaned_data
+        self.store.request_cleanup()
+    
+    def get_conversations(self):
+        return self.store.get_conversations(self.username)
+    
+    def find_conversation(self, animal):
+        return self.store.find_conversation(self.username, animal)
     
     def _get_or_create_conversation(self, animal):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username not in data:
-            data[self.username] = {"conversations": []}
-        
-        for conv in data[self.username]["conversations"]:
-            if conv["animal"].lower() == animal.lower():
-                return conv
-        
-        new_conv = {
-            "id": str(uuid.uuid4()),
-            "animal": animal,
-            "scripts": [],
-            "hooks": [],
-            "created_at": datetime.now().isoformat()
-        }
-        
-        data[self.username]["conversations"].append(new_conv)
-        self._save_conversations(data)
-        return new_conv
+        return self.store.get_or_create_conversation(self.username, animal)
     
     def add_script_to_conversation(self, animal, script_content):
         try:
-            data = self._load_conversations()
-            
-            # Nettoyer les anciennes conversations
-            data = self._cleanup_old_conversations(data)
-            
-            # Créer l'utilisateur s'il n'existe pas
-            if self.username not in data:
-                data[self.username] = {"conversations": []}
-            
-            # Chercher une conversation existante
-            for conv in data[self.username]["conversations"]:
-                if conv["animal"].lower() == animal.lower():
-                    script_entry = {
-                        "content": script_content,
-                        "char_count": len(script_content)
-                    }
-                    conv["scripts"].append(script_entry)
-                    self._save_conversations(data)
-                    return True
-            
-            # Créer une nouvelle conversation
-            new_conv = {
-                "id": str(uuid.uuid4()),
-                "animal": animal,
-                "scripts": [{
-                    "content": script_content,
-                    "char_count": len(script_content)
-                }],
-                "hooks": [],
-                "created_at": datetime.now().isoformat()
-            }
-            
-            data[self.username]["conversations"].append(new_conv)
-            self._save_conversations(data)
-            return True
-        
+            return self.store.add_script(self.username, animal, script_content)
         except Exception as e:
             st.error(f"❌ Erreur lors de la sauvegarde: {str(e)}")
             return False
 
     def add_hooks_to_conversation(self, conversation_id, hooks_content):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username in data:
-            for conv in data[self.username]["conversations"]:
-                if conv["id"] == conversation_id:
-                    hook_entry = {
-                        "content": hooks_content
-                    }
-                    
-                    if "hooks" not in conv:
-                        conv["hooks"] = []
-                    
-                    conv["hooks"].append(hook_entry)
-                    self._save_conversations(data)
-                    return True
-        return False
+        return self.store.add_hook(self.username, conversation_id, hooks_content)
 
     def delete_script(self, conversation_id, script_index):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username in data:
-            for conv in data[self.username]["conversations"]:
-                if conv["id"] == conversation_id:
-                    if 0 <= script_index < len(conv["scripts"]):
-                        del conv["scripts"][script_index]
-                        self._save_conversations(data)
-                        return True
-        return False
+        return self.store.delete_script(self.username, conversation_id, script_index)
 
     def delete_hook(self, conversation_id, hook_index):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username in data:
-            for conv in data[self.username]["conversations"]:
-                if conv["id"] == conversation_id:
-                    if 0 <= hook_index < len(conv.get("hooks", [])):
-                        del conv["hooks"][hook_index]
-                        self._save_conversations(data)
-                        return True
-        return False
+        return self.store.delete_hook(self.username, conversation_id, hook_index)
 
     def update_script(self, conversation_id, script_index, new_content):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username in data:
-            for conv in data[self.username]["conversations"]:
-                if conv["id"] == conversation_id:
-                    if 0 <= script_index < len(conv["scripts"]):
-                        conv["scripts"][script_index]["content"] = new_content
-                        conv["scripts"][script_index]["char_count"] = len(new_content)
-                        self._save_conversations(data)
-                        return True
-        return False
+        return self.store.update_script(self.username, conversation_id, script_index, new_content)
 
     def update_hook(self, conversation_id, hook_index, new_content):
-        data = self._load_conversations()
-        
-        # Nettoyer les anciennes conversations
-        data = self._cleanup_old_conversations(data)
-        
-        if self.username in data:
-            for conv in data[self.username]["conversations"]:
-                if conv["id"] == conversation_id:
-                    if 0 <= hook_index < len(conv.get("hooks", [])):
-                        conv["hooks"][hook_index]["content"] = new_content
-                        self._save_conversations(data)
-                        return True
-        return False
+        return self.store.update_hook(self.username, conversation_id, hook_index, new_content)
+    
+    def _stream_renderer(self):
+        """Renderer throttlé: un rendu toutes les STREAM_FLUSH_MS ms ou STREAM_FLUSH_CHARS caractères"""
+        return StreamRenderer(
+            st.empty(),
+            interval=int(st.secrets.get("STREAM_FLUSH_MS", 100)) / 1000,
+            chars=int(st.secrets.get("STREAM_FLUSH_CHARS", 200)),
+            stats=get_render_stats()
+        )
     
-    def generate_script_stream(self, animal):
+    def _script_content(self, animal):
         if not self.api_key:
             st.error("❌ Clé API Anthropic non configurée")
             return None
@@ -433,39 +535,14 @@ class ViralScriptGenerator:
             st.error("❌ Prompt script non chargé")
             return None
         
-        try:
-            if "{{ANIMAL}}" not in self.script_prompt:
-                st.error("❌ Le placeholder {{ANIMAL}} n'est pas trouvé dans le prompt!")
-                return None
-
-            prompt = self.script_prompt.replace("{{ANIMAL}}", animal)
-            
-            with self.client.messages.stream(
-                model="claude-sonnet-4-20250514",
-                max_tokens=6500,
-                temperature=0.7,
-                messages=[{"role": "user", "content": prompt}]
-            ) as stream:
-                
-                full_text = ""
-                placeholder = st.empty()
-                
-                for text in stream.text_stream:
-                    full_text += text
-                    placeholder.markdown(f"{full_text}")
-                
-                # Incrémenter le compteur de scripts après génération réussie
-                if full_text and self.username:
-                    auth_manager = AuthManager()
-                    auth_manager.increment_script_count(self.username)
-                
-                return full_text
-                
-        except Exception as e:
-            st.error(f"❌ Erreur génération: {str(e)}")
+        if "{{ANIMAL}}" not in self.script_prompt:
+            st.error("❌ Le placeholder {{ANIMAL}} n'est pas trouvé dans le prompt!")
             return None
+        
+        return self.script_template.content(animal)
     
-    def generate_hooks_stream(self, conversation):
+    def _hooks_content(self, conversation):
+        """(blocs de contenu, empreintes des scripts envoyés) sous le budget HOOK_TOKEN_BUDGET"""
         if not self.api_key:
             st.error("❌ Clé API non configurée")
             return None
@@ -478,51 +555,172 @@ class ViralScriptGenerator:
             st.warning("⚠️ Aucun script dans la conversation")
             return None
         
-        try:
-            combined_scripts = "\n\n".join([
-                f"SCRIPT {i+1}:\n{script['content']}" 
-                for i, script in enumerate(conversation["scripts"])
-            ])
-            
-            prompt = self.hook_prompt.replace("{{SCRIPT}}", f"{combined_scripts}")
-            
-            with self.client.messages.stream(
-                model="claude-sonnet-4-20250514",
-                max_tokens=2500,
-                temperature=0.7,
-                messages=[{"role": "user", "content": prompt}]
-            ) as stream:
-                
-                full_text = ""
-                placeholder = st.empty()
-                
-                for text in stream.text_stream:
-                    full_text += text
-                    placeholder.markdown(f"{full_text}")
-                
-                # Incrémenter le compteur de hooks après génération réussie
-                if full_text and self.username:
-                    auth_manager = AuthManager()
-                    auth_manager.increment_hook_count(self.username)
-                
-                return full_text
-                
-        except Exception as e:
-            st.error(f"❌ Erreur génération hooks: {str(e)}")
+        # Le rapport (scripts envoyés, troncature) est déjà journalisé par build()
+        content, sources, _ = self.hook_context.build(conversation)
+        return content, sources
+    
+    def _stream_text(self, kind, animal, content, max_tokens):
+        """Morceaux de texte générés par Claude (exécuté dans un worker du JobRunner)"""
+        return stream_claude(
+            self.client, kind, content, max_tokens, self.ttft_stats, self.usage_log, self.attempt_log, **self.retry,
+            metrics=self.metrics, username=self.username, animal=animal
+        )
+    
+    def _start_job(self, kind, label, target, content, max_tokens, reservation, counter, write=None, group=None):
+        auth_manager = AuthManager()
+        username = self.username
+        
+        def commit(text):
+            # Débit, compteur et sauvegarde faits par le worker, même si la session a disparu
+            return auth_manager.commit_generation(
+                username, reservation, counter,
+                (lambda: write(text)) if write is not None else None
+            )
+        
+        return get_job_runner().submit(
+            username, kind, label,
+            lambda: self._stream_text(kind, label, content, max_tokens),
+            commit=commit,
+            release=reservation.release if reservation is not None else None,
+            target=target,
+            group=group
+        )
+    
+    def start_script_job(self, animal, reservation=None, conversation_id=None):
+        """Lance un script en arrière-plan: brouillon à accepter, ou ajouté directement à `conversation_id`"""
+        content = self._script_content(animal)
+        if content is None:
+            if reservation is not None:
+                reservation.release()
             return None
+        
+        if conversation_id is None:
+            return self._start_job("draft", animal, None, content, SCRIPT_MAX_TOKENS, reservation, "total_scripts")
+        
+        return self._start_job(
+            "script", animal, conversation_id, content, SCRIPT_MAX_TOKENS, reservation, "total_scripts",
+            lambda text: self.store.add_script(self.username, animal, text)
+        )
+    
+    def start_variant_jobs(self, animal, reservations):
+        """Lance une variante par réservation, en parallèle, regroupées pour l'affichage côte à côte"""
+        content = self._script_content(animal)
+        if content is None:
+            for reservation in reservations:
+                if reservation is not None:
+                    reservation.release()
+            return None
+        
+        group = str(uuid.uuid4())
+        return [
+            self._start_job("draft", animal, None, content, SCRIPT_MAX_TOKENS, reservation, "total_scripts", group=group)
+            for reservation in reservations
+        ]
+    
+    def start_hooks_job(self, conversation, reservation=None):
+        """Lance la génération des hooks d'une conversation en arrière-plan"""
+        built = self._hooks_content(conversation)
+        if built is None:
+            if reservation is not None:
+                reservation.release()
+            return None
+        
+        content, sources = built
+        return self._start_job(
+            "hooks", conversation["animal"], conversation["id"], content, HOOK_MAX_TOKENS, reservation, "total_hooks",
+            lambda text: self.store.add_hook(self.username, conversation["id"], text, sources)
+        )
+    
+    def running_job(self, kind, target=None):
+        for job in get_job_runner().jobs_for(self.username, kind, target):
+            if not job.finished:
+                return job
+        return None
+    
+    def draft_jobs(self):
+        """Brouillons de scripts pas encore affichés à l'utilisateur (hors variantes)"""
+        return [
+            job for job in get_job_runner().jobs_for(self.username, "draft")
+            if not job.claimed and job.group is None
+        ]
+    
+    def variant_group(self):
+        """Variantes du plus ancien lot pas encore tranché par l'utilisateur, ou None"""
+        groups = {}
+        for job in get_job_runner().jobs_for(self.username, "draft"):
+            if job.group is not None and not job.claimed:
+                groups.setdefault(job.group, []).append(job)
+        return next(iter(groups.values()), None)
+    
+    def claim_job(self, job):
+        get_job_runner().claim(job)
+    
+    @profiled("jobs")
+    def notify_finished_jobs(self):
+        """Signale les scripts et hooks terminés en arrière-plan (succès ou échec)"""
+        for job in get_job_runner().jobs_for(self.username):
+            if job.kind == "draft" or not job.finished or job.claimed:
+                continue
+            self.claim_job(job)
+            what = "Script" if job.kind == "script" else "Hooks"
+            if job.status == "done":
+                st.toast(f"{what} généré(s) pour {job.label}", icon="✅")
+            else:
+                st.toast(f"{what} pour {job.label}: {job.error}", icon="❌")
+    
+    def defer_attach(self, job):
+        """Réserve l'emplacement du flux d'un job; il est rempli par attach_deferred en fin de run"""
+        self._attachments.append((st.container(), job))
+    
+    @profiled("stream")
+    def attach_deferred(self):
+        """Diffuse le buffer des jobs en cours dans leurs emplacements, puis relance la page à la fin de l'un d'eux"""
+        if not self._attachments:
+            return
+        
+        runner = get_job_runner()
+        attached = []
+        for slot, job in self._attachments:
+            with slot:
+                status = st.empty()
+                attached.append([job, status, self._stream_renderer(), 0, None])
+        poll = int(st.secrets.get("STREAM_FLUSH_MS", 100)) / 1000
+        
+        while True:
+            any_finished = False
+            for entry in attached:
+                job, status, renderer, seen, caption = entry
+                parts, finished = job.read(seen)
+                for text in parts:
+                    renderer.write(text)
+                entry[3] = seen + len(parts)
+                any_finished = any_finished or finished
+                position = runner.queue_position(job) if job.status == "queued" else None
+                if position is not None:
+                    text = f"⏳ En file d'attente - position {position} ({int(time.time() - job.created_at)}s)"
+                else:
+                    text = f"⏳ Génération en cours... {int(time.time() - job.created_at)}s"
+                # Statut renvoyé au navigateur seulement quand il change: au plus une fois par seconde
+                if text != caption:
+                    status.caption(text)
+                    entry[4] = text
+            if any_finished:
+                break
+            # Un seul job: réveil dès qu'un morceau arrive, sinon chaque seconde pour le statut
+            job, seen = attached[0][0], attached[0][3]
+            job.wait(seen, timeout=1.0 if len(attached) == 1 else poll)
+        
+        for job, status, renderer, seen, caption in attached:
+            renderer.close()
+        self._attachments = []
+        st.rerun()
 
 def get_random_animals_placeholder():
     try:
-        animals_list = st.secrets.get("ANIMALS_LIST", "")
-        if animals_list:
-            try:
-                animals = json.loads(animals_list)
-            except json.JSONDecodeError:
-                animals = [line.strip() for line in animals_list.split('\n') if line.strip()]
-            
-            if animals:
-                selected = random.sample(animals, min(10, len(animals)))
-                return ", ".join(selected)
+        animals = load_animals_list()
+        if animals:
+            selected = random.sample(animals, min(10, len(animals)))
+            return ", ".join(selected)
     except Exception:
         pass
     
@@ -535,6 +733,7 @@ def copy_to_clipboard(text):
     except:
         return False
 
+@profiled("page")
 def show_login_page():
     col1, col2, col3 = st.columns([1, 2, 1])
     
@@ -568,13 +767,195 @@ def show_login_page():
                     else:
                         st.error("❌ Identifiants incorrects")
 
+def _kilobytes(count):
+    """Octets en Ko pour le tableau de profilage; "n/a" pour les stores SQLite, non mesurés"""
+    return "n/a" if count is None else f"{count / 1024:.1f}"
+
+def show_profiling_panel(profiler):
+    """Temps des derniers reruns et des appels les plus coûteux (sidebar admin)"""
+    st.markdown("### Profilage")
+    summary = profiler.summary()
+    if not summary["reruns"]:
+        st.caption("Aucun rerun mesuré")
+        return
+    
+    last = summary["last"]
+    st.caption(
+        f"Dernier rerun ({last['page']}): {last['duration'] * 1000:.0f} ms · "
+        f"moyenne {summary['avg'] * 1000:.0f} ms, p95 {summary['p95'] * 1000:.0f} ms, "
+        f"max {summary['max'] * 1000:.0f} ms ({summary['reruns']} reruns)"
+    )
+    st.dataframe([
+        {
+            "Appel": f"{span['category']}.{span['name']}",
+            "ms / rerun": round(span["avg"] * 1000, 1),
+            "p95 ms": round(span["p95"] * 1000, 1),
+            "Appels": span["calls"],
+            "Ko lus": _kilobytes(span["bytes_read"]),
+            "Ko écrits": _kilobytes(span["bytes_written"]),
+        }
+        for span in summary["spans"][:15]
+    ], use_container_width=True)
+    
+    if profiler.trace_path:
+        st.caption(f"Trace JSONL: {profiler.trace_path}")
+    elif st.button("Exporter la trace (JSONL)", use_container_width=True):
+        count = profiler.dump("profile_trace.jsonl")
+        st.success(f"✅ {count} reruns ajoutés à profile_trace.jsonl")
+
+METRIC_LABELS = {
+    "ttft": "Time-to-first-token (s)",
+    "total_time": "Durée totale (s)",
+    "tokens_per_sec": "Tokens de sortie / s",
+    "gap_p95": "Écart p95 entre morceaux (s)",
+    "gap_max": "Écart max entre morceaux (s)",
+}
+
+def show_generation_metrics():
+    """Percentiles quotidiens des mesures de génération, par tâche (script / hook / réserve)"""
+    metrics = get_generation_metrics()
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        metric = st.selectbox(
+            "Mesure", options=list(METRIC_COLUMNS), format_func=lambda m: METRIC_LABELS[m], key="metrics_column"
+        )
+    with col2:
+        days = st.selectbox("Période", options=[7, 30, 90], format_func=lambda d: f"{d} jours", key="metrics_days")
+    
+    rows = metrics.daily_percentiles(metric, days=days)
+    if not rows:
+        st.info("Aucune génération mesurée sur la période")
+    
+    for task, title in (("script", "Scripts"), ("hook", "Hooks"), ("pool", "Réserve de Scripts")):
+        task_rows = [row for row in rows if row["task"] == task]
+        if not task_rows:
+            continue
+        st.markdown(f"### {title}")
+        st.line_chart(task_rows, x="day", y=["p50", "p95", "p99"])
+        latest = task_rows[-1]
+        st.caption(
+            f"{latest['day']}: {latest['count']} générations · p50 {latest['p50']:.2f} · "
+            f"p95 {latest['p95']:.2f} · p99 {latest['p99']:.2f}"
+        )
+    
+    recent = metrics.recent()
+    if recent:
+        st.markdown("### Dernières Générations")
+        st.dataframe([
+            {
+                "Date": datetime.fromtimestamp(row["at"]).strftime("%d/%m %H:%M:%S"),
+                "Tâche": row["kind"],
+                "Statut": row["status"],
+                "Utilisateur": row["username"],
+                "Animal": row["animal"],
+                "Modèle": row["model"],
+                "Max tokens": row["max_tokens"],
+                "Tentatives": row["attempts"],
+                "TTFT (s)": row["ttft"],
+                "Durée (s)": row["total_time"],
+                "Écart max (s)": row["gap_max"],
+                "Tokens/s": row["tokens_per_sec"],
+                "Entrée": row["input_tokens"],
+                "Sortie": row["output_tokens"],
+                "Cache lu": row["cache_read_tokens"],
+                "Cache écrit": row["cache_write_tokens"],
+            }
+            for row in recent
+        ], use_container_width=True)
+
+
+USER_SELECT_LIMIT = 50
+
+USER_SORT_LABELS = {
+    "username": "Nom",
+    "credits": "Crédits",
+    "last_login": "Dernière connexion",
+    "last_activity": "Dernière activité",
+    "total_scripts": "Total Scripts",
+    "total_hooks": "Total Hooks",
+}
+
+
+def show_user_table(auth_manager):
+    """Tableau des utilisateurs paginé côté serveur: seule la page affichée est chargée"""
+    col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 1, 1])
+    
+    with col1:
+        query = st.text_input("Rechercher", key="user_table_search").strip()
+    
+    with col2:
+        mode = st.selectbox(
+            "Correspondance", options=["prefix", "contains"],
+            format_func={"prefix": "Commence par", "contains": "Contient"}.get,
+            key="user_table_mode"
+        )
+    
+    with col3:
+        sort = st.selectbox(
+            "Trier par", options=list(USER_SORT_LABELS),
+            format_func=USER_SORT_LABELS.get, key="user_table_sort"
+        )
+    
+    with col4:
+        descending = st.checkbox("Décroissant", key="user_table_desc")
+    
+    with col5:
+        page_size = st.selectbox("Par page", options=[25, 50, 100], key="user_table_size")
+    
+    # Nouvelle recherche ou nouveau tri: retour à la première page
+    filters = (query, mode, sort, descending, page_size)
+    if st.session_state.get("user_table_filters") != filters:
+        st.session_state.user_table_filters = filters
+        st.session_state.user_table_page = 0
+    
+    page = st.session_state.get("user_table_page", 0)
+    rows, total = auth_manager.list_users(query, mode, sort, descending, page * page_size, page_size)
+    pages = max(1, -(-total // page_size))
+    if page >= pages:
+        # La liste a rétréci depuis le dernier rerun (suppressions)
+        page = st.session_state.user_table_page = pages - 1
+        rows, total = auth_manager.list_users(query, mode, sort, descending, page * page_size, page_size)
+    
+    if not rows:
+        st.info("Aucun utilisateur ne correspond à la recherche")
+        return
+    
+    st.dataframe([
+        {
+            "Utilisateur": username,
+            "Crédits": user_data['credits'],
+            "Total Scripts": user_data.get('total_scripts', 0),
+            "Total Hooks": user_data.get('total_hooks', 0),
+            "Dernière connexion": datetime.fromisoformat(user_data['last_login']).strftime("%d/%m %H:%M") if user_data.get('last_login') else "Jamais"
+        }
+        for username, user_data in rows
+    ], use_container_width=True)
+    
+    col1, col2, col3 = st.columns([1, 3, 1])
+    
+    with col1:
+        if st.button("◀", disabled=page == 0, key="user_table_prev", use_container_width=True):
+            st.session_state.user_table_page = page - 1
+            st.rerun()
+    
+    with col2:
+        st.caption(f"Page {page + 1}/{pages} · {total} utilisateurs")
+    
+    with col3:
+        if st.button("▶", disabled=page + 1 >= pages, key="user_table_next", use_container_width=True):
+            st.session_state.user_table_page = page + 1
+            st.rerun()
+
+
+@profiled("page")
 def show_admin_console():
     """Afficher la console d'administration"""
     st.markdown("# Console Administration")
     
     auth_manager = AuthManager()
     
-    tab1, tab2, tab3 = st.tabs(["Gestion Utilisateurs", "Statistiques", "Mot de passe"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Gestion Utilisateurs", "Statistiques", "Performance", "Mot de passe"])
     
     with tab1:
         st.markdown("### Ajouter un Utilisateur")
@@ -592,8 +973,11 @@ def show_admin_console():
                     st.error("Nom d'utilisateur requis")
 
         st.markdown("### Choisir un Utilisateur")
-        users = auth_manager.get_all_users()
-        user_options = [""] + list(users.keys()) if users else [""]
+        search = st.text_input("Rechercher (début du nom)", key="user_search").strip()
+        matches, total = auth_manager.list_users(search, limit=USER_SELECT_LIMIT)
+        user_options = [""] + [username for username, _ in matches]
+        if total > len(matches):
+            st.caption(f"{len(matches)} premiers sur {total} utilisateurs: affinez la recherche")
         
         user_to_select = st.selectbox(
             "Sélectionner un utilisateur",
@@ -602,7 +986,7 @@ def show_admin_console():
         )
 
         if user_to_select:
-            current_credits = auth_manager.get_user_credits(user_to_select)
+            current_credits = auth_manager.get_stored_credits(user_to_select)
             
             new_credits = st.slider(
                 "Nouveaux crédits",
@@ -625,69 +1009,111 @@ def show_admin_console():
     
     with tab2:
         st.markdown("### Liste des Utilisateurs")
-        users = auth_manager.get_all_users()
+        stats = auth_manager.get_admin_stats()
         
-        if users:
-            total_users = len(users)
-            total_credits = sum(user['credits'] for user in users.values())
-            active_users = len([u for u in users.values() if u.get('last_login')])
-            total_scripts = sum(user.get('total_scripts', 0) for user in users.values())
-            total_hooks = sum(user.get('total_hooks', 0) for user in users.values())
-            
+        if stats["users"]:
             col1, col2, col3, col4, col5 = st.columns(5)
             
             with col1:
-                st.metric("Total Utilisateurs", total_users)
+                st.metric("Total Utilisateurs", stats["users"])
             
             with col2:
-                st.metric("Crédits Totaux", total_credits)
+                st.metric("Crédits Totaux", stats["credits"])
             
             with col3:
-                st.metric("Utilisateurs Actifs", active_users)
+                st.metric("Utilisateurs Actifs", stats["active_users"])
             
             with col4:
-                st.metric("Scripts Générés", total_scripts)
+                st.metric("Scripts Générés", stats["total_scripts"])
             
             with col5:
-                st.metric("Hooks Générés", total_hooks)
+                st.metric("Hooks Générés", stats["total_hooks"])
             
-            # Tableau détaillé avec possibilité de suppression
-            st.markdown("### Détails par Utilisateur")
-            user_stats = []
-            
-            def get_user_content_stats(username):
-                try:
-                    with open("conversations.json", 'r', encoding='utf-8') as f:
-                        conv_data = json.load(f)
-                        user_conversations = conv_data.get(username, {}).get("conversations", [])
-                        scripts_count = sum(len(conv.get("scripts", [])) for conv in user_conversations)
-                        hooks_count = sum(len(conv.get("hooks", [])) for conv in user_conversations)
-                        return scripts_count, hooks_count
-                except:
-                    return 0, 0
-            
-            for username, user_data in users.items():
-                # Utiliser les compteurs totaux depuis la base de données utilisateurs
-                total_scripts = user_data.get('total_scripts', 0)
-                total_hooks = user_data.get('total_hooks', 0)
+            daily = auth_manager.get_daily_stats(30)
+            if daily:
+                st.markdown("### Tendances (30 jours)")
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.caption("Générations et connexions par jour")
+                    st.bar_chart(
+                        [{"Jour": d["day"], "Scripts": d["scripts"], "Hooks": d["hooks"], "Connexions": d["logins"]} for d in daily],
+                        x="Jour", y=["Scripts", "Hooks", "Connexions"]
+                    )
                 
-                user_stats.append({
-                    "Utilisateur": username,
-                    "Crédits": user_data['credits'],
-                    "Total Scripts": total_scripts,
-                    "Total Hooks": total_hooks,
-                    "Dernière connexion": datetime.fromisoformat(user_data['last_login']).strftime("%d/%m %H:%M") if user_data.get('last_login') else "Jamais"
-                })
+                with col2:
+                    st.caption("Crédits dépensés / ajoutés par jour")
+                    st.bar_chart(
+                        [{"Jour": d["day"], "Dépensés": d["credits_spent"], "Ajoutés": d["credits_added"]} for d in daily],
+                        x="Jour", y=["Dépensés", "Ajoutés"]
+                    )
+                
+                st.caption("Utilisateurs et crédits en circulation (fin de journée)")
+                st.line_chart(
+                    [{"Jour": d["day"], "Utilisateurs": d["users"], "Crédits": d["credits"]} for d in daily],
+                    x="Jour", y=["Utilisateurs", "Crédits"]
+                )
             
-            st.dataframe(user_stats, use_container_width=True)
+            st.markdown("### Détails par Utilisateur")
+            show_user_table(auth_manager)
             
         else:
             st.info("Aucun utilisateur enregistré")
+        
+        st.markdown("### File de Génération")
+        queue_stats = get_job_runner().queue_stats()
+        
+        col1, col2, col3, col4 = st.columns(4)
+        
+        with col1:
+            st.metric("En cours", queue_stats["running"])
+        
+        with col2:
+            st.metric("En attente", queue_stats["queued"])
+        
+        with col3:
+            st.metric("Attente moyenne", f"{queue_stats['avg_wait']:.1f}s")
+        
+        with col4:
+            st.metric("Attente p95", f"{queue_stats['p95_wait']:.1f}s")
+        
+        if queue_stats["queued"]:
+            st.caption(f"Plus ancienne demande en attente depuis {queue_stats['oldest_wait']:.0f}s")
+        
+        script_pool = get_script_pool()
+        if script_pool is not None:
+            st.markdown("### Réserve de Scripts")
+            pool_stats = script_pool.stats()
+            
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                st.metric("Taux de hit", f"{pool_stats['hit_rate']:.0%}")
+            
+            with col2:
+                st.metric("Servis depuis la réserve", f"{pool_stats['hits']}/{pool_stats['served']}")
+            
+            with col3:
+                st.metric("Scripts en stock", sum(row["stock"] for row in pool_stats["animals"]))
+            
+            if pool_stats["animals"]:
+                st.dataframe([
+                    {
+                        "Animal": row["animal"],
+                        "Demandes": row["requests"],
+                        "Hits": row["hits"],
+                        "Ratés": row["misses"],
+                        "En stock": f"{row['stock']}/{script_pool.target_size(row['animal'])}"
+                    }
+                    for row in pool_stats["animals"]
+                ], use_container_width=True)
 
     with tab3:
+        show_generation_metrics()
+
+    with tab4:
         st.markdown("### Modifier le Mot de Passe Global")
-        data = auth_manager._load_users()
-        current_password = data.get("global_password", "")
+        current_password = auth_manager.get_global_password()
         
         with st.form("password_form"):
             st.info(f"Mot de passe actuel: **{current_password}**")
@@ -724,6 +1150,7 @@ if 'auto_generate' not in st.session_state:
 if 'auto_generate_animal' not in st.session_state:
     st.session_state.auto_generate_animal = None
 
+@profiled("page")
 def show_animal_manager_page(animal, generator):
     # Gestion des toasts de sauvegarde et suppression
     if st.session_state.get('show_save_success'):
@@ -751,18 +1178,7 @@ def show_animal_manager_page(animal, generator):
         st.session_state.current_page = "main"
         st.rerun()
     
-    data = generator._load_conversations()
-    # Nettoyer les anciennes conversations avant affichage
-    data = generator._cleanup_old_conversations(data)
-    conversation = None
-    
-    user_data = data.get(st.session_state.username, {})
-    user_conversations = user_data.get("conversations", [])
-
-    for conv in user_conversations:
-        if conv["animal"].lower() == animal.lower():
-            conversation = conv
-            break
+    conversation = generator.find_conversation(animal)
     
     if not conversation:
         st.error(f"❌ Aucune conversation trouvée pour {animal}")
@@ -820,39 +1236,28 @@ def show_animal_manager_page(animal, generator):
             st.text("Aucun script pour cet animal...")
             
             # Vérifier les crédits pour la génération
-            if st.session_state.user_type == "user":
+            script_job = generator.running_job("script", conversation["id"])
+            if script_job is not None:
+                generator.defer_attach(script_job)
+            elif st.session_state.user_type == "user":
                 auth_manager = AuthManager()
                 user_credits = auth_manager.get_user_credits(st.session_state.username)
                 
                 if user_credits >= 2:
                     if st.button(f"Générer un script - 2/{user_credits} crédits", type="primary", key=f"generate_script_{conversation['id']}", use_container_width=True):
-                        if auth_manager.deduct_credits(st.session_state.username, 2):
-                            with st.spinner("Génération du script en cours..."):
-                                generated_script = generator.generate_script_stream(conversation["animal"])
-                                if generated_script:
-                                    if generator.add_script_to_conversation(conversation["animal"], generated_script):
-                                        st.rerun()
-                                    else:
-                                        st.error("❌ Erreur lors de l'ajout du script")
-                                else:
-                                    st.error("❌ Erreur lors de la génération du script")
-                                    # Rembourser les crédits en cas d'erreur
-                                    auth_manager.update_user_credits(st.session_state.username, user_credits)
+                        reservation = auth_manager.reserve_credits(st.session_state.username, 2)
+                        if reservation:
+                            # Débit, compteur et ajout du script sont faits par le job à la fin du flux
+                            if generator.start_script_job(conversation["animal"], reservation, conversation["id"]):
+                                st.rerun()
                         else:
                             st.error("❌ Crédits insuffisants")
                 else:
                     st.button(f"Crédits insuffisants - {user_credits}/2", type="primary", key=f"generate_script_{conversation['id']}", use_container_width=True, disabled=True)
             else:  # Admin
                 if st.button("Générer un script", type="primary", key=f"generate_script_{conversation['id']}", use_container_width=True):
-                    with st.spinner("Génération du script en cours..."):
-                        generated_script = generator.generate_script_stream(conversation["animal"])
-                        if generated_script:
-                            if generator.add_script_to_conversation(conversation["animal"], generated_script):
-                                st.rerun()
-                            else:
-                                st.error("❌ Erreur lors de l'ajout du script")
-                        else:
-                            st.error("❌ Erreur lors de la génération du script")
+                    if generator.start_script_job(conversation["animal"], conversation_id=conversation["id"]):
+                        st.rerun()
             
             if st.button("Ajouter un script manuellement", key=f"add_manual_script_{conversation['id']}", use_container_width=True):
                 st.session_state[f"show_manual_script_form_{conversation['id']}"] = True
@@ -977,39 +1382,27 @@ def show_animal_manager_page(animal, generator):
             st.text("Aucun hook pour cet animal...")
             
             # Vérifier les crédits pour la génération de hooks
-            if st.session_state.user_type == "user":
+            hooks_job = generator.running_job("hooks", conversation["id"])
+            if hooks_job is not None:
+                generator.defer_attach(hooks_job)
+            elif st.session_state.user_type == "user":
                 auth_manager = AuthManager()
                 user_credits = auth_manager.get_user_credits(st.session_state.username)
                 
                 if user_credits >= 1:
                     if st.button(f"Générer des hooks - 1/{user_credits} crédits", type="primary", key=f"generate_hooks_{conversation['id']}", use_container_width=True):
-                        if auth_manager.deduct_credits(st.session_state.username, 1):
-                            with st.spinner("Génération des hooks en cours..."):
-                                generated_hooks = generator.generate_hooks_stream(conversation)
-                                if generated_hooks:
-                                    if generator.add_hooks_to_conversation(conversation["id"], generated_hooks):
-                                        st.rerun()
-                                    else:
-                                        st.error("❌ Erreur lors de l'ajout des hooks")
-                                else:
-                                    st.error("❌ Erreur lors de la génération des hooks")
-                                    # Rembourser les crédits en cas d'erreur
-                                    auth_manager.update_user_credits(st.session_state.username, user_credits)
+                        reservation = auth_manager.reserve_credits(st.session_state.username, 1)
+                        if reservation:
+                            if generator.start_hooks_job(conversation, reservation):
+                                st.rerun()
                         else:
                             st.error("❌ Crédits insuffisants")
                 else:
                     st.button(f"Crédits insuffisants - {user_credits}/1", type="primary", key=f"generate_hooks_{conversation['id']}", use_container_width=True, disabled=True)
             else:  # Admin
                 if st.button("Générer des hooks", type="primary", key=f"generate_hooks_{conversation['id']}", use_container_width=True):
-                    with st.spinner("Génération des hooks en cours..."):
-                        generated_hooks = generator.generate_hooks_stream(conversation)
-                        if generated_hooks:
-                            if generator.add_hooks_to_conversation(conversation["id"], generated_hooks):
-                                st.rerun()
-                            else:
-                                st.error("❌ Erreur lors de l'ajout des hooks")
-                        else:
-                            st.error("❌ Erreur lors de la génération des hooks")
+                    if generator.start_hooks_job(conversation):
+                        st.rerun()
             
             if st.button("Ajouter des hooks manuellement", key=f"add_manual_hooks_{conversation['id']}", use_container_width=True):
                 st.session_state[f"show_manual_hooks_form_{conversation['id']}"] = True
@@ -1119,11 +1512,15 @@ def main():
             
             if generator.script_prompt:
                 st.success("✅ Script prompt chargé")
+                for warning in generator.script_template.warnings:
+                    st.warning(f"⚠️ Script prompt: {warning}")
             else:
                 st.error("❌ Script prompt manquant")
                 
             if generator.hook_prompt:
                 st.success("✅ Hook prompt chargé")
+                for warning in generator.hook_template.warnings:
+                    st.warning(f"⚠️ Hook prompt: {warning}")
             else:
                 st.error("❌ Hook prompt manquant")
 
@@ -1132,13 +1529,33 @@ def main():
             else:
                 st.error("❌ Liste d'animaux manquante")
             
+            cache_usage = get_cache_usage_log().summary()
+            if cache_usage["calls"]:
+                st.caption(f"Cache prompt: {cache_usage['hit_ratio']:.0%} des tokens d'entrée lus depuis le cache ({cache_usage['calls']} appels)")
+            
+            attempts = get_attempt_log().summary()
+            if attempts["retries"] or attempts["failed"]:
+                st.caption(f"Streams: {attempts['retries']} coupures reprises, {attempts['resumed']} générations sauvées, {attempts['failed']} échecs")
+            
+            ttft = get_ttft_stats().snapshot()
+            if ttft["count"]:
+                st.caption(f"TTFT: p50 {ttft['p50']:.2f}s, p95 {ttft['p95']:.2f}s ({ttft['count']} générations)")
+            
+            render_stats = get_render_stats().snapshot()
+            if render_stats["chunks"]:
+                st.caption(f"Streaming: {render_stats['renders']} rendus pour {render_stats['chunks']} morceaux ({render_stats['saved']} évités)")
+            
+            profiler = get_profiler()
+            if profiler is not None:
+                show_profiling_panel(profiler)
+            
             if st.button("Recharger les prompts", use_container_width=True):
                 st.rerun()
             
             if st.button("Nettoyer la database", use_container_width=True):
                 if st.session_state.get('confirm_delete'):
                     generator.force_cleanup()
-                    st.success("✅ Conversations expirées supprimées")
+                    st.success("✅ Nettoyage des conversations expirées lancé")
                     st.session_state.confirm_delete = False
                     st.rerun()
                 else:
@@ -1167,16 +1584,16 @@ def main():
             
             if st.button("Supprimer mes scripts", use_container_width=True):
                 if st.session_state.get('user_confirm_delete'):
-                    data = generator._load_conversations()
-                    if st.session_state.username in data:
-                        data[st.session_state.username] = {"conversations": []}
-                        generator._save_conversations(data)
+                    generator.store.clear_user(st.session_state.username)
                     st.session_state.user_confirm_delete = False
                     st.rerun()
                 else:
                     st.session_state.user_confirm_delete = True
                     st.warning("⚠️ Cliquez à nouveau pour confirmer")
 
+    # Scripts et hooks terminés en arrière-plan depuis le dernier run
+    generator.notify_finished_jobs()
+
     # Routage des pages
     if st.session_state.current_page == "admin_console" and st.session_state.user_type == "admin":
         show_admin_console()
@@ -1185,7 +1602,57 @@ def main():
             show_animal_manager_page(st.session_state.selected_animal, generator)
     else:
         show_main_app(generator)
+    
+    # Les générations en cours sont diffusées une fois le reste de la page affiché
+    generator.attach_deferred()
+
+def start_variant_generation(generator, animal, count):
+    """Réserve les crédits des `count` variantes en une fois puis les lance en parallèle"""
+    reservations = [None] * count
+    if st.session_state.user_type == "user":
+        reservations = AuthManager().reserve_credits_batch(st.session_state.username, 2, count)
+        if reservations is None:
+            st.error(f"❌ Crédits insuffisants pour {count} variantes ({2 * count} crédits)")
+            return False
+    
+    return generator.start_variant_jobs(animal, reservations) is not None
 
+def start_draft_generation(generator, animal):
+    """Réserve les crédits puis lance un brouillon de script en arrière-plan.
+    
+    Un brouillon est débité et compté dès qu'il est généré, mais n'est
+    enregistré dans la conversation qu'au clic sur « Accepter »: un brouillon
+    refusé est payé sans être sauvegardé.
+    """
+    reservation = None
+    if st.session_state.user_type == "user":
+        reservation = AuthManager().reserve_credits(st.session_state.username, 2)
+        if reservation is None:
+            st.error("❌ Crédits insuffisants")
+            return False
+    
+    # Réserve de scripts pré-générés: réponse immédiate, débit et compteur comme une génération
+    script_pool = get_script_pool()
+    if script_pool is not None:
+        script = script_pool.take(animal)
+        if script is not None:
+            try:
+                committed = AuthManager().commit_generation(st.session_state.username, reservation, "total_scripts")
+            except Exception:
+                script_pool.put_back(animal, script)
+                raise
+            if committed:
+                st.session_state.generated_script = script["content"]
+                st.session_state.generated_animal = animal
+                return True
+            # Débit refusé: le script reste disponible pour la prochaine demande
+            script_pool.put_back(animal, script)
+            st.error("❌ Crédits insuffisants")
+            return False
+    
+    return generator.start_script_job(animal, reservation) is not None
+
+@profiled("page")
 def show_main_app(generator):
     """Afficher l'application principale"""
     
@@ -1193,6 +1660,20 @@ def show_main_app(generator):
         st.toast("Script accepté !", icon="🎉")
         st.session_state.show_success_message = False
     
+    # Brouillons générés en arrière-plan, y compris pendant une déconnexion
+    running_draft = None
+    for job in generator.draft_jobs():
+        if not job.finished:
+            running_draft = running_draft or job
+        elif job.status != "done":
+            generator.claim_job(job)
+            st.error(f"❌ Échec de la génération du script pour {job.label}: {job.error}")
+        elif not st.session_state.generated_script:
+            generator.claim_job(job)
+            st.session_state.generated_script = job.text()
+            st.session_state.generated_animal = job.label
+    st.session_state.generation_in_progress = running_draft is not None
+    
     col1, col2, col3 = st.columns([1, 4, 1])
     generate_btn = None
     
@@ -1205,7 +1686,7 @@ def show_main_app(generator):
                 key="animal_input",
             )
             
-            col_btn1, col_btn2, col_btn3 = st.columns([4, 1, 1])
+            col_btn1, col_btn2, col_btn3, col_btn4 = st.columns([4, 1, 1, 1])
             
             with col_btn1:
                 # Affichage différent selon le type d'utilisateur
@@ -1225,6 +1706,15 @@ def show_main_app(generator):
             
             with col_btn3:
                 add_manual_btn = st.form_submit_button("➕", use_container_width=True)
+            
+            with col_btn4:
+                variant_count = st.selectbox(
+                    "Variantes",
+                    options=list(range(1, int(st.secrets.get("MAX_VARIANTS", 4)) + 1)),
+                    format_func=lambda n: f"×{n}",
+                    label_visibility="collapsed",
+                    key="variant_count"
+                )
         
         if random_btn:
             st.session_state.random_animals = get_random_animals_placeholder()
@@ -1240,78 +1730,57 @@ def show_main_app(generator):
         st.session_state.auto_generate = False
         st.session_state.auto_generate_animal = None
         
-        if st.session_state.user_type == "user":
-            auth_manager = AuthManager()
-            if not auth_manager.deduct_credits(st.session_state.username, 2):
-                st.error("❌ Crédits insuffisants")
-                return
-        
-        st.session_state.generation_in_progress = True
-        
-        col1, col2, col3 = st.columns([1, 4, 1])
-        
-        with col2:
-            st.markdown(f"#### Génération pour : **{animal}**")
-            
-            try:
-                generated_script = generator.generate_script_stream(animal)
-                
-                if generated_script:
-                    st.session_state.generated_script = generated_script
-                    st.session_state.generated_animal = animal
-                    st.session_state.generation_in_progress = False
-                else:
-                    st.session_state.generation_in_progress = False
-                    st.error("❌ Échec de la génération du script")
-                    # Rembourser en cas d'erreur
-                    if st.session_state.user_type == "user":
-                        current_credits = auth_manager.get_user_credits(st.session_state.username)
-                        auth_manager.update_user_credits(st.session_state.username, current_credits + 2)
-            except Exception as e:
-                st.session_state.generation_in_progress = False
-                st.error(f"❌ Erreur lors de la génération: {str(e)}")
-                # Rembourser en cas d'erreur
-                if st.session_state.user_type == "user":
-                    current_credits = auth_manager.get_user_credits(st.session_state.username)
-                    auth_manager.update_user_credits(st.session_state.username, current_credits + 2)
+        if start_draft_generation(generator, animal):
+            st.rerun()
     
     elif generate_btn and animal_input.strip():
         animal = animal_input.strip().title()
         
-        if st.session_state.user_type == "user":
-            auth_manager = AuthManager()
-            if not auth_manager.deduct_credits(st.session_state.username, 2):
-                st.error("❌ Crédits insuffisants")
-                return
-        
-        st.session_state.generation_in_progress = True
+        if variant_count > 1:
+            if start_variant_generation(generator, animal, variant_count):
+                st.rerun()
+        elif start_draft_generation(generator, animal):
+            st.rerun()
+    
+    # Flux du brouillon en cours, diffusé en fin de run
+    if running_draft is not None:
+        col1, col2, col3 = st.columns([1, 4, 1])
         
+        with col2:
+            st.markdown(f"#### Génération pour : **{running_draft.label}**")
+            generator.defer_attach(running_draft)
+    
+    # Variantes générées en parallèle, affichées côte à côte
+    variants = generator.variant_group()
+    if variants:
         col1, col2, col3 = st.columns([1, 4, 1])
         
         with col2:
-            st.markdown(f"#### Génération pour : **{animal}**")
+            st.markdown(f"#### {len(variants)} variantes pour : **{variants[0].label}**")
+            variant_cols = st.columns(len(variants))
             
-            try:
-                generated_script = generator.generate_script_stream(animal)
-                
-                if generated_script:
-                    st.session_state.generated_script = generated_script
-                    st.session_state.generated_animal = animal
-                    st.session_state.generation_in_progress = False
-                else:
-                    st.session_state.generation_in_progress = False
-                    st.error("❌ Échec de la génération du script")
-                    # Rembourser en cas d'erreur
-                    if st.session_state.user_type == "user":
-                        current_credits = auth_manager.get_user_credits(st.session_state.username)
-                        auth_manager.update_user_credits(st.session_state.username, current_credits + 2)
-            except Exception as e:
-                st.session_state.generation_in_progress = False
-                st.error(f"❌ Erreur lors de la génération: {str(e)}")
-                # Rembourser en cas d'erreur
-                if st.session_state.user_type == "user":
-                    current_credits = auth_manager.get_user_credits(st.session_state.username)
-                    auth_manager.update_user_credits(st.session_state.username, current_credits + 2)
+            for i, (variant_col, job) in enumerate(zip(variant_cols, variants), 1):
+                with variant_col:
+                    st.markdown(f"**Variante {i}**")
+                    if not job.finished:
+                        generator.defer_attach(job)
+                    elif job.status == "done":
+                        st.markdown(job.text())
+                        if st.button("✅ Accepter", type="primary", use_container_width=True, key=f"accept_variant_{job.id}"):
+                            if generator.add_script_to_conversation(job.label, job.text()):
+                                for other in variants:
+                                    generator.claim_job(other)
+                                st.session_state.show_success_message = True
+                                st.rerun()
+                            else:
+                                st.error("❌ Erreur lors de la sauvegarde")
+                    else:
+                        st.error(f"❌ {job.error}")
+            
+            if st.button("❌ Refuser les variantes", use_container_width=True, key="reject_variants_btn"):
+                for job in variants:
+                    generator.claim_job(job)
+                st.rerun()
     
     # Formulaire d'ajout manuel
     if st.session_state.show_manual_form:
@@ -1418,10 +1887,7 @@ def show_main_app(generator):
                 else:
                     st.button("🔄 Crédits insuffisants", use_container_width=True, disabled=True)
     
-    data = generator._load_conversations()
-    # Nettoyer les anciennes conversations avant affichage
-    data = generator._cleanup_old_conversations(data)
-    user_conversations = data.get(st.session_state.username, {}).get("conversations", [])
+    user_conversations = generator.get_conversations()
     conversations_with_scripts = [conv for conv in user_conversations if conv["scripts"]]
     
     if conversations_with_scripts:
@@ -1448,6 +1914,7 @@ def show_main_app(generator):
                     with tabs[i]:
                         display_conversation(conv, generator)
 
+@profiled("page")
 def display_conversation(conversation, generator):
     """Afficher une conversation dans l'onglet"""
     animal = conversation["animal"]
@@ -1501,32 +1968,22 @@ def display_conversation(conversation, generator):
             st.markdown(script["content"])
     
     # Génération des hooks
-    if 'generate_hooks_btn' in locals() and generate_hooks_btn and can_generate_hooks:
-        # Vérification supplémentaire des crédits
+    hooks_job = generator.running_job("hooks", conversation["id"])
+    if hooks_job is not None:
+        st.markdown("#### Génération des Hooks")
+        generator.defer_attach(hooks_job)
+    
+    elif 'generate_hooks_btn' in locals() and generate_hooks_btn and can_generate_hooks:
+        reservation = None
+        # Réserver les crédits pour les utilisateurs normaux
         if st.session_state.user_type == "user":
-            auth_manager = AuthManager()
-            user_credits = auth_manager.get_user_credits(st.session_state.username)
-            if user_credits < 1:
+            reservation = AuthManager().reserve_credits(st.session_state.username, 1)
+            if reservation is None:
                 st.error("❌ Crédits insuffisants")
                 return
-            
-            # Déduire les crédits pour les utilisateurs normaux
-            if not auth_manager.deduct_credits(st.session_state.username, 1):
-                st.error("❌ Crédits insuffisants")
-                return
-        
-        st.markdown("#### Génération des Hooks")
-        
-        hooks_content = generator.generate_hooks_stream(conversation)
         
-        if hooks_content:
-            generator.add_hooks_to_conversation(conversation["id"], hooks_content)
+        if generator.start_hooks_job(conversation, reservation):
             st.rerun()
-        else:
-            # Rembourser en cas d'erreur
-            if st.session_state.user_type == "user":
-                current_credits = auth_manager.get_user_credits(st.session_state.username)
-                auth_manager.update_user_credits(st.session_state.username, current_credits + 1)
     
     # Affichage des hooks existants
     if conversation.get("hooks") and len(conversation["hooks"]) > 0:
@@ -1537,4 +1994,9 @@ def display_conversation(conversation, generator):
                 st.markdown(hook_entry["content"])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiler = get_profiler()
+    if profiler is None:
+        main()
+    else:
+        with profiler.rerun(st.session_state.get("current_page", "main")):
+            main()
\ No newline at end of file
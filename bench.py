@@ -0,0 +1,410 @@
+"""Micro-benchmarks du stockage à travers AuthManager et ViralScriptGenerator.
+
+Génère un users.json et un conversations.json à l'échelle demandée (1k, 10k et
+100k utilisateurs par défaut). Chaque backend est mesuré dans un processus
+séparé qui importe app.py (mode « bare », sans `streamlit run`) dans un
+répertoire contenant ces fichiers et un .streamlit/secrets.toml: les stores
+sont ouverts par les fabriques de l'application (migration depuis le JSON
+comprise) et chaque opération passe par les méthodes des managers, avec leur
+agrégateur d'activité et leur ledger de crédits. Les résultats (ops/s, p50,
+p95) sont écrits dans un fichier JSON: comparer deux runs avec --baseline
+signale les régressions.
+
+    python bench.py                                        # 1k, 10k, 100k, tous les backends
+    python bench.py --scales 1000 --conversation-backends json,sqlite
+    python bench.py --output new.json --baseline bench_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from accounts import new_user
+from metrics import percentile
+from storage import ExpirySweeper, atomic_write_json, make_hook, make_script, new_conversation, read_json
+
+CONVERSATION_TIME = 7 * 24 * 60 * 60
+# Avance d'horloge de la passe du sweeper mesurée (≈ 7 % des conversations du jeu)
+SWEEP_AHEAD = 0.1 * CONVERSATION_TIME
+
+# Secrets communs aux workers: les lots d'activité ne sont écrits que par la mesure
+# du flush, et le sweeper est mesuré à part (pas de passe en tâche de fond)
+BENCH_SECRETS = {"ACTIVITY_FLUSH_SECONDS": 3600, "ACTIVITY_FLUSH_EVENTS": 10 ** 9, "EXPIRY_SWEEPER": False}
+
+ANIMALS = [
+    "Chat", "Chien", "Lion", "Tigre", "Éléphant", "Girafe", "Zèbre", "Panda", "Koala", "Kangourou",
+    "Loup", "Renard", "Ours", "Aigle", "Hibou", "Dauphin", "Requin", "Baleine", "Pieuvre", "Tortue",
+    "Crocodile", "Serpent", "Grenouille", "Papillon", "Abeille", "Fourmi", "Pingouin", "Phoque", "Loutre", "Castor",
+]
+
+WORDS = (
+    "le la les un une des et mais donc car animal incroyable secret nature vidéo regarde ceci "
+    "personne ne sait pourquoi cet peut survivre jours sans eau voici trois faits qui vont te surprendre"
+).split()
+
+USER_BACKENDS = ("json", "sqlite")
+CONVERSATION_BACKENDS = ("json", "sharded", "journal", "sqlite")
+
+
+def make_dataset(n_users, rng, active_ratio, conversations, scripts, script_chars):
+    """(users.json, conversations.json) synthétiques.
+
+    `active_ratio` des utilisateurs ont des conversations: 1 à 2*`conversations`-1
+    chacun, de 1 à 2*`scripts`-1 scripts, un hook sur deux. Les dates de création
+    couvrent 1,4 fois la durée de vie: une partie des conversations est expirée.
+    """
+    texts = [" ".join(rng.choice(WORDS) for _ in range(script_chars // 5))[:script_chars] for _ in range(32)]
+    now = time.time()
+    users = {"global_password": "bench", "users": {}}
+    data = {}
+    for i in range(n_users):
+        username = f"user{i:06d}"
+        user = new_user(rng.randint(0, 100))
+        user["total_scripts"] = rng.randint(0, 50)
+        user["total_hooks"] = rng.randint(0, 20)
+        users["users"][username] = user
+        if rng.random() >= active_ratio:
+            continue
+        convs = []
+        for animal in rng.sample(ANIMALS, min(len(ANIMALS), rng.randint(1, 2 * conversations - 1))):
+            conv = new_conversation(animal)
+            conv["created_at"] = datetime.fromtimestamp(now - rng.uniform(0, 1.4 * CONVERSATION_TIME)).isoformat()
+            conv["scripts"] = [make_script(rng.choice(texts)) for _ in range(rng.randint(1, 2 * scripts - 1))]
+            if rng.random() < 0.5:
+                conv["hooks"] = [make_hook(rng.choice(texts)[:script_chars // 3])]
+            convs.append(conv)
+        data[username] = {"conversations": convs}
+    return users, data
+
+
+def prepare_workspace(directory, files, secrets):
+    """Répertoire d'un worker: copies des fichiers du jeu de données et configuration Streamlit"""
+    os.makedirs(os.path.join(directory, ".streamlit"))
+    for path in files:
+        shutil.copy(path, directory)
+    with open(os.path.join(directory, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        for key, value in secrets.items():
+            # Une chaîne JSON est aussi une chaîne TOML valide
+            f.write(f"{key} = {json.dumps(value, ensure_ascii=False)}\n")
+    # Sans `streamlit run`, chaque accès au contexte de script journalise un avertissement
+    with open(os.path.join(directory, ".streamlit", "config.toml"), "w", encoding="utf-8") as f:
+        f.write('[logger]\nlevel = "error"\n')
+
+
+class Runner:
+    """Chronomètre des opérations et accumule les lignes de résultats"""
+
+    def __init__(self, ops, max_seconds):
+        self.ops = ops
+        self.max_seconds = max_seconds
+        self.results = []
+
+    def measure(self, context, op, call, args, ops=None, setup=None):
+        """Appelle `call(*args[i])` jusqu'à `ops` fois ou `max_seconds` écoulées.
+
+        `setup(*args[i])`, s'il est donné, est appelé avant chaque mesure sans être chronométré.
+        """
+        latencies = []
+        deadline = time.perf_counter() + self.max_seconds
+        for i in range(min(ops or self.ops, len(args))):
+            if setup is not None:
+                setup(*args[i])
+            started = time.perf_counter()
+            call(*args[i])
+            latencies.append(time.perf_counter() - started)
+            if time.perf_counter() > deadline:
+                break
+        self.record(context, op, latencies)
+
+    def record(self, context, op, latencies):
+        latencies = sorted(latencies)
+        total = sum(latencies)
+        row = dict(context, op=op, ops=len(latencies),
+                   ops_per_sec=len(latencies) / total if total else None,
+                   p50_ms=percentile(latencies, 50) * 1000 if latencies else None,
+                   p95_ms=percentile(latencies, 95) * 1000 if latencies else None,
+                   total_s=total)
+        self.results.append(row)
+        rate = f"{row['ops_per_sec']:.1f} ops/s" if row["ops_per_sec"] else "-"
+        p95 = f"p95 {row['p95_ms']:.2f} ms" if latencies else ""
+        print(f"  {context['store']:<13} {context['backend']:<8} {op:<36} {len(latencies):>5} ops  {rate:>14}  {p95}")
+        return row
+
+
+def timed(call):
+    started = time.perf_counter()
+    result = call()
+    return result, time.perf_counter() - started
+
+
+def bench_users(runner, context, app, targets, rng):
+    """Opérations sur les comptes, telles que l'application les appelle (AuthManager)"""
+    usernames = targets["usernames"]
+    pick = lambda n: [rng.choice(usernames) for _ in range(n)]
+    auth, seconds = timed(app.AuthManager)
+    runner.record(context, "open", [seconds])
+    activity = app.get_activity_aggregator()
+
+    def generation(username):
+        reservation = auth.reserve_credits(username, 2)
+        return auth.commit_generation(username, reservation, "total_scripts")
+
+    def pending_activity():
+        for username in pick(50):
+            activity.increment(username, "total_scripts")
+            activity.touch(username, "last_activity")
+
+    new_names = [(f"bench-{i}", 10) for i in range(runner.ops)]
+    funded = pick(runner.ops)
+    runner.measure(context, "get_all_users", auth.get_all_users, [()] * runner.ops, ops=min(runner.ops, 20))
+    runner.measure(context, "get_admin_stats", auth.get_admin_stats, [()] * runner.ops)
+    runner.measure(context, "list_users (prefix)", auth.list_users, [(u[:7],) for u in pick(runner.ops)])
+    runner.measure(context, "list_users (credits)", lambda offset: auth.list_users(sort="credits", descending=True, offset=offset),
+                   [(rng.randrange(len(usernames)),) for _ in range(runner.ops)])
+    runner.measure(context, "get_user_credits", auth.get_user_credits, [(u,) for u in pick(runner.ops)])
+    runner.measure(context, "get_user_stats", auth.get_user_stats, [(u,) for u in pick(runner.ops)])
+    runner.measure(context, "add_user", auth.add_user, new_names)
+    runner.measure(context, "update_user_credits", auth.update_user_credits, [(u, 50) for u in funded])
+    runner.measure(context, "reserve + commit_generation", generation, [(u,) for u in funded])
+    runner.measure(context, "deduct_credits", auth.deduct_credits, [(u, 1) for u in pick(runner.ops)])
+    runner.measure(context, "increment_script_count", auth.increment_script_count, [(u,) for u in pick(runner.ops)])
+    runner.measure(context, "update_last_login", auth.update_last_login, [(u,) for u in pick(runner.ops)])
+    runner.measure(context, "activity flush (50 users)", activity.flush, [()] * runner.ops, setup=pending_activity)
+    runner.measure(context, "remove_user", auth.remove_user, [(name,) for name, _ in new_names])
+
+
+def bench_conversations(runner, context, app, targets, rng):
+    """Opérations sur les conversations, telles que l'application les appelle (ViralScriptGenerator)
+
+    Un générateur par utilisateur, comme dans une session: il est construit
+    hors mesure au premier appel pour cet utilisateur.
+    """
+    active = targets["active"]
+    pick = lambda n: [rng.choice(targets["conversations"]) for _ in range(n)]
+    sample = lambda n: rng.sample(active, min(len(active), n))
+    generator, seconds = timed(lambda: app.ViralScriptGenerator(active[0]))
+    runner.record(context, "open", [seconds])
+    store = app.get_conversation_store()
+    # Configuration de l'application: l'expiration passe par le sweeper, pas par les lectures
+    store.cleanup_on_access = False
+    generators = {active[0]: generator}
+
+    def session(username, *args):
+        if username not in generators:
+            generators[username] = app.ViralScriptGenerator(username)
+
+    def as_user(method):
+        return lambda username, *args: getattr(generators[username], method)(*args)
+
+    def measure(op, call, args, **kwargs):
+        runner.measure(context, op, call, args, setup=session, **kwargs)
+
+    texts = ["script de benchmark " * 50] * runner.ops
+    with_hooks = pick(runner.ops)
+    measure("get_conversations", as_user("get_conversations"), [(u,) for u in sample(runner.ops)])
+    measure("find_conversation", as_user("find_conversation"), [(u, a) for u, _, a in pick(runner.ops)])
+    measure("_get_or_create_conversation", as_user("_get_or_create_conversation"), [(u, "Animal Bench") for u, _, _ in pick(runner.ops)])
+    measure("add_script_to_conversation", as_user("add_script_to_conversation"), [(u, a, t) for (u, _, a), t in zip(pick(runner.ops), texts)])
+    measure("update_script", as_user("update_script"), [(u, c, 0, t) for (u, c, _), t in zip(pick(runner.ops), texts)])
+    measure("delete_script", as_user("delete_script"), [(u, c, 0) for u, c, _ in pick(runner.ops)])
+    # Les mêmes conversations pour les trois opérations: chacune a au moins le hook ajouté
+    measure("add_hooks_to_conversation", as_user("add_hooks_to_conversation"), [(u, c, t) for (u, c, _), t in zip(with_hooks, texts)])
+    measure("update_hook", as_user("update_hook"), [(u, c, 0, t) for (u, c, _), t in zip(with_hooks, texts)])
+    measure("delete_hook", as_user("delete_hook"), [(u, c, 0) for u, c, _ in with_hooks])
+    measure("clear_user", lambda username: generators[username].store.clear_user(username), [(u,) for u in sample(runner.ops)])
+    auth = app.AuthManager()
+    runner.measure(context, "remove_user (compte + conversations)", auth.remove_user, [(u,) for u in sample(runner.ops)])
+
+    # Expiration: index du sweeper, passe incrémentale, puis passe complète (bouton admin sans sweeper).
+    # Le journal purge déjà les expirées à l'ouverture (compaction): on retire d'abord
+    # les conversations échues partout, puis on mesure une passe en avançant l'horloge
+    # de SWEEP_AHEAD, pour que tous les backends suppriment le même lot.
+    sweeper = ExpirySweeper(store)
+    _, seconds = timed(sweeper.seed)
+    runner.record(context, "sweeper_seed", [seconds])
+    sweeper.sweep()
+    removed, seconds = timed(lambda: sweeper.sweep(now=time.time() + SWEEP_AHEAD))
+    runner.record(context, "sweeper_sweep", [seconds])["removed"] = removed
+    store.cleanup_on_access = True
+    _, seconds = timed(generator.force_cleanup)
+    runner.record(context, "force_cleanup (full)", [seconds])
+
+
+def worker(args):
+    """Mesures d'un backend dans le répertoire préparé par run_worker (répertoire courant)"""
+    # Importé ici: app.py lit les secrets et ouvre ses stores dans le répertoire courant
+    import app
+
+    targets = read_json(args.targets)
+    context = {"scale": args.scale, "store": args.worker, "backend": args.backend}
+    runner = Runner(args.ops, args.max_seconds)
+    bench = bench_users if args.worker == "users" else bench_conversations
+    bench(runner, context, app, targets, random.Random(args.seed))
+    atomic_write_json(args.worker_output, runner.results)
+    return 0
+
+
+def run_worker(runner, args, store, backend, scale, scale_dir, files, secrets):
+    """Lance un processus de mesure pour un backend et récupère ses résultats"""
+    directory = tempfile.mkdtemp(prefix=f"{store}-{backend}-", dir=scale_dir)
+    prepare_workspace(directory, files, dict(BENCH_SECRETS, **secrets))
+    output = os.path.join(directory, "results.json")
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", store, "--backend", backend, "--scale", str(scale),
+         "--targets", os.path.join(scale_dir, "targets.json"), "--worker-output", output,
+         "--ops", str(args.ops), "--max-seconds", str(args.max_seconds), "--seed", str(args.seed)],
+        cwd=directory, check=True
+    )
+    runner.results.extend(read_json(output))
+
+
+def run_scale(runner, args, n_users, root):
+    rng = random.Random(args.seed)
+    print(f"\n=== {n_users} utilisateurs ===")
+    users_doc, data = make_dataset(
+        n_users, rng, args.active_ratio, args.conversations, args.scripts, args.script_chars
+    )
+    scale_dir = os.path.join(root, str(n_users))
+    os.makedirs(scale_dir)
+    users_path = os.path.join(scale_dir, "users.json")
+    conversations_path = os.path.join(scale_dir, "conversations.json")
+    atomic_write_json(users_path, users_doc)
+    atomic_write_json(conversations_path, data)
+    dataset = {
+        "scale": n_users,
+        "users_json_bytes": os.path.getsize(users_path),
+        "conversations_json_bytes": os.path.getsize(conversations_path),
+        "conversations": sum(len(user["conversations"]) for user in data.values()),
+        "scripts": sum(len(conv["scripts"]) for user in data.values() for conv in user["conversations"]),
+    }
+    print(f"Données: {dataset['users_json_bytes'] / 1e6:.1f} Mo d'utilisateurs, "
+          f"{dataset['conversations_json_bytes'] / 1e6:.1f} Mo de conversations "
+          f"({dataset['conversations']} conversations, {dataset['scripts']} scripts)")
+
+    # Cibles des opérations, relues par chaque worker
+    atomic_write_json(os.path.join(scale_dir, "targets.json"), {
+        "usernames": list(users_doc["users"]),
+        "active": list(data),
+        "conversations": [(u, conv["id"], conv["animal"]) for u, user in data.items() for conv in user["conversations"]],
+    })
+    del users_doc, data
+
+    for backend in args.user_backends:
+        run_worker(runner, args, "users", backend, n_users, scale_dir, [users_path], {"USER_BACKEND": backend})
+    for backend in args.conversation_backends:
+        run_worker(runner, args, "conversations", backend, n_users, scale_dir, [users_path, conversations_path],
+                   {"CONVERSATION_BACKEND": backend})
+
+    return dataset
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance, min_ms=0.1):
+    """Affiche les opérations plus lentes que la référence au-delà de `tolerance`; renvoie leur nombre.
+
+    Les opérations sous `min_ms` de p95 (bruit de mesure) ne sont pas comparées.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    key = lambda row: (row["scale"], row["store"], row["backend"], row["op"])
+    previous = {key(row): row for row in baseline["results"]}
+    regressions = 0
+    print(f"\n=== Comparaison avec {baseline_path} ({baseline['meta'].get('git_commit')}) ===")
+    for row in results:
+        before = previous.get(key(row))
+        if not before or not before.get("p95_ms") or not row.get("p95_ms"):
+            continue
+        if max(before["p95_ms"], row["p95_ms"]) < min_ms:
+            continue
+        ratio = row["p95_ms"] / before["p95_ms"]
+        if ratio > 1 + tolerance:
+            regressions += 1
+            print(f"  ⚠️ {row['scale']} {row['store']} {row['backend']} {row['op']}: "
+                  f"p95 {before['p95_ms']:.2f} → {row['p95_ms']:.2f} ms (x{ratio:.2f})")
+    if not regressions:
+        print("  Aucune régression")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks des backends de stockage")
+    parser.add_argument("--scales", default="1000,10000,100000", help="nombres d'utilisateurs, séparés par des virgules")
+    parser.add_argument("--user-backends", default=",".join(USER_BACKENDS))
+    parser.add_argument("--conversation-backends", default=",".join(CONVERSATION_BACKENDS))
+    parser.add_argument("--ops", type=int, default=200, help="opérations mesurées par type au plus")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="durée max par type d'opération")
+    parser.add_argument("--active-ratio", type=float, default=0.3, help="part des utilisateurs ayant des conversations")
+    parser.add_argument("--conversations", type=int, default=3, help="conversations moyennes par utilisateur actif")
+    parser.add_argument("--scripts", type=int, default=3, help="scripts moyens par conversation")
+    parser.add_argument("--script-chars", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="résultats précédents à comparer (p95)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="ralentissement toléré avant signalement")
+    parser.add_argument("--min-ms", type=float, default=0.1, help="p95 sous lequel la comparaison est ignorée")
+    parser.add_argument("--keep", action="store_true", help="conserver les fichiers générés")
+    # Usage interne: un processus de mesure par backend (voir run_worker)
+    parser.add_argument("--worker", choices=("users", "conversations"), help=argparse.SUPPRESS)
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--targets", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        return worker(args)
+    args.user_backends = [b for b in args.user_backends.split(",") if b]
+    args.conversation_backends = [b for b in args.conversation_backends.split(",") if b]
+    for backend in args.user_backends:
+        if backend not in USER_BACKENDS:
+            parser.error(f"backend utilisateurs inconnu: {backend}")
+    for backend in args.conversation_backends:
+        if backend not in CONVERSATION_BACKENDS:
+            parser.error(f"backend de conversations inconnu: {backend}")
+
+    runner = Runner(args.ops, args.max_seconds)
+    root = tempfile.mkdtemp(prefix="bench-")
+    started_at = datetime.now().isoformat()
+    try:
+        datasets = [run_scale(runner, args, int(scale), root) for scale in args.scales.split(",") if scale]
+    finally:
+        if args.keep:
+            print(f"\nFichiers conservés dans {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started_at": started_at,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        },
+        "datasets": datasets,
+        "results": runner.results,
+    }
+    atomic_write_json(args.output, report)
+    print(f"\nRésultats écrits dans {args.output}")
+
+    if args.baseline:
+        return 1 if compare(runner.results, args.baseline, args.tolerance, args.min_ms) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
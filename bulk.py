@@ -0,0 +1,312 @@
+"""Génération en masse de scripts et de hooks pour une liste d'animaux.
+
+Écrit directement dans le store de conversations d'un utilisateur, avec les
+mêmes SCRIPT_PROMPT / HOOK_PROMPT que l'application. La progression est
+sauvegardée après chaque résultat: relancer la même commande reprend là où
+elle s'était arrêtée.
+
+    python bulk.py animaux.txt --user alice --scripts 2 --hooks --backend streaming
+    python bulk.py --user alice --backend batch          # animaux de ANIMALS_LIST
+    python bulk.py animaux.txt --user test --backend fake # hors ligne
+
+Avec les backends fichiers (json, sharded, journal), l'application doit être
+arrêtée: un seul processus peut y écrire et bulk.py refuse de démarrer sinon.
+Avec CONVERSATION_BACKEND=sqlite, les deux peuvent tourner en même temps.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from prompts import HOOK_MAX_TOKENS, MODEL, SCRIPT_MAX_TOKENS, TEMPERATURE, HookContextBuilder, PromptTemplate
+from storage import StoreLockedError, animal_key, atomic_write_json, open_conversation_store
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python < 3.11: paquet toml, installé avec Streamlit
+    tomllib = None
+    import toml
+
+CONVERSATION_TIME = 7 * 24 * 60 * 60
+
+
+def load_secrets(path):
+    """Secrets Streamlit (secrets.toml), surchargés par les variables d'environnement du même nom"""
+    secrets = {}
+    if os.path.exists(path):
+        if tomllib is not None:
+            with open(path, "rb") as f:
+                secrets = tomllib.load(f)
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                secrets = toml.load(f)
+    for key in ("ANTHROPIC_API_KEY", "SCRIPT_PROMPT", "HOOK_PROMPT", "ANIMALS_LIST", "CONVERSATION_BACKEND"):
+        if os.environ.get(key):
+            secrets[key] = os.environ[key]
+    return secrets
+
+
+def parse_animals(value):
+    """Tableau TOML, liste JSON ou un animal par ligne (mêmes formats que ANIMALS_LIST)"""
+    if isinstance(value, list):
+        animals = value
+    else:
+        try:
+            animals = json.loads(value)
+        except json.JSONDecodeError:
+            animals = [line.strip() for line in value.split("\n") if line.strip()]
+    return [animal.strip().title() for animal in animals if animal.strip()]
+
+
+def request_id(kind, animal, n=0, user="", prompt=""):
+    """custom_id stable (compatible Batches API) d'une génération.
+
+    L'utilisateur cible et le prompt en font partie: une autre cible ou un
+    prompt modifié ne reprend pas les générations déjà faites.
+    """
+    key = "\0".join((user, prompt, animal_key(animal)))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return f"{kind}-{digest}-{n}"
+
+
+def message_params(request):
+    return {
+        "model": MODEL,
+        "max_tokens": request["max_tokens"],
+        "temperature": TEMPERATURE,
+        "messages": [{"role": "user", "content": request["content"]}],
+    }
+
+
+class StreamingBackend:
+    """Appels Messages en streaming, `concurrency` requêtes en vol au plus"""
+
+    def __init__(self, client, concurrency=4):
+        self.client = client
+        self.concurrency = concurrency
+
+    def _generate(self, request):
+        with self.client.messages.stream(**message_params(request)) as stream:
+            return "".join(stream.text_stream)
+
+    def run(self, requests, progress):
+        """Itère sur (requête, texte ou None, erreur ou None) au fil des résultats"""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self._generate, request): request for request in requests}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, str(e)
+
+
+class BatchBackend:
+    """Message Batches API: un lot par phase, repris après interruption via son id"""
+
+    def __init__(self, client, poll_interval=30):
+        self.client = client
+        self.poll_interval = poll_interval
+
+    def run(self, requests, progress):
+        if not requests:
+            return
+        by_id = {request["id"]: request for request in requests}
+        # Un lot par phase et par utilisateur cible
+        phase = f"{requests[0]['kind']}:{requests[0]['user']}"
+        batch_id = progress.batch(phase)
+        if batch_id is None:
+            batch = self.client.messages.batches.create(requests=[
+                {"custom_id": request["id"], "params": message_params(request)} for request in requests
+            ])
+            batch_id = batch.id
+            progress.set_batch(phase, batch_id)
+            print(f"Lot {batch_id} créé ({len(requests)} requêtes)")
+
+        while True:
+            batch = self.client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                break
+            counts = batch.request_counts
+            print(f"Lot {batch_id}: {counts.processing} en cours, {counts.succeeded} terminées")
+            time.sleep(self.poll_interval)
+
+        for entry in self.client.messages.batches.results(batch_id):
+            request = by_id.get(entry.custom_id)
+            if request is None:
+                continue
+            if entry.result.type == "succeeded":
+                text = "".join(block.text for block in entry.result.message.content if block.type == "text")
+                yield request, text, None
+            else:
+                yield request, None, entry.result.type
+        progress.set_batch(phase, None)
+
+
+class FakeBackend:
+    """Backend local sans réseau: texte déterministe, pour les tests et les essais"""
+
+    def __init__(self, concurrency=4, delay=0.0):
+        self.concurrency = concurrency
+        self.delay = delay
+
+    def _generate(self, request):
+        if self.delay:
+            time.sleep(self.delay)
+        return f"[fake] {request['kind']} {request['animal']} #{request['n'] + 1}"
+
+    def run(self, requests, progress):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for request, text in zip(requests, executor.map(self._generate, requests)):
+                yield request, text, None
+
+
+class Progress:
+    """Fichier de progression: ids terminés et lots Batches en cours"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.data = {"done": {}, "batches": {}}
+
+    def _save(self):
+        atomic_write_json(self.path, self.data)
+
+    def is_done(self, request_id):
+        return request_id in self.data["done"]
+
+    def mark_done(self, request):
+        with self._lock:
+            self.data["done"][request["id"]] = {"user": request["user"], "animal": request["animal"], "at": time.time()}
+            self._save()
+
+    def batch(self, phase):
+        return self.data["batches"].get(phase)
+
+    def set_batch(self, phase, batch_id):
+        with self._lock:
+            if batch_id is None:
+                self.data["batches"].pop(phase, None)
+            else:
+                self.data["batches"][phase] = batch_id
+            self._save()
+
+
+def run_phase(backend, requests, progress, write):
+    """Exécute les requêtes pas encore faites; renvoie (succès, échecs)"""
+    pending = [request for request in requests if not progress.is_done(request["id"])]
+    if len(pending) < len(requests):
+        print(f"{len(requests) - len(pending)} {requests[0]['kind']} déjà faits, reprise")
+    ok = failed = 0
+    for request, text, error in backend.run(pending, progress):
+        if text and write(request, text):
+            progress.mark_done(request)
+            ok += 1
+            print(f"✅ {request['kind']} {request['animal']} ({len(text)} caractères)")
+        else:
+            failed += 1
+            print(f"❌ {request['kind']} {request['animal']}: {error or 'enregistrement impossible'}")
+    return ok, failed
+
+
+def make_backend(args, secrets):
+    if args.backend == "fake":
+        return FakeBackend(args.concurrency, delay=args.fake_delay)
+
+    import anthropic
+
+    client = anthropic.Anthropic(api_key=secrets["ANTHROPIC_API_KEY"])
+    if args.backend == "batch":
+        return BatchBackend(client, poll_interval=args.poll_interval)
+    return StreamingBackend(client, args.concurrency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Génération en masse de scripts / hooks")
+    parser.add_argument("animals", nargs="?", help="fichier d'animaux (JSON ou un par ligne); défaut: ANIMALS_LIST")
+    parser.add_argument("--user", required=True, help="utilisateur qui reçoit les conversations")
+    parser.add_argument("--scripts", type=int, default=1, help="scripts par animal (0 pour hooks seulement)")
+    parser.add_argument("--hooks", action="store_true", help="générer aussi les hooks de chaque animal")
+    parser.add_argument("--backend", choices=["streaming", "batch", "fake"], default="streaming")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--progress", default="bulk_progress.json")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"))
+    parser.add_argument("--hook-budget", type=int, default=12000, help="budget de tokens d'entrée des hooks")
+    parser.add_argument("--poll-interval", type=float, default=30)
+    parser.add_argument("--fake-delay", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    secrets = load_secrets(args.secrets)
+    if args.animals:
+        with open(args.animals, "r", encoding="utf-8") as f:
+            animals = parse_animals(f.read())
+    else:
+        animals = parse_animals(secrets.get("ANIMALS_LIST", "") or "[]")
+    if not animals:
+        parser.error("aucun animal à traiter")
+    if args.backend != "fake" and not secrets.get("ANTHROPIC_API_KEY"):
+        parser.error("ANTHROPIC_API_KEY manquante")
+
+    script_template = PromptTemplate(secrets.get("SCRIPT_PROMPT", ""), "{{ANIMAL}}", "animal")
+    hook_context = HookContextBuilder(
+        PromptTemplate(secrets.get("HOOK_PROMPT", ""), "{{SCRIPT}}", "scripts"), budget=args.hook_budget
+    )
+    if args.scripts and script_template.warnings and args.backend != "fake":
+        parser.error(f"SCRIPT_PROMPT: {script_template.warnings[0]}")
+
+    try:
+        store = open_conversation_store(secrets.get("CONVERSATION_BACKEND", "json"), CONVERSATION_TIME)
+    except StoreLockedError as e:
+        parser.error(f"{e}: arrêtez l'application, ou passez au backend sqlite")
+    progress = Progress(args.progress)
+    backend = make_backend(args, secrets)
+    failures = 0
+
+    if args.scripts:
+        requests = [
+            {
+                "id": request_id("script", animal, n, args.user, script_template.template),
+                "kind": "script", "user": args.user, "animal": animal, "n": n,
+                "content": script_template.content(animal), "max_tokens": SCRIPT_MAX_TOKENS,
+            }
+            for animal in animals for n in range(args.scripts)
+        ]
+        ok, failed = run_phase(
+            backend, requests, progress,
+            lambda request, text: store.add_script(args.user, request["animal"], text)
+        )
+        failures += failed
+        print(f"Scripts: {ok} générés, {failed} échecs")
+
+    if args.hooks:
+        requests = []
+        for animal in animals:
+            conversation = store.find_conversation(args.user, animal)
+            if conversation and conversation["scripts"]:
+                content, sources, report = hook_context.build(conversation)
+                requests.append({
+                    "id": request_id("hooks", animal, 0, args.user, hook_context.template.template),
+                    "kind": "hooks", "user": args.user, "animal": animal, "n": 0,
+                    "conversation_id": conversation["id"], "sources": sources,
+                    "content": content, "max_tokens": HOOK_MAX_TOKENS,
+                })
+        ok, failed = run_phase(
+            backend, requests, progress,
+            lambda request, text: store.add_hook(args.user, request["conversation_id"], text, request["sources"])
+        ) if requests else (0, 0)
+        failures += failed
+        print(f"Hooks: {ok} générés, {failed} échecs")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from metrics import percentile
+from storage import atomic_write_json
+
+FINISHED_STATUSES = ("done", "failed", "interrupted")
+
+
+class GenerationJob:
+    """Une génération exécutée hors du run Streamlit, avec son buffer de texte partiel"""
+
+    def __init__(self, username, kind, label, target=None, job_id=None, group=None):
+        self.id = job_id or str(uuid.uuid4())
+        self.username = username
+        self.kind = kind
+        self.label = label
+        self.target = target
+        self.group = group
+        self.status = "queued"
+        self.error = None
+        self.claimed = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.parts = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._persist_lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def append(self, text):
+        with self._lock:
+            self.parts.append(text)
+            self._changed.notify_all()
+
+    def set_status(self, status, error=None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            if status == "running":
+                self.started_at = time.time()
+            elif status in FINISHED_STATUSES:
+                self.finished_at = time.time()
+            self._changed.notify_all()
+
+    def read(self, start=0):
+        """(morceaux reçus depuis `start`, job terminé) lus de façon cohérente"""
+        with self._lock:
+            return self.parts[start:], self.finished
+
+    def wait(self, start=0, timeout=None):
+        """Comme read(), après avoir attendu (au plus `timeout` s) un morceau au-delà de `start` ou la fin du job"""
+        with self._lock:
+            self._changed.wait_for(lambda: len(self.parts) > start or self.finished, timeout)
+            return self.parts[start:], self.finished
+
+    def text(self):
+        # Pas de compaction en place: les lecteurs suivent leur position dans `parts`
+        with self._lock:
+            return "".join(self.parts)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "kind": self.kind,
+            "label": self.label,
+            "target": self.target,
+            "group": self.group,
+            "status": self.status,
+            "error": self.error,
+            "claimed": self.claimed,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "text": self.text(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["username"], data["kind"], data.get("label"), data.get("target"), job_id=data["id"], group=data.get("group"))
+        job.status = data.get("status", "interrupted")
+        job.error = data.get("error")
+        job.claimed = data.get("claimed", False)
+        job.created_at = data.get("created_at", job.created_at)
+        job.started_at = data.get("started_at")
+        job.finished_at = data.get("finished_at")
+        if data.get("text"):
+            job.parts = [data["text"]]
+        return job
+
+
+class FairQueue:
+    """File d'attente équitable entre utilisateurs (round-robin).
+
+    Chaque utilisateur a sa propre file; `get` sert à tour de rôle le premier
+    élément de chaque utilisateur, si bien qu'une rafale d'un seul compte
+    n'attend que derrière ses propres demandes.
+    """
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+
+    def put(self, username, item):
+        with self._cond:
+            if username not in self._queues:
+                self._queues[username] = deque()
+            self._queues[username].append(item)
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            username, queue = next(iter(self._queues.items()))
+            item = queue.popleft()
+            if queue:
+                self._queues.move_to_end(username)
+            else:
+                del self._queues[username]
+            return item
+
+    def position(self, username, item):
+        """Nombre d'éléments servis avant `item` (0 = prochain), ou None s'il n'est plus en file"""
+        with self._cond:
+            users = list(self._queues)
+            if username not in self._queues or item not in self._queues[username]:
+                return None
+            rank = users.index(username)
+            index = self._queues[username].index(item)
+            ahead = index
+            for other_rank, other in enumerate(users):
+                if other != username:
+                    turns = index + 1 if other_rank < rank else index
+                    ahead += min(len(self._queues[other]), turns)
+            return ahead
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+class JobRunner:
+    """Exécute les générations dans un pool de threads du process.
+
+    Au plus `max_workers` appels à l'API sont en vol en même temps, toutes
+    sessions confondues; les jobs en attente sont servis par une FairQueue.
+
+    Un job survit aux reruns et aux déconnexions de la session qui l'a lancé:
+    le texte partiel est gardé en mémoire et écrit dans `directory` au plus
+    toutes les `persist_interval` secondes, l'enregistrement (`commit`) est
+    fait par le worker à la fin du flux. Au redémarrage, les jobs qui étaient
+    en cours sont rechargés avec le statut `interrupted` et leur texte partiel.
+    """
+
+    def __init__(self, directory="jobs", max_workers=4, persist_interval=1.0, retention=24 * 60 * 60):
+        self.directory = directory
+        self.persist_interval = persist_interval
+        self.retention = retention
+        self.queue = FairQueue()
+        self._jobs = {}
+        self._tasks = {}
+        self._waits = deque(maxlen=200)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f"generation-{i}", daemon=True).start()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _load(self):
+        cutoff = time.time() - self.retention
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    job = GenerationJob.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            if job.created_at < cutoff:
+                self._discard(job.id)
+                continue
+            if not job.finished:
+                job.status = "interrupted"
+                job.error = "Génération interrompue par un redémarrage du serveur"
+                job.finished_at = time.time()
+                self._persist(job)
+            self._jobs[job.id] = job
+
+    def _persist(self, job):
+        with job._persist_lock:
+            atomic_write_json(self._path(job.id), job.to_dict())
+
+    def _discard(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [job for job in self._jobs.values() if job.finished and job.finished_at < cutoff]
+        for job in expired:
+            del self._jobs[job.id]
+            self._discard(job.id)
+
+    def submit(self, username, kind, label, produce, commit=None, release=None, target=None, group=None):
+        """Lance `produce()` (itérateur de morceaux de texte) dans le pool.
+
+        `commit(text)` enregistre le résultat et renvoie False en cas d'échec;
+        `release()` est toujours appelé à la fin, succès ou non. Les jobs d'un
+        même `group` (variantes) sont affichés ensemble.
+        """
+        job = GenerationJob(username, kind, label, target, group=group)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            self._tasks[job.id] = (produce, commit, release)
+        self._persist(job)
+        self.queue.put(username, job.id)
+        return job
+
+    def _worker(self):
+        while True:
+            job_id = self.queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                produce, commit, release = self._tasks.pop(job_id)
+            try:
+                self._run(job, produce, commit, release)
+            except OSError:
+                # Une écriture du job impossible ne doit pas arrêter le worker
+                pass
+
+    def _run(self, job, produce, commit, release):
+        job.set_status("running")
+        with self._lock:
+            self._waits.append(job.started_at - job.created_at)
+        last_persist = time.monotonic()
+        try:
+            for text in produce():
+                if not text:
+                    continue
+                job.append(text)
+                if time.monotonic() - last_persist >= self.persist_interval:
+                    self._persist(job)
+                    last_persist = time.monotonic()
+            text = job.text()
+            if not text:
+                job.set_status("failed", "Réponse vide")
+            elif commit is not None and not commit(text):
+                job.set_status("failed", "Erreur lors de l'enregistrement")
+            else:
+                job.set_status("done")
+        except Exception as e:
+            job.set_status("failed", str(e))
+        finally:
+            if release is not None:
+                release()
+            self._persist(job)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, username, kind=None, target=None):
+        """Jobs d'un utilisateur, du plus ancien au plus récent"""
+        with self._lock:
+            jobs = [
+                job for job in self._jobs.values()
+                if job.username == username
+                and (kind is None or job.kind == kind)
+                and (target is None or job.target == target)
+            ]
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    def claim(self, job):
+        """Marque un job terminé comme pris en compte par l'interface"""
+        job.claimed = True
+        self._persist(job)
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def queue_position(self, job):
+        """Position (1 = prochain servi) d'un job en attente, None s'il a démarré"""
+        ahead = self.queue.position(job.username, job.id)
+        return None if ahead is None else ahead + 1
+
+    def queue_stats(self):
+        """Profondeur de la file, jobs en cours et temps d'attente (sur les 200 derniers départs)"""
+        now = time.time()
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job.status == "queued"]
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+            waits = sorted(self._waits)
+        return {
+            "queued": len(queued),
+            "running": running,
+            "oldest_wait": max((now - job.created_at for job in queued), default=0.0),
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": percentile(waits, 95) or 0.0,
+        }
@@ -0,0 +1,606 @@
+"""Test de charge: N sessions concurrentes contre un faux serveur Anthropic local.
+
+L'application tourne dans un vrai serveur `streamlit run` (processus séparé,
+comme en production) et chaque utilisateur virtuel est un client WebSocket
+qui parle le protocole du navigateur: connexion, génération d'un script,
+acceptation, génération des hooks puis modification du script dans le
+Laboratoire. Les appels Claude partent vers un serveur SSE local
+(ANTHROPIC_BASE_URL) qui émet les tokens à un débit réglable, avec des
+erreurs 529 et des coupures en cours de flux optionnelles.
+
+À la fin, le serveur est arrêté (les compteurs en attente sont écrits à la
+sortie) puis les stores sont relus depuis le disque et comparés à ce que
+chaque utilisateur a réellement fait: crédits, compteurs, scripts, hooks et
+modifications manquants sont comptés comme mises à jour perdues.
+
+    python loadtest.py --users 20 --iterations 2 --token-rate 80
+    python loadtest.py --users 50 --conversation-backend sqlite --user-backend sqlite
+    python loadtest.py --serve-only --port 8765   # faux serveur seul
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Exception_pb2 import Exception as ExceptionProto
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from websockets.sync.client import connect
+
+from accounts import open_user_store
+from metrics import percentile
+from prompts import MODEL
+from storage import atomic_write_json, open_conversation_store
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+PASSWORD = "loadtest"
+ANIMALS = ["Chat", "Chien", "Lion", "Tigre", "Panda", "Koala", "Loup", "Renard", "Aigle", "Dauphin"]
+WORDS = "voici le fait le plus incroyable sur cet animal que personne ne connaît encore".split()
+STEPS = ("login", "generate_script", "accept", "generate_hooks", "lab_edit")
+
+
+class FakeAnthropicServer:
+    """Serveur local compatible avec /v1/messages en streaming (SSE)"""
+
+    def __init__(self, port=0, token_rate=50.0, tokens=300, error_rate=0.0, drop_rate=0.0, seed=None):
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "errors": 0, "drops": 0, "completed": 0, "active": 0, "peak": 0}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-anthropic", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.stats[key] += delta
+            self.stats["peak"] = max(self.stats["peak"], self.stats["active"])
+
+    def _roll(self, rate):
+        with self._lock:
+            return self.rng.random() < rate
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _event(self, name, data):
+                self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                server._count("requests")
+                if server._roll(server.error_rate):
+                    server._count("errors")
+                    payload = json.dumps({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+                    self.send_response(529)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload.encode("utf-8"))
+                    return
+
+                prompt_chars = sum(
+                    len(block.get("text", "")) if isinstance(block, dict) else len(block)
+                    for message in body.get("messages", [])
+                    for block in (message["content"] if isinstance(message["content"], list) else [message["content"]])
+                )
+                tokens = min(server.tokens, body.get("max_tokens", server.tokens))
+                drop_at = server.rng.randint(1, tokens) if server._roll(server.drop_rate) else None
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                server._count("active")
+                try:
+                    self._event("message_start", {"type": "message_start", "message": {
+                        "id": f"msg_fake_{time.monotonic_ns()}", "type": "message", "role": "assistant",
+                        "model": body.get("model", MODEL), "content": [], "stop_reason": None, "stop_sequence": None,
+                        "usage": {"input_tokens": prompt_chars // 4, "output_tokens": 1,
+                                  "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0},
+                    }})
+                    self._event("content_block_start", {
+                        "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}
+                    })
+                    for n in range(tokens):
+                        if n == drop_at:
+                            # Coupure brutale en cours de flux: le client doit reprendre
+                            server._count("drops")
+                            return
+                        self._event("content_block_delta", {
+                            "type": "content_block_delta", "index": 0,
+                            "delta": {"type": "text_delta", "text": WORDS[n % len(WORDS)] + " "}
+                        })
+                        if server.token_rate:
+                            time.sleep(1 / server.token_rate)
+                    self._event("content_block_stop", {"type": "content_block_stop", "index": 0})
+                    self._event("message_delta", {
+                        "type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                        "usage": {"output_tokens": tokens}
+                    })
+                    self._event("message_stop", {"type": "message_stop"})
+                    server._count("completed")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    server._count("active", -1)
+
+        return Handler
+
+
+class StreamlitServer:
+    """`streamlit run app.py` dans un processus séparé, avec ses secrets dans `workdir`"""
+
+    def __init__(self, workdir, secrets, port=0, startup_timeout=60):
+        self.workdir = workdir
+        self.port = port or free_port()
+        self.startup_timeout = startup_timeout
+        self.process = None
+        os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+        with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+            for key, value in secrets.items():
+                # Une chaîne JSON est aussi une chaîne TOML valide
+                f.write(f"{key} = {json.dumps(value, ensure_ascii=False)}\n")
+        self.log_path = os.path.join(workdir, "streamlit.log")
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.port}/_stcore/stream"
+
+    def start(self):
+        with open(self.log_path, "w", encoding="utf-8") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "streamlit", "run", APP_PATH,
+                 "--server.headless", "true", "--server.address", "127.0.0.1", "--server.port", str(self.port),
+                 "--server.fileWatcherType", "none", "--browser.gatherUsageStats", "false"],
+                cwd=self.workdir, stdout=log, stderr=subprocess.STDOUT,
+            )
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_stcore/health", timeout=1) as response:
+                    if response.status == 200:
+                        return self
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"le serveur Streamlit n'a pas démarré, voir {self.log_path}")
+
+    def stop(self, timeout=30):
+        """Arrêt propre (SIGTERM): renvoie False s'il a fallu tuer le processus"""
+        if self.process is None or self.process.poll() is not None:
+            return True
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+            return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class StepError(Exception):
+    pass
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+        "p99": percentile(values, 99), "max": values[-1],
+    }
+
+
+def widget_key(element_id):
+    """Clé utilisateur d'un widget, lue à la fin de son id (« $$ID-<hash>-<clé> »)"""
+    parts = element_id.split("-", 2)
+    if element_id.startswith("$$ID-") and len(parts) == 3 and parts[2] != "None":
+        return parts[2]
+    return None
+
+
+class AppClient:
+    """Session Streamlit pilotée comme le fait le navigateur: BackMsg / ForwardMsg sur le WebSocket.
+
+    Après chaque action, on attend la fin du run (y compris ceux enchaînés par
+    st.rerun) et on garde l'arbre d'éléments du dernier run complet.
+    """
+
+    def __init__(self, ws, timeout):
+        self.ws = ws
+        self.timeout = timeout
+        self.widgets = {}
+        self.nodes = {}
+
+    def rerun(self, *triggers):
+        message = BackMsg()
+        message.rerun_script.SetInParent()
+        message.rerun_script.widget_states.widgets.extend(self.widgets.values())
+        message.rerun_script.widget_states.widgets.extend(triggers)
+        self.ws.send(message.SerializeToString())
+        self._wait_idle()
+
+    def _wait_idle(self):
+        deadline = time.monotonic() + self.timeout
+        nodes = {}
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise StepError("délai dépassé: fin du run")
+            try:
+                data = self.ws.recv(timeout=remaining)
+            except TimeoutError:
+                continue
+            message = ForwardMsg()
+            message.ParseFromString(data)
+            kind = message.WhichOneof("type")
+            if kind == "new_session":
+                nodes = {}
+            elif kind == "delta":
+                delta = message.delta
+                if delta.WhichOneof("type") == "new_element":
+                    element = delta.new_element
+                    node = ("element", element.WhichOneof("type"), getattr(element, element.WhichOneof("type")))
+                elif delta.WhichOneof("type") == "add_block":
+                    block = delta.add_block
+                    node = ("block", block.WhichOneof("type"), getattr(block, block.WhichOneof("type")))
+                else:
+                    continue
+                nodes[tuple(message.metadata.delta_path)] = node
+            elif kind == "script_finished":
+                if message.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise StepError("erreur de compilation de l'application")
+                if message.script_finished == ForwardMsg.FINISHED_SUCCESSFULLY:
+                    break
+        self.nodes = nodes
+        elements = [proto for kind, proto in self._elements()]
+        for proto in elements:
+            if isinstance(proto, ExceptionProto):
+                raise StepError(proto.message)
+        # Comme le navigateur: l'état des widgets disparus n'est plus envoyé
+        ids = {getattr(proto, "id", "") for proto in elements}
+        self.widgets = {id: state for id, state in self.widgets.items() if id in ids}
+
+    def _elements(self, within=None):
+        for path, (node, kind, proto) in sorted(self.nodes.items()):
+            if node == "element" and (within is None or path[:len(within)] == within):
+                yield kind, proto
+
+    def blocks(self, kind):
+        return [(path, proto) for path, (node, block_kind, proto) in sorted(self.nodes.items())
+                if node == "block" and block_kind == kind]
+
+    def widget(self, kind, key=None, prefix=None, label=None, within=None):
+        for element_kind, proto in self._elements(within):
+            if element_kind != kind:
+                continue
+            element_key = widget_key(proto.id)
+            if key is not None and element_key == key:
+                return proto
+            if prefix is not None and element_key and element_key.startswith(prefix):
+                return proto
+            if label is not None and proto.label.startswith(label):
+                return proto
+        return None
+
+    def has_widget(self, kind, key):
+        return self.widget(kind, key=key) is not None
+
+    def input(self, proto, value):
+        self.widgets[proto.id] = WidgetState(id=proto.id, string_value=value)
+
+    def click(self, proto):
+        self.rerun(WidgetState(id=proto.id, trigger_value=True))
+
+
+class VirtualUser:
+    """Un client WebSocket qui rejoue le parcours complet `iterations` fois"""
+
+    def __init__(self, username, url, iterations, timeout, think, rng):
+        self.username = username
+        self.url = url
+        self.iterations = iterations
+        self.timeout = timeout
+        self.think = think
+        self.rng = rng
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = []
+        # Ce que l'utilisateur a réellement obtenu, pour détecter les mises à jour perdues
+        self.expected = {"scripts_generated": 0, "hooks_generated": 0, "conversations": {}}
+
+    def _button(self, app, key=None, prefix=None, label=None, within=None):
+        button = app.widget("button", key=key, prefix=prefix, label=label, within=within)
+        if button is None:
+            raise StepError(f"bouton introuvable: {key or prefix or label}")
+        return button
+
+    def _wait_for(self, app, predicate, what):
+        deadline = time.monotonic() + self.timeout
+        while not predicate(app):
+            if time.monotonic() > deadline:
+                raise StepError(f"délai dépassé: {what}")
+            time.sleep(0.25)
+            app.rerun()
+
+    def _step(self, name, action):
+        started = time.monotonic()
+        action()
+        self.latencies[name].append(time.monotonic() - started)
+        if self.think:
+            time.sleep(self.rng.uniform(0, self.think))
+
+    def run(self):
+        iteration = 0
+        timed_login = True
+        while iteration < self.iterations:
+            step = "login"
+            try:
+                with connect(self.url, subprotocols=["streamlit"], max_size=None, open_timeout=self.timeout) as ws:
+                    app = AppClient(ws, self.timeout)
+                    app.rerun()
+                    if timed_login:
+                        self._step(step, lambda: self._login(app))
+                        timed_login = False
+                    else:
+                        self._login(app)
+                    while iteration < self.iterations:
+                        animal = ANIMALS[iteration % len(ANIMALS)]
+                        step = "generate_script"
+                        self._step(step, lambda: self._generate_script(app, animal))
+                        step = "accept"
+                        conversation = self.expected["conversations"].setdefault(animal, {"scripts": 0, "hooks": 0, "edit": None})
+                        self._step(step, lambda: self._accept(app, conversation))
+                        step = "generate_hooks"
+                        self._step(step, lambda: self._generate_hooks(app, animal, conversation))
+                        step = "lab_edit"
+                        self._step(step, lambda: self._lab_edit(app, animal, conversation, iteration))
+                        iteration += 1
+            except Exception as e:
+                self.errors.append({"step": step, "error": repr(e)})
+                if step == "login":
+                    return
+                # Session dans un état inconnu: on repart d'une session neuve
+                iteration += 1
+
+    def _login(self, app):
+        app.input(app.widget("text_input", key="login_username"), self.username)
+        app.input(app.widget("text_input", key="login_password"), PASSWORD)
+        app.click(self._button(app, label="🔐 Se connecter"))
+        if app.has_widget("text_input", "login_username"):
+            raise StepError("connexion refusée")
+
+    def _generate_script(self, app, animal):
+        app.input(app.widget("text_input", key="animal_input"), animal)
+        app.click(self._button(app, label="Générer Script"))
+        self._wait_for(app, lambda app: app.has_widget("button", "accept_script_btn"), "script")
+        self.expected["scripts_generated"] += 1
+
+    def _accept(self, app, conversation):
+        app.click(self._button(app, key="accept_script_btn"))
+        if app.has_widget("button", "accept_script_btn"):
+            raise StepError("script non accepté")
+        conversation["scripts"] += 1
+
+    def _hooks_expanders(self, app):
+        return sum(1 for _, expander in app.blocks("expandable") if expander.label.startswith("Hooks "))
+
+    def _generate_hooks(self, app, animal, conversation):
+        before = self._hooks_expanders(app)
+        conversation_id = self._conversation_id(app, animal)
+        app.click(self._button(app, key=f"hooks_{conversation_id}"))
+        self._wait_for(app, lambda app: self._hooks_expanders(app) > before, "hooks")
+        conversation["hooks"] += 1
+        self.expected["hooks_generated"] += 1
+
+    def _conversation_id(self, app, animal):
+        """Id de la conversation de `animal`, lu sur le bouton hooks de son onglet"""
+        tabs = [path for path, tab in app.blocks("tab") if tab.label.startswith(f"{animal} (")]
+        button = app.widget("button", prefix="hooks_", within=tabs[0] if tabs else None)
+        if button is None:
+            raise StepError(f"conversation introuvable: {animal}")
+        return widget_key(button.id)[len("hooks_"):]
+
+    def _lab_edit(self, app, animal, conversation, iteration):
+        conversation_id = self._conversation_id(app, animal)
+        app.click(self._button(app, key=f"manage_{conversation_id}"))
+        text = f"[loadtest {self.username} #{iteration}] " + " ".join(self.rng.choice(WORDS) for _ in range(30))
+        text_area = app.widget("text_area", key=f"script_content_{conversation_id}_0")
+        if text_area is None:
+            raise StepError(f"script introuvable: {animal}")
+        app.input(text_area, text)
+        app.click(self._button(app, key=f"save_script_{conversation_id}_0"))
+        conversation["edit"] = text
+        app.click(self._button(app, label="← Retour"))
+
+
+def check_stores(args, users, initial_credits):
+    """Compare les stores relus depuis le disque aux actions réussies de chaque utilisateur"""
+    user_store = open_user_store(args.user_backend)
+    conversation_store = open_conversation_store(args.conversation_backend, 7 * 24 * 60 * 60)
+    lost = []
+    for user in users:
+        expected = user.expected
+        stored = user_store.get_user(user.username) or {}
+        checks = [
+            ("credits", initial_credits - 2 * expected["scripts_generated"] - expected["hooks_generated"],
+             stored.get("credits")),
+            ("total_scripts", expected["scripts_generated"], stored.get("total_scripts")),
+            ("total_hooks", expected["hooks_generated"], stored.get("total_hooks")),
+        ]
+        for animal, conversation in expected["conversations"].items():
+            stored_conversation = conversation_store.find_conversation(user.username, animal) or {"scripts": [], "hooks": []}
+            checks.append((f"{animal}.scripts", conversation["scripts"], len(stored_conversation["scripts"])))
+            checks.append((f"{animal}.hooks", conversation["hooks"], len(stored_conversation["hooks"])))
+            if conversation["edit"] is not None:
+                content = stored_conversation["scripts"][0]["content"] if stored_conversation["scripts"] else None
+                checks.append((f"{animal}.edit", True, content == conversation["edit"]))
+        for field, want, got in checks:
+            if want != got:
+                lost.append({"user": user.username, "field": field, "expected": want, "stored": got})
+    return lost
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test de charge de l'application (streamlit run + faux serveur Anthropic)")
+    parser.add_argument("--users", type=int, default=10, help="sessions concurrentes")
+    parser.add_argument("--iterations", type=int, default=1, help="parcours complets par utilisateur")
+    parser.add_argument("--ramp", type=float, default=2.0, help="secondes pour démarrer toutes les sessions")
+    parser.add_argument("--think", type=float, default=0.0, help="pause aléatoire max entre deux étapes")
+    parser.add_argument("--timeout", type=float, default=180, help="délai max d'une étape")
+    parser.add_argument("--credits", type=int, default=100)
+    parser.add_argument("--token-rate", type=float, default=50, help="tokens/s émis par le faux serveur (0: sans pause)")
+    parser.add_argument("--tokens", type=int, default=300, help="tokens par réponse")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part des requêtes en erreur 529")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="part des flux coupés en cours de route")
+    parser.add_argument("--user-backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--conversation-backend", choices=["json", "sharded", "journal", "sqlite"], default="json")
+    parser.add_argument("--workers", type=int, default=4, help="GENERATION_WORKERS de l'application")
+    parser.add_argument("--workdir", help="répertoire de travail (défaut: temporaire, supprimé à la fin)")
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--port", type=int, default=0, help="port du faux serveur Anthropic")
+    parser.add_argument("--app-port", type=int, default=0, help="port de l'application (défaut: libre)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--serve-only", action="store_true", help="lancer uniquement le faux serveur")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+
+    server = FakeAnthropicServer(
+        args.port, args.token_rate, args.tokens, args.error_rate, args.drop_rate, seed=args.seed
+    ).start()
+    if args.serve_only:
+        print(f"Faux serveur Anthropic sur {server.url} (Ctrl+C pour arrêter)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    usernames = [f"load{i:04d}" for i in range(args.users)]
+    user_store = open_user_store(args.user_backend)
+    user_store.set_global_password(PASSWORD)
+    for username in usernames:
+        user_store.add_user(username, args.credits)
+
+    secrets = {
+        "ANTHROPIC_API_KEY": "fake-key",
+        "ANTHROPIC_BASE_URL": server.url,
+        "SCRIPT_PROMPT": "Écris un script viral sur {{ANIMAL}}",
+        "HOOK_PROMPT": "Écris des hooks pour ces scripts:\n{{SCRIPT}}",
+        "ANIMALS_LIST": json.dumps(ANIMALS),
+        "ADMIN_USERNAME": "admin",
+        "ADMIN_PASSWORD": "admin-loadtest",
+        "USER_BACKEND": args.user_backend,
+        "CONVERSATION_BACKEND": args.conversation_backend,
+        "GENERATION_WORKERS": args.workers,
+        "ACTIVITY_FLUSH_SECONDS": 1,
+        "STREAM_RETRY_BASE_DELAY": 0.2,
+        "LOG_LEVEL": "WARNING",
+    }
+
+    app_server = StreamlitServer(workdir, secrets, args.app_port).start()
+    rng = random.Random(args.seed)
+    users = [
+        VirtualUser(username, app_server.url, args.iterations, args.timeout, args.think, random.Random(rng.random()))
+        for username in usernames
+    ]
+    print(f"{args.users} sessions x {args.iterations} parcours, application sur le port {app_server.port}, "
+          f"faux serveur {server.url}, données dans {workdir}")
+    started = time.monotonic()
+    threads = []
+    for i, user in enumerate(users):
+        thread = threading.Thread(target=user.run, name=user.username, daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.users > 1:
+            time.sleep(args.ramp / (args.users - 1))
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    # Les stores ne sont relus qu'une fois le serveur sorti: compteurs en attente écrits, verrous rendus
+    if not app_server.stop():
+        print(f"⚠️ Serveur Streamlit tué après expiration du délai d'arrêt, voir {app_server.log_path}")
+    lost = check_stores(args, users, args.credits)
+    server.stop()
+
+    latencies = {step: percentiles([v for user in users for v in user.latencies[step]]) for step in STEPS}
+    completed = sum(len(user.latencies["lab_edit"]) for user in users)
+    errors = [dict(error, user=user.username) for user in users for error in user.errors]
+    report = {
+        "args": {key: value for key, value in vars(args).items() if key != "serve_only"},
+        "elapsed_s": elapsed,
+        "journeys_completed": completed,
+        "journeys_per_min": completed / elapsed * 60 if elapsed else 0.0,
+        "steps_per_sec": sum(len(user.latencies[step]) for user in users for step in STEPS) / elapsed if elapsed else 0.0,
+        "errors": len(errors),
+        "lost_updates": len(lost),
+        "latency_s": latencies,
+        "server": dict(server.stats),
+        "error_details": errors,
+        "lost_update_details": lost,
+    }
+    atomic_write_json(output, report)
+
+    print(f"\nDurée {elapsed:.1f}s · {completed} parcours complets ({report['journeys_per_min']:.1f}/min) · "
+          f"{report['steps_per_sec']:.2f} étapes/s")
+    for step in STEPS:
+        stats = latencies[step]
+        if stats["count"]:
+            print(f"  {step:<16} {stats['count']:>5}  p50 {stats['p50']:.2f}s  p95 {stats['p95']:.2f}s  "
+                  f"p99 {stats['p99']:.2f}s  max {stats['max']:.2f}s")
+    print(f"Erreurs: {len(errors)} · Mises à jour perdues: {len(lost)} · "
+          f"Serveur: {server.stats['requests']} requêtes, pic de {server.stats['peak']} flux simultanés")
+    for item in lost[:10]:
+        print(f"  ⚠️ {item['user']} {item['field']}: attendu {item['expected']}, stocké {item['stored']}")
+    print(f"Résultats écrits dans {output}")
+
+    if not args.workdir:
+        os.chdir(os.path.dirname(output))
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if errors or lost else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
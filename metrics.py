@@ -0,0 +1,173 @@
+import logging
+import math
+import sqlite3
+import time
+from datetime import datetime
+
+from storage import SqliteDatabase
+
+METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at REAL NOT NULL,
+    day TEXT NOT NULL,
+    task TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    username TEXT,
+    animal TEXT,
+    model TEXT,
+    max_tokens INTEGER,
+    attempts INTEGER,
+    ttft REAL,
+    total_time REAL,
+    gap_p50 REAL,
+    gap_p95 REAL,
+    gap_max REAL,
+    chunks INTEGER,
+    output_tokens INTEGER,
+    tokens_per_sec REAL,
+    input_tokens INTEGER,
+    cache_read_tokens INTEGER,
+    cache_write_tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_generations_day_task ON generations(day, task);
+"""
+
+logger = logging.getLogger(__name__)
+
+METRIC_COLUMNS = ("ttft", "total_time", "tokens_per_sec", "gap_p95", "gap_max")
+
+
+TASKS = {"scripts": "script", "hooks": "hook", "pool": "pool"}
+
+
+def percentile(sorted_values, p):
+    """Percentile au rang le plus proche (valeurs déjà triées), None si vide.
+
+    Seule formule de percentile du projet: admin, profiler, file de jobs,
+    bench et test de charge l'utilisent tous.
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+
+class GenerationTrace:
+    """Mesures d'une génération, alimentées au fil du flux"""
+
+    def __init__(self, kind, username, animal, model, max_tokens, clock=time.monotonic):
+        self.kind = kind
+        self.username = username
+        self.animal = animal
+        self.model = model
+        self.max_tokens = max_tokens
+        self.clock = clock
+        self.started = clock()
+        self.first_token = None
+        self.last_chunk = None
+        self.gaps = []
+        self.chunks = 0
+        self.attempts = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def attempt(self):
+        self.attempts += 1
+
+    def chunk(self):
+        now = self.clock()
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self.gaps.append(now - self.last_chunk)
+        self.last_chunk = now
+        self.chunks += 1
+
+    def usage(self, usage):
+        """Ajoute l'usage du message final d'une tentative"""
+        self.input_tokens += getattr(usage, "input_tokens", 0) or 0
+        self.output_tokens += getattr(usage, "output_tokens", 0) or 0
+        self.cache_read_tokens += getattr(usage, "cache_read_input_tokens", 0) or 0
+        self.cache_write_tokens += getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+    def finish(self, status):
+        """Ligne de la table `generations`"""
+        total = self.clock() - self.started
+        gaps = sorted(self.gaps)
+        streaming = (self.last_chunk - self.first_token) if self.first_token is not None else 0
+        return {
+            "at": time.time(),
+            "day": datetime.now().strftime("%Y-%m-%d"),
+            # La pré-génération de la réserve a sa propre tâche: elle ne fausse pas les scripts des utilisateurs
+            "task": TASKS.get(self.kind, "script"),
+            "kind": self.kind,
+            "status": status,
+            "username": self.username,
+            "animal": self.animal,
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "attempts": self.attempts,
+            "ttft": (self.first_token - self.started) if self.first_token is not None else None,
+            "total_time": total,
+            "gap_p50": percentile(gaps, 50),
+            "gap_p95": percentile(gaps, 95),
+            "gap_max": gaps[-1] if gaps else None,
+            "chunks": self.chunks,
+            "output_tokens": self.output_tokens,
+            "tokens_per_sec": self.output_tokens / streaming if streaming > 0 and self.output_tokens else None,
+            "input_tokens": self.input_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+        }
+
+
+class GenerationMetrics:
+    """Table SQLite locale des mesures de génération (une ligne par génération)"""
+
+    def __init__(self, path="metrics.db", retention_days=90):
+        self.db = SqliteDatabase.shared(path)
+        self.db.executescript(METRICS_SCHEMA)
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM generations WHERE at < ?", (time.time() - retention_days * 86400,))
+
+    def record(self, row):
+        """Ajoute une ligne; une erreur d'écriture est journalisée sans interrompre la génération"""
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(f"INSERT INTO generations ({columns}) VALUES ({placeholders})", tuple(row.values()))
+        except sqlite3.Error as e:
+            logger.warning("Mesure de génération non enregistrée: %s", e)
+
+    def daily_percentiles(self, metric, days=30):
+        """[{day, task, count, p50, p95, p99}] des générations réussies des `days` derniers jours"""
+        if metric not in METRIC_COLUMNS:
+            raise ValueError(f"Métrique inconnue: {metric}")
+        with self.db.lock:
+            rows = self.db.conn.execute(
+                f"SELECT day, task, {metric} AS value FROM generations "
+                f"WHERE at >= ? AND status = 'ok' AND {metric} IS NOT NULL ORDER BY day, task, value",
+                (time.time() - days * 86400,)
+            ).fetchall()
+        groups = {}
+        for row in rows:
+            groups.setdefault((row["day"], row["task"]), []).append(row["value"])
+        return [
+            {
+                "day": day, "task": task, "count": len(values),
+                "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            }
+            for (day, task), values in groups.items()
+        ]
+
+    def recent(self, limit=50):
+        with self.db.lock:
+            rows = self.db.conn.execute(
+                "SELECT * FROM generations ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
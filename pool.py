@@ -0,0 +1,201 @@
+import atexit
+import copy
+import json
+import threading
+import time
+
+from storage import animal_key, atomic_write_json
+
+POOL_USERNAME = "__pool__"
+
+
+class ScriptPool:
+    """Réserve de scripts pré-générés pour les animaux les plus demandés.
+
+    Chaque demande de script (servie ou non) alimente la popularité de
+    l'animal. Un thread de fond garde `size` scripts frais (plus jeunes que
+    `max_age`) pour les `top_n` animaux de `candidates` les plus demandés.
+    Les remplissages passent par le JobRunner sous l'utilisateur `__pool__`,
+    seulement quand aucune demande réelle n'attend, un à la fois. L'état
+    (stock, popularité, hits) est persisté dans `path` par le thread de fond,
+    jamais sur le chemin d'une demande: dès que le stock change, et au plus
+    toutes les `save_interval` secondes pour les seuls compteurs.
+    """
+
+    def __init__(self, runner, produce, candidates, path="script_pool.json", size=2, sizes=None,
+                 max_age=24 * 60 * 60, top_n=20, check_interval=60, save_interval=30):
+        self.runner = runner
+        self.produce = produce
+        self.candidates = {animal_key(animal): animal for animal in candidates}
+        self.path = path
+        self.size = size
+        self.sizes = {animal_key(animal): n for animal, n in (sizes or {}).items()}
+        self.max_age = max_age
+        self.top_n = top_n
+        self.check_interval = check_interval
+        self.save_interval = save_interval
+        self._animals, self._other_misses = self._load()
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # Compteurs modifiés depuis la dernière sauvegarde / stock modifié (sauvegarde au prochain réveil)
+        self._dirty = False
+        self._stock_changed = False
+        self._saved_at = time.time()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name="script-pool", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("animals", {}), data.get("other_misses", 0)
+        except (FileNotFoundError, ValueError):
+            return {}, 0
+
+    def _changed(self, stock=False):
+        # Appelé sous self._lock
+        self._dirty = True
+        self._stock_changed = self._stock_changed or stock
+
+    def flush(self):
+        """Écrit l'état s'il a changé depuis la dernière sauvegarde"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                state = copy.deepcopy({"animals": self._animals, "other_misses": self._other_misses})
+                self._dirty = self._stock_changed = False
+                self._saved_at = time.time()
+            try:
+                atomic_write_json(self.path, state)
+            except BaseException:
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _persist(self):
+        with self._lock:
+            due = self._stock_changed or (self._dirty and time.time() - self._saved_at >= self.save_interval)
+        if due:
+            self.flush()
+
+    def _entry(self, animal):
+        key = animal_key(animal)
+        if key not in self._animals:
+            self._animals[key] = {"animal": animal, "requests": 0, "hits": 0, "misses": 0, "scripts": []}
+        return self._animals[key]
+
+    def _fresh(self, entry, now):
+        entry["scripts"] = [s for s in entry["scripts"] if now - s["created_at"] < self.max_age]
+        return entry["scripts"]
+
+    def target_size(self, animal):
+        return self.sizes.get(animal_key(animal), self.size)
+
+    def take(self, animal):
+        """Script jamais servi pour `animal` (le plus ancien encore frais, {"content", "created_at"}), ou None"""
+        now = time.time()
+        with self._lock:
+            if animal_key(animal) not in self.candidates:
+                # Animal hors ANIMALS_LIST: jamais mis en réserve, compté comme raté
+                self._other_misses += 1
+                self._changed()
+                return None
+            entry = self._entry(animal)
+            entry["requests"] += 1
+            scripts = self._fresh(entry, now)
+            if scripts:
+                entry["hits"] += 1
+                script = scripts.pop(0)
+            else:
+                entry["misses"] += 1
+                script = None
+            self._changed(stock=script is not None)
+        self._wakeup.set()
+        return script
+
+    def put_back(self, animal, script):
+        """Remet en tête de réserve un script pris par `take` mais finalement pas servi"""
+        with self._lock:
+            entry = self._entry(animal)
+            entry["hits"] -= 1
+            entry["scripts"].insert(0, script)
+            self._changed(stock=True)
+        self._wakeup.set()
+
+    def _add(self, animal, text):
+        with self._lock:
+            self._entry(animal)["scripts"].append({"content": text, "created_at": time.time()})
+            self._changed(stock=True)
+            self._refilling.discard(animal_key(animal))
+        # Remplissage suivant tout de suite; après un échec on attend `check_interval`
+        self._wakeup.set()
+        return True
+
+    def popular(self):
+        """Animaux à tenir en réserve: les `top_n` candidats les plus demandés"""
+        with self._lock:
+            ranked = sorted(
+                (entry for key, entry in self._animals.items() if key in self.candidates),
+                key=lambda entry: entry["requests"], reverse=True
+            )
+            return [self.candidates[animal_key(entry["animal"])] for entry in ranked[:self.top_n]]
+
+    def _next_refill(self):
+        now = time.time()
+        for animal in self.popular():
+            key = animal_key(animal)
+            with self._lock:
+                if key in self._refilling:
+                    continue
+                if len(self._fresh(self._entry(animal), now)) < self.target_size(animal):
+                    self._refilling.add(key)
+                    return animal
+        return None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            try:
+                self._persist()
+            except OSError:
+                # Disque indisponible: l'état reste marqué modifié, nouvel essai au prochain réveil
+                pass
+            # Un seul remplissage à la fois, et jamais devant un utilisateur en attente
+            if self._refilling or self.runner.queue_stats()["queued"]:
+                continue
+            animal = self._next_refill()
+            if animal is not None:
+                self.runner.submit(
+                    POOL_USERNAME, "pool", animal,
+                    lambda animal=animal: self.produce(animal),
+                    commit=lambda text, animal=animal: self._add(animal, text),
+                    release=lambda animal=animal: self._refilled(animal)
+                )
+
+    def _refilled(self, animal):
+        with self._lock:
+            self._refilling.discard(animal_key(animal))
+
+    def stats(self):
+        """Hits, ratés et stock par animal, pour la console admin"""
+        now = time.time()
+        with self._lock:
+            rows = [
+                {
+                    "animal": entry["animal"],
+                    "requests": entry["requests"],
+                    "hits": entry["hits"],
+                    "misses": entry["misses"],
+                    "stock": len(self._fresh(entry, now)),
+                }
+                for entry in self._animals.values()
+            ]
+            other_misses = self._other_misses
+        rows.sort(key=lambda row: row["requests"], reverse=True)
+        hits = sum(row["hits"] for row in rows)
+        served = hits + other_misses + sum(row["misses"] for row in rows)
+        return {"hit_rate": hits / served if served else 0.0, "hits": hits, "served": served, "animals": rows}
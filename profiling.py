@@ -0,0 +1,150 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import percentile
+from storage import io_counters
+
+
+def _p95(values):
+    return percentile(sorted(values), 95) or 0.0
+
+
+class RerunProfiler:
+    """Chronométrage des reruns Streamlit: durée totale, fonctions de page et appels de stockage.
+
+    Un rerun ouvert par `rerun()` est propre au thread qui l'exécute (une
+    session = un thread de script). Les `span()` ouverts pendant ce rerun
+    cumulent appels, durée et octets lus / écrits par les stores JSON
+    (`storage.io_counters`; None pour les stores SQLite, qui n'y passent pas,
+    affiché « n/a »); hors rerun (workers de génération), ils ne coûtent
+    rien. Les `window` derniers reruns sont gardés en mémoire et, avec
+    `trace_path`, ajoutés au fil de l'eau à un fichier JSONL.
+    """
+
+    def __init__(self, window=50, trace_path=None):
+        self.reruns = deque(maxlen=window)
+        self.trace_path = trace_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def rerun(self, page):
+        record = {"at": time.time(), "page": page, "outcome": "ok", "duration": 0.0, "spans": {}}
+        self._local.current = record
+        started = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            # st.rerun() / st.stop() passent par des exceptions
+            record["outcome"] = type(e).__name__
+            raise
+        finally:
+            record["duration"] = time.perf_counter() - started
+            record["spans"] = list(record["spans"].values())
+            self._local.current = None
+            with self._lock:
+                self.reruns.append(record)
+                if self.trace_path:
+                    self._write([record], self.trace_path)
+
+    @contextmanager
+    def span(self, name, category, counts_io=True):
+        record = getattr(self._local, "current", None)
+        if record is None:
+            yield
+            return
+        read, written = io_counters()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            read_after, written_after = io_counters()
+            bytes_zero = 0 if counts_io else None
+            span = record["spans"].setdefault(
+                (category, name),
+                {"name": name, "category": category, "calls": 0, "duration": 0.0,
+                 "bytes_read": bytes_zero, "bytes_written": bytes_zero}
+            )
+            span["calls"] += 1
+            span["duration"] += duration
+            if span["bytes_read"] is not None:
+                span["bytes_read"] += read_after - read
+                span["bytes_written"] += written_after - written
+
+    def instrument(self, target, category):
+        return ProfiledProxy(target, self, category)
+
+    def summary(self):
+        """Durées des reruns et, par span, cumul moyen par rerun sur la fenêtre"""
+        with self._lock:
+            reruns = list(self.reruns)
+        spans = {}
+        for record in reruns:
+            for span in record["spans"]:
+                entry = spans.setdefault((span["category"], span["name"]), {
+                    "name": span["name"], "category": span["category"],
+                    "reruns": 0, "calls": 0, "durations": [], "bytes_read": 0, "bytes_written": 0
+                })
+                entry["reruns"] += 1
+                entry["calls"] += span["calls"]
+                entry["durations"].append(span["duration"])
+                for field in ("bytes_read", "bytes_written"):
+                    if entry[field] is not None:
+                        entry[field] = None if span[field] is None else entry[field] + span[field]
+
+        rows = []
+        for entry in spans.values():
+            durations = entry.pop("durations")
+            entry["avg"] = sum(durations) / len(durations)
+            entry["p95"] = _p95(durations)
+            entry["max"] = max(durations)
+            rows.append(entry)
+        rows.sort(key=lambda entry: entry["avg"] * entry["reruns"], reverse=True)
+
+        durations = [record["duration"] for record in reruns]
+        return {
+            "reruns": len(reruns),
+            "avg": sum(durations) / len(durations) if durations else 0.0,
+            "p95": _p95(durations),
+            "max": max(durations) if durations else 0.0,
+            "last": reruns[-1] if reruns else None,
+            "spans": rows,
+        }
+
+    def _write(self, records, path):
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def dump(self, path):
+        """Ajoute les reruns de la fenêtre à un fichier JSONL; renvoie leur nombre"""
+        with self._lock:
+            records = list(self.reruns)
+            self._write(records, path)
+        return len(records)
+
+
+class ProfiledProxy:
+    """Enveloppe un store: chaque appel de méthode publique devient un span du rerun en cours"""
+
+    def __init__(self, target, profiler, category):
+        self._target = target
+        self._profiler = profiler
+        self._category = category
+        self._counts_io = getattr(target, "counts_io", True)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        profiler, category, counts_io = self._profiler, self._category, self._counts_io
+
+        def call(*args, **kwargs):
+            with profiler.span(name, category, counts_io):
+                return attr(*args, **kwargs)
+
+        return call
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from storage import script_fingerprint
+
+logger = logging.getLogger(__name__)
+
+MODEL = "claude-sonnet-4-20250514"
+TEMPERATURE = 0.7
+SCRIPT_MAX_TOKENS = 6500
+HOOK_MAX_TOKENS = 2500
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+TRUNCATION_MARK = "\n[…script tronqué]"
+
+
+def combine_scripts(scripts, numbers=None):
+    """Texte injecté à la place de {{SCRIPT}} dans le prompt des hooks"""
+    numbers = numbers or range(1, len(scripts) + 1)
+    return "\n\n".join([
+        f"SCRIPT {number}:\n{script['content']}"
+        for number, script in zip(numbers, scripts)
+    ])
+
+
+def estimate_tokens(text):
+    """Estimation locale (≈ 4 caractères par token), sans appel réseau avant l'envoi"""
+    return (len(text) + 3) // 4
+
+
+class PromptTemplate:
+    """Template de prompt découpé pour le prompt caching d'Anthropic.
+
+    Tout ce qui précède la première occurrence du placeholder est statique:
+    il part dans un bloc `cache_control` identique d'un appel à l'autre. Le
+    reste (valeur + fin du template) forme un petit bloc variable. Si le
+    placeholder est au milieu du template, la fin statique n'est pas mise en
+    cache: `warnings` le signale, et avec `rewrite=True` le template est
+    réécrit pour renvoyer la valeur tout en bas du message, dans une balise
+    `<tag>`, afin que tout le texte statique soit caché.
+    """
+
+    def __init__(self, template, placeholder, tag, rewrite=False, max_static_suffix=500):
+        self.template = template
+        self.placeholder = placeholder
+        self.tag = tag
+        self.warnings = []
+        self.rewritten = False
+
+        if placeholder not in template:
+            self.prefix, self.suffix = template, ""
+            self.warnings.append(f"Le placeholder {placeholder} est absent du prompt")
+            return
+
+        prefix, _, suffix = template.partition(placeholder)
+        static_suffix = suffix.replace(placeholder, "")
+        if len(static_suffix.strip()) > max_static_suffix:
+            if rewrite:
+                self.prefix = f"{prefix}<{tag}/>{suffix.replace(placeholder, f'<{tag}/>')}\n\n"
+                self.suffix = None
+                self.rewritten = True
+            else:
+                self.prefix, self.suffix = prefix, suffix
+                self.warnings.append(
+                    f"{len(static_suffix)} caractères après {placeholder} ne sont pas mis en cache "
+                    f"(placer le placeholder en fin de prompt ou activer PROMPT_CACHE_REWRITE)"
+                )
+        else:
+            self.prefix, self.suffix = prefix, suffix
+
+    def content(self, value):
+        """Blocs de contenu du message utilisateur: préfixe caché puis partie variable"""
+        if self.rewritten:
+            variable = f"<{self.tag}>\n{value}\n</{self.tag}>"
+        else:
+            variable = f"{value}{self.suffix.replace(self.placeholder, value)}"
+
+        blocks = []
+        if self.prefix.strip():
+            blocks.append({"type": "text", "text": self.prefix, "cache_control": CACHE_CONTROL})
+        # L'API refuse les blocs de texte vides
+        if variable.strip() or not blocks:
+            blocks.append({"type": "text", "text": variable})
+        return blocks
+
+
+class HookContextBuilder:
+    """Choisit les scripts envoyés dans {{SCRIPT}} sous un budget de tokens d'entrée.
+
+    Avec `only_new`, les scripts déjà couverts par un hook (empreintes dans
+    `sources`) sont écartés, sauf s'il n'en reste aucun. Les scripts sont
+    ensuite pris du plus récent au plus ancien tant que le budget le permet;
+    le premier qui dépasse est tronqué s'il reste au moins `min_tokens`,
+    sinon il est écarté avec les plus anciens. Le plus récent est toujours
+    envoyé, tronqué à `min_tokens` au moins, même si le prompt seul dépasse
+    déjà le budget. Seuls les scripts envoyés en entier sont comptés dans les
+    empreintes renvoyées: un script tronqué reste « nouveau » pour `only_new`.
+    L'estimation et la décision sont journalisées.
+    """
+
+    def __init__(self, template, budget, only_new=False, min_tokens=200, count_tokens=estimate_tokens):
+        self.template = template
+        self.budget = budget
+        self.only_new = only_new
+        self.min_tokens = min_tokens
+        self.count_tokens = count_tokens
+
+    def build(self, conversation):
+        """(blocs de contenu, empreintes des scripts envoyés en entier, rapport)"""
+        if not conversation["scripts"]:
+            raise ValueError("Aucun script dans la conversation")
+        scripts = list(enumerate(conversation["scripts"], 1))
+        mode = "all"
+        if self.only_new:
+            covered = set()
+            for hook in conversation.get("hooks", []):
+                covered.update(hook.get("sources") or [])
+            new = [(n, s) for n, s in scripts if script_fingerprint(s["content"]) not in covered]
+            if new:
+                scripts, mode = new, "new"
+
+        static = self.template.prefix + (self.template.suffix or "")
+        remaining = self.budget - self.count_tokens(static)
+        selected = []
+        truncated = None
+        for number, script in reversed(scripts):
+            header = self.count_tokens(f"SCRIPT {number}:\n\n\n")
+            tokens = header + self.count_tokens(script["content"])
+            if tokens <= remaining:
+                selected.append((number, script))
+                remaining -= tokens
+                continue
+            if remaining - header >= self.min_tokens or not selected:
+                keep = max(0, max(remaining - header, self.min_tokens) * 4 - len(TRUNCATION_MARK))
+                selected.append((number, {"content": script["content"][:keep] + TRUNCATION_MARK}))
+                truncated = number
+            break
+        selected.reverse()
+
+        text = combine_scripts([s for _, s in selected], [n for n, _ in selected])
+        report = {
+            "mode": mode,
+            "scripts_total": len(conversation["scripts"]),
+            "scripts_candidates": len(scripts),
+            "scripts_sent": len(selected),
+            "truncated": truncated is not None,
+            "estimated_tokens": self.count_tokens(static) + self.count_tokens(text),
+            "budget": self.budget,
+        }
+        logger.info(
+            "Contexte hooks %s: %d/%d scripts (%s), ~%d tokens pour un budget de %d%s",
+            conversation.get("animal"), report["scripts_sent"], report["scripts_total"], mode,
+            report["estimated_tokens"], self.budget, f", script {truncated} tronqué" if truncated else ""
+        )
+        sources = [script_fingerprint(conversation["scripts"][n - 1]["content"]) for n, _ in selected if n != truncated]
+        return self.template.content(text), sources, report
+
+
+class CacheUsageLog:
+    """Usage de tokens (dont lecture/écriture du cache de prompt) des derniers appels"""
+
+    def __init__(self, size=500):
+        self.calls = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, kind, usage):
+        entry = {
+            "at": time.time(),
+            "kind": kind,
+            "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+            "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+            "cache_read_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+            "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        }
+        with self._lock:
+            self.calls.append(entry)
+        return entry
+
+    def summary(self):
+        with self._lock:
+            calls = list(self.calls)
+        cache_read = sum(call["cache_read_tokens"] for call in calls)
+        cache_write = sum(call["cache_write_tokens"] for call in calls)
+        uncached = sum(call["input_tokens"] for call in calls)
+        total_input = cache_read + cache_write + uncached
+        return {
+            "calls": len(calls),
+            "cache_read_tokens": cache_read,
+            "cache_write_tokens": cache_write,
+            "input_tokens": uncached,
+            "hit_ratio": cache_read / total_input if total_input else 0.0,
+        }
@@ -0,0 +1,1476 @@
+"""Backends de stockage des conversations (scripts et hooks par utilisateur).
+
+Toutes les implémentations exposent la même interface (`ConversationStore`) et
+renvoient les conversations sous la même forme que l'ancien conversations.json:
+{"id", "animal", "scripts": [{"content", "char_count"}], "hooks": [{"content"}], "created_at"}.
+Un hook peut en plus lister les empreintes des scripts dont il est issu ("sources").
+"""
+import copy
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: pas de verrou entre processus
+    fcntl = None
+
+
+class StoreLockedError(RuntimeError):
+    """Le store est déjà ouvert en écriture par un autre processus"""
+
+
+_process_locks = {}
+_process_locks_guard = threading.Lock()
+
+
+def hold_process_lock(path):
+    """Prend (sans attendre) un verrou exclusif entre processus sur `path`, gardé jusqu'à la fin du processus.
+
+    Renvoie False si un autre processus le détient; un processus qui le
+    détient déjà peut le redemander (rechargement des ressources Streamlit).
+    """
+    key = os.path.abspath(path)
+    with _process_locks_guard:
+        if key in _process_locks:
+            return True
+        f = open(key, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+        _process_locks[key] = f
+        return True
+
+
+def new_conversation(animal):
+    return {
+        "id": str(uuid.uuid4()),
+        "animal": animal,
+        "scripts": [],
+        "hooks": [],
+        "created_at": datetime.now().isoformat()
+    }
+
+
+def make_script(content):
+    return {"content": content, "char_count": len(content)}
+
+
+def make_hook(content, sources=None):
+    hook = {"content": content}
+    if sources is not None:
+        hook["sources"] = list(sources)
+    return hook
+
+
+def script_fingerprint(content):
+    """Empreinte courte d'un script, pour savoir quels scripts un hook a déjà couverts"""
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+
+
+_io = threading.local()
+
+
+def io_counters():
+    """(octets lus, octets écrits) dans les fichiers JSON des stores par le thread courant"""
+    return getattr(_io, "read", 0), getattr(_io, "written", 0)
+
+
+def count_io(read=0, written=0):
+    _io.read = getattr(_io, "read", 0) + read
+    _io.written = getattr(_io, "written", 0) + written
+
+
+def read_json(path):
+    """json.load d'un fichier, comptabilisé dans io_counters"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    count_io(read=len(raw))
+    return json.loads(raw)
+
+
+def atomic_write_text(path, text):
+    """Écrit dans un fichier temporaire puis le renomme: jamais de fichier à moitié écrit"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    raw = text.encode('utf-8')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp crée en 0600: conserver les droits du fichier remplacé
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        os.replace(tmp_path, path)
+        count_io(written=len(raw))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_json(path, data):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=2))
+
+
+def parse_timestamp(value):
+    """Convertit un created_at ISO en timestamp, None si illisible"""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def cleanup_conversations(data, ttl):
+    """Supprime les conversations plus vieilles que `ttl` secondes.
+
+    Ne modifie pas `data` (qui peut être un document partagé par le cache):
+    les utilisateurs nettoyés sont des copies. Un utilisateur sans conversation
+    expirée garde sa liste d'origine, ce qui conserve son `ConversationIndex`.
+    """
+    current_time = datetime.now()
+    cleaned_data = data.copy()
+
+    for username, user in data.items():
+        if "conversations" in user:
+            recent_conversations = []
+            for conv in user["conversations"]:
+                if "created_at" in conv:
+                    try:
+                        conv_time = datetime.fromisoformat(conv["created_at"])
+                        if (current_time - conv_time).total_seconds() < ttl:
+                            recent_conversations.append(conv)
+                    except:
+                        # Si erreur de parsing, garder la conversation
+                        recent_conversations.append(conv)
+                # Si pas de timestamp, supprimer (ancien format)
+
+            if len(recent_conversations) != len(user["conversations"]):
+                cleaned_data[username] = dict(user, conversations=recent_conversations)
+
+    return cleaned_data
+
+
+def animal_key(animal):
+    """Clé de recherche d'un animal, insensible à la casse"""
+    return animal.casefold()
+
+
+class ConversationIndex:
+    """Index secondaires par utilisateur: id -> conversation et animal -> conversation.
+
+    L'index d'un utilisateur est lié à l'objet liste de ses conversations: si
+    la liste est remplacée (relecture du fichier, nettoyage), il est reconstruit
+    au prochain accès. Les créations l'alimentent via `add`; toute suppression
+    en place doit appeler `forget`.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, username, conversations):
+        with self._lock:
+            entry = self._users.get(username)
+            if entry is None or entry[0] is not conversations:
+                by_id, by_animal = {}, {}
+                for conv in conversations:
+                    by_id[conv["id"]] = conv
+                    # Comme l'ancien parcours linéaire: la première conversation gagne
+                    by_animal.setdefault(animal_key(conv["animal"]), conv)
+                entry = (conversations, by_id, by_animal)
+                self._users[username] = entry
+            return entry
+
+    def get(self, username, conversations, conversation_id):
+        return self._entry(username, conversations)[1].get(conversation_id)
+
+    def find(self, username, conversations, animal):
+        return self._entry(username, conversations)[2].get(animal_key(animal))
+
+    def add(self, username, conversations, conv):
+        _, by_id, by_animal = self._entry(username, conversations)
+        with self._lock:
+            by_id[conv["id"]] = conv
+            by_animal.setdefault(animal_key(conv["animal"]), conv)
+
+    def forget(self, username):
+        with self._lock:
+            self._users.pop(username, None)
+
+
+class ConversationStore:
+    """Interface commune des backends.
+
+    L'implémentation par défaut travaille sur le document complet
+    ({username: {"conversations": [...]}}) via `load_all` / `_save_document`;
+    les backends plus fins surchargent `_mutate` ou les opérations elles-mêmes.
+    """
+
+    # Les lectures / écritures passent par io_counters (fichiers JSON)
+    counts_io = True
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Sans sweeper, chaque accès filtre les conversations expirées (comportement historique)
+        self.sweeper = None
+        self.cleanup_on_access = True
+        self.index = ConversationIndex()
+
+    def load_all(self):
+        raise NotImplementedError
+
+    def _save_document(self, data):
+        raise NotImplementedError
+
+    def replace_all(self, data):
+        self._save_document(data)
+        self._replaced()
+
+    def _cleaned(self, data):
+        return cleanup_conversations(data, self.ttl) if self.cleanup_on_access else data
+
+    def _created(self, username, conversations, conv):
+        if conversations is not None:
+            self.index.add(username, conversations, conv)
+        if self.sweeper is not None:
+            self.sweeper.schedule(username, conv["id"], conv.get("created_at"))
+
+    def _replaced(self):
+        if self.sweeper is not None:
+            self.sweeper.seed()
+
+    def _mutate(self, username, apply):
+        """Applique `apply(conversations) -> (changed, result)` et sauvegarde si changed.
+
+        `apply` travaille sur une copie de l'utilisateur: le document lu, qui peut
+        être partagé par un cache et par les lecteurs, n'est remplacé qu'une fois
+        la sauvegarde réussie.
+        """
+        data = dict(self.load_all())
+        user = copy.deepcopy(data.get(username)) or {"conversations": []}
+        changed, result = apply(user.setdefault("conversations", []))
+        if changed:
+            data[username] = user
+            self._save_document(data)
+        return result
+
+    def get_conversations(self, username):
+        return self.load_all().get(username, {}).get("conversations", [])
+
+    def get_conversation(self, username, conversation_id):
+        return self.index.get(username, self.get_conversations(username), conversation_id)
+
+    def find_conversation(self, username, animal):
+        return self.index.find(username, self.get_conversations(username), animal)
+
+    def get_or_create_conversation(self, username, animal):
+        def apply(conversations):
+            conv = self.index.find(username, conversations, animal)
+            if conv is not None:
+                return False, conv
+            conv = new_conversation(animal)
+            conversations.append(conv)
+            self._created(username, conversations, conv)
+            return True, conv
+        return self._mutate(username, apply)
+
+    def add_script(self, username, animal, content):
+        def apply(conversations):
+            conv = self.index.find(username, conversations, animal)
+            if conv is None:
+                conv = new_conversation(animal)
+                conversations.append(conv)
+                self._created(username, conversations, conv)
+            conv["scripts"].append(make_script(content))
+            return True, True
+        return self._mutate(username, apply)
+
+    def add_hook(self, username, conversation_id, content, sources=None):
+        def apply(conversations):
+            conv = self.index.get(username, conversations, conversation_id)
+            if conv is None:
+                return False, False
+            conv.setdefault("hooks", []).append(make_hook(content, sources))
+            return True, True
+        return self._mutate(username, apply)
+
+    def update_script(self, username, conversation_id, index, content):
+        def apply(conversations):
+            conv = self.index.get(username, conversations, conversation_id)
+            if conv is None or not 0 <= index < len(conv["scripts"]):
+                return False, False
+            conv["scripts"][index]["content"] = content
+            conv["scripts"][index]["char_count"] = len(content)
+            return True, True
+        return self._mutate(username, apply)
+
+    def update_hook(self, username, conversation_id, index, content):
+        def apply(conversations):
+            conv = self.index.get(username, conversations, conversation_id)
+            if conv is None or not 0 <= index < len(conv.get("hooks", [])):
+                return False, False
+            conv["hooks"][index]["content"] = content
+            return True, True
+        return self._mutate(username, apply)
+
+    def delete_script(self, username, conversation_id, index):
+        def apply(conversations):
+            conv = self.index.get(username, conversations, conversation_id)
+            if conv is None or not 0 <= index < len(conv["scripts"]):
+                return False, False
+            del conv["scripts"][index]
+            return True, True
+        return self._mutate(username, apply)
+
+    def delete_hook(self, username, conversation_id, index):
+        def apply(conversations):
+            conv = self.index.get(username, conversations, conversation_id)
+            if conv is None or not 0 <= index < len(conv.get("hooks", [])):
+                return False, False
+            del conv["hooks"][index]
+            return True, True
+        return self._mutate(username, apply)
+
+    def clear_user(self, username):
+        """Vide les conversations d'un utilisateur sans supprimer son entrée"""
+        data = dict(self.load_all())
+        if username in data:
+            data[username] = {"conversations": []}
+            self.index.forget(username)
+            self._save_document(data)
+
+    def delete_user(self, username):
+        data = dict(self.load_all())
+        if username in data:
+            del data[username]
+            self.index.forget(username)
+            self._save_document(data)
+
+    def cleanup_expired(self):
+        """Supprime définitivement les conversations expirées (passe complète)"""
+        self._save_document(cleanup_conversations(self.load_all(), self.ttl))
+
+    def request_cleanup(self):
+        """Nettoyage demandé par l'admin: délégué au sweeper s'il tourne"""
+        if self.sweeper is not None:
+            self.sweeper.trigger()
+        else:
+            self.cleanup_expired()
+
+    def expiry_entries(self):
+        """(username, conversation_id, created_at) de toutes les conversations stockées"""
+        for username, user in self.load_all().items():
+            for conv in user.get("conversations", []):
+                yield username, conv["id"], conv.get("created_at")
+
+    def remove_conversations(self, entries):
+        """Supprime les conversations (username, conversation_id) données, renvoie le nombre supprimé"""
+        targets = {}
+        for username, conversation_id in entries:
+            targets.setdefault(username, set()).add(conversation_id)
+        data = dict(self.load_all())
+        removed = 0
+        for username, ids in targets.items():
+            conversations = data.get(username, {}).get("conversations")
+            if not conversations:
+                continue
+            kept = [conv for conv in conversations if conv.get("id") not in ids]
+            removed += len(conversations) - len(kept)
+            data[username] = dict(data[username], conversations=kept)
+            self.index.forget(username)
+        if removed:
+            self._save_document(data)
+        return removed
+
+
+class ParsedFileCache:
+    """Documents JSON déjà parsés, invalidés par la signature (mtime, taille) du fichier.
+
+    Partagé par toutes les sessions du processus: tant que le fichier n'a pas
+    changé sur disque, une lecture coûte un `os.stat` au lieu d'un `json.load`.
+    Les documents renvoyés sont partagés et ne doivent pas être modifiés: les
+    stores modifient une copie et ne la remettent en cache qu'après l'écriture.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def signature(self, path):
+        """(mtime_ns, taille) du fichier, None s'il n'existe pas"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path):
+        """Document en cache, ou None s'il faut relire le fichier"""
+        signature = self.signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and signature is not None and entry[0] == signature:
+            return entry[1]
+        return None
+
+    def put(self, path, data, signature=None):
+        """Met `data` en cache pour `path`.
+
+        Pour un document lu sur disque, passer la `signature` relevée avant la
+        lecture: une écriture concurrente entre la lecture et le `put` laisse
+        alors une entrée périmée au lieu d'associer l'ancien contenu au nouveau
+        fichier.
+        """
+        if signature is None:
+            signature = self.signature(path)
+        with self._lock:
+            if signature is None:
+                self._entries.pop(path, None)
+            else:
+                self._entries[path] = (signature, data)
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+class JsonConversationStore(ConversationStore):
+    """Un seul fichier JSON réécrit intégralement à chaque modification"""
+
+    def __init__(self, path, ttl):
+        super().__init__(ttl)
+        self.path = path
+        # Incrémenté à chaque sauvegarde, utilisable comme clé de cache par l'UI
+        self.version = 0
+        self._cache = ParsedFileCache()
+        self._lock = threading.RLock()
+
+        # Initialiser le fichier de base de données s'il n'existe pas
+        if not os.path.exists(self.path):
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({}, f, ensure_ascii=False, indent=2)
+
+    def _read(self):
+        data = self._cache.get(self.path)
+        if data is not None:
+            return data
+        if os.path.exists(self.path):
+            signature = self._cache.signature(self.path)
+            try:
+                data = read_json(self.path)
+            except:
+                return {}
+            self._cache.put(self.path, data, signature)
+            return data
+        return {}
+
+    def load_all(self):
+        return self._cleaned(self._read())
+
+    def _save_document(self, data):
+        with self._lock:
+            try:
+                atomic_write_json(self.path, data)
+            except BaseException:
+                self._cache.invalidate(self.path)
+                raise
+            self._cache.put(self.path, data)
+            self.version += 1
+
+    def _mutate(self, username, apply):
+        with self._lock:
+            return super()._mutate(username, apply)
+
+    def remove_conversations(self, entries):
+        with self._lock:
+            return super().remove_conversations(entries)
+
+
+class ShardedJsonConversationStore(ConversationStore):
+    """Un fichier JSON par utilisateur (conversations/<username>.json).
+
+    Les lectures et écritures ne touchent que le fichier de l'utilisateur
+    concerné, et chaque écriture passe par un renommage atomique.
+    """
+
+    def __init__(self, directory, ttl, legacy_path=None):
+        super().__init__(ttl)
+        self.path = directory
+        self.version = 0
+        self._cache = ParsedFileCache()
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+        if not os.path.isdir(self.path):
+            self._migrate(legacy_path)
+
+    def _migrate(self, legacy_path):
+        """Découpage unique de l'ancien fichier global.
+
+        Les fichiers sont écrits dans un répertoire temporaire renommé à la fin:
+        un arrêt en cours de route ne laisse pas un répertoire à moitié rempli
+        qui passerait pour déjà migré.
+        """
+        data = {}
+        if legacy_path and os.path.exists(legacy_path):
+            try:
+                data = read_json(legacy_path)
+            except (OSError, ValueError):
+                pass
+        parent = os.path.dirname(os.path.abspath(self.path))
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-" + os.path.basename(self.path) + "-")
+        try:
+            os.chmod(tmp_dir, 0o755)
+            for username, shard in data.items():
+                atomic_write_json(self._shard_path(username, tmp_dir), shard)
+            os.rename(tmp_dir, self.path)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            # Un autre processus a pu terminer la migration entre-temps
+            if not os.path.isdir(self.path):
+                raise
+
+    def _shard_path(self, username, directory=None):
+        return os.path.join(directory or self.path, quote(username, safe="") + ".json")
+
+    def _lock_for(self, username):
+        with self._locks_guard:
+            return self._locks.setdefault(username, threading.RLock())
+
+    def _usernames(self):
+        return [
+            unquote(name[:-len(".json")])
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(".json") and not name.startswith(".tmp-")
+        ]
+
+    def _load_shard(self, username):
+        """Contenu du fichier tel qu'il est sur disque (partagé avec le cache)"""
+        path = self._shard_path(username)
+        shard = self._cache.get(path)
+        if shard is None:
+            signature = self._cache.signature(path)
+            try:
+                shard = read_json(path)
+            except (OSError, ValueError):
+                return None
+            self._cache.put(path, shard, signature)
+        return shard
+
+    def _read_shard(self, username):
+        shard = self._load_shard(username)
+        if shard is None:
+            return None
+        # Copie de surface: le filtrage à la lecture ne doit pas modifier l'entrée du cache
+        return self._cleaned({username: dict(shard)})[username]
+
+    def _write_shard(self, username, shard):
+        path = self._shard_path(username)
+        try:
+            atomic_write_json(path, shard)
+        except BaseException:
+            self._cache.invalidate(path)
+            raise
+        self._cache.put(path, shard)
+        self.version += 1
+
+    def _mutate(self, username, apply):
+        with self._lock_for(username):
+            # Copie: le cache ne voit la modification qu'une fois le fichier écrit
+            shard = copy.deepcopy(self._read_shard(username)) or {"conversations": []}
+            changed, result = apply(shard.setdefault("conversations", []))
+            if changed:
+                self._write_shard(username, shard)
+            return result
+
+    def load_all(self):
+        data = {}
+        for username in self._usernames():
+            shard = self._read_shard(username)
+            if shard is not None:
+                data[username] = shard
+        return data
+
+    def _save_document(self, data):
+        for username, shard in data.items():
+            with self._lock_for(username):
+                self._write_shard(username, shard)
+        for username in set(self._usernames()) - set(data):
+            self.delete_user(username)
+
+    def get_conversations(self, username):
+        shard = self._read_shard(username)
+        return shard.get("conversations", []) if shard else []
+
+    def clear_user(self, username):
+        with self._lock_for(username):
+            if os.path.exists(self._shard_path(username)):
+                self.index.forget(username)
+                self._write_shard(username, {"conversations": []})
+
+    def delete_user(self, username):
+        with self._lock_for(username):
+            self.index.forget(username)
+            try:
+                os.remove(self._shard_path(username))
+            except FileNotFoundError:
+                pass
+            self._cache.invalidate(self._shard_path(username))
+            self.version += 1
+
+    def cleanup_expired(self):
+        """Ne réécrit que les fichiers dont au moins une conversation a expiré"""
+        for username in self._usernames():
+            with self._lock_for(username):
+                shard = self._load_shard(username)
+                if shard is None:
+                    continue
+                conversations = shard.get("conversations", [])
+                kept = cleanup_conversations({username: {"conversations": conversations}}, self.ttl)[username]["conversations"]
+                if len(kept) != len(conversations):
+                    self.index.forget(username)
+                    self._write_shard(username, dict(shard, conversations=kept))
+
+    def remove_conversations(self, entries):
+        targets = {}
+        for username, conversation_id in entries:
+            targets.setdefault(username, set()).add(conversation_id)
+        removed = 0
+        for username, ids in targets.items():
+            def apply(conversations):
+                kept = [conv for conv in conversations if conv.get("id") not in ids]
+                count = len(conversations) - len(kept)
+                conversations[:] = kept
+                self.index.forget(username)
+                return count > 0, count
+            removed += self._mutate(username, apply)
+        return removed
+
+
+def _end_with_newline(path):
+    """Termine par un saut de ligne un journal dont la dernière ligne a été tronquée,
+    pour que l'enregistrement suivant ne s'y colle pas"""
+    try:
+        with open(path, 'rb+') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    except FileNotFoundError:
+        pass
+
+
+def _apply_record(data, record):
+    """Rejoue un enregistrement du journal sur le document en mémoire"""
+    op = record["op"]
+    username = record["user"]
+    if op == "delete_user":
+        data.pop(username, None)
+        return
+    conversations = data.setdefault(username, {"conversations": []}).setdefault("conversations", [])
+    if op == "clear_user":
+        del conversations[:]
+        return
+    if op == "create":
+        conversations.append(record["conversation"])
+        return
+    if op == "remove":
+        conversations[:] = [conv for conv in conversations if conv.get("id") != record["id"]]
+        return
+    conv = next((c for c in conversations if c["id"] == record["id"]), None)
+    if conv is None:
+        return
+    if op == "add_script":
+        conv["scripts"].append(make_script(record["content"]))
+    elif op == "add_hook":
+        conv.setdefault("hooks", []).append(make_hook(record["content"], record.get("sources")))
+    elif op == "update_script":
+        conv["scripts"][record["index"]]["content"] = record["content"]
+        conv["scripts"][record["index"]]["char_count"] = len(record["content"])
+    elif op == "update_hook":
+        conv["hooks"][record["index"]]["content"] = record["content"]
+    elif op == "delete_script":
+        del conv["scripts"][record["index"]]
+    elif op == "delete_hook":
+        del conv["hooks"][record["index"]]
+
+
+class JournalConversationStore(ConversationStore):
+    """Journal append-only (JSON lines) + snapshot compacté.
+
+    Chaque modification ajoute une ligne au journal au lieu de réécrire tout le
+    document; l'état en mémoire est reconstruit au démarrage par rejeu du journal
+    sur le dernier snapshot. Au-delà de `compact_bytes`, un thread de fond replie
+    le journal dans un nouveau snapshot. Prévu pour un seul processus Streamlit.
+    """
+
+    def __init__(self, snapshot_path, journal_path, ttl, compact_bytes=1024 * 1024, legacy_path=None):
+        super().__init__(ttl)
+        self.path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compacting = False
+        self._data = {}
+        self._seq = 0
+
+        snapshot_seq = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._data = snapshot.get("data", {})
+            snapshot_seq = self._seq = snapshot.get("seq", 0)
+        elif legacy_path and os.path.exists(legacy_path) and not os.path.exists(self.journal_path):
+            try:
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        # Un journal ".old" reste si une compaction a été interrompue
+        for path in (self.journal_path + ".old", self.journal_path):
+            self._replay(path, snapshot_seq)
+
+        self._journal = self._open_journal()
+        self._journal_size = os.path.getsize(self.journal_path)
+        if not os.path.exists(self.path) or os.path.exists(self.journal_path + ".old"):
+            self.compact()
+
+    def _replay(self, path, snapshot_seq):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Dernière ligne tronquée par un arrêt brutal
+                    continue
+                if record["seq"] <= snapshot_seq:
+                    continue
+                try:
+                    _apply_record(self._data, record)
+                except (KeyError, IndexError):
+                    pass
+                self._seq = max(self._seq, record["seq"])
+
+    def _open_journal(self):
+        """Ouvre le journal en ajout, après une éventuelle dernière ligne tronquée"""
+        _end_with_newline(self.journal_path)
+        return open(self.journal_path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        """Met le journal courant de côté (".old") pour la compaction.
+
+        Un ".old" laissé par une compaction dont le snapshot n'a pas été écrit
+        contient des enregistrements absents du snapshot sur disque: le journal
+        lui est ajouté au lieu de l'écraser.
+        """
+        old_path = self.journal_path + ".old"
+        self._journal.close()
+        if os.path.exists(old_path):
+            _end_with_newline(old_path)
+            with open(self.journal_path, 'rb') as src, open(old_path, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, old_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_size = 0
+
+    def _append(self, record):
+        self._seq += 1
+        record["seq"] = self._seq
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        written = len(line.encode('utf-8'))
+        self._journal_size += written
+        count_io(written=written)
+        if self._journal_size >= self.compact_bytes and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def _commit(self, record):
+        _apply_record(self._data, record)
+        if record["op"] in ("clear_user", "delete_user", "remove"):
+            self.index.forget(record["user"])
+        self._append(record)
+
+    def compact(self):
+        """Replie le journal dans un nouveau snapshot"""
+        with self._compact_lock:
+            with self._lock:
+                self._data = cleanup_conversations(self._data, self.ttl)
+                snapshot = json.dumps({"seq": self._seq, "data": self._data}, ensure_ascii=False)
+                self._rotate()
+            # L'écriture du snapshot se fait hors verrou: les écritures continuent dans le nouveau journal
+            try:
+                atomic_write_text(self.path, snapshot)
+                os.remove(self.journal_path + ".old")
+            finally:
+                self._compacting = False
+
+    def _user_conversations(self, username):
+        self._data = self._cleaned(self._data)
+        return self._data.get(username, {}).get("conversations", [])
+
+    def load_all(self):
+        with self._lock:
+            return copy.deepcopy(self._cleaned(self._data))
+
+    def _save_document(self, data):
+        with self._lock:
+            self._data = copy.deepcopy(data)
+        self.compact()
+
+    def get_conversations(self, username):
+        with self._lock:
+            return copy.deepcopy(self._user_conversations(username))
+
+    def get_conversation(self, username, conversation_id):
+        with self._lock:
+            return copy.deepcopy(self.index.get(username, self._user_conversations(username), conversation_id))
+
+    def find_conversation(self, username, animal):
+        with self._lock:
+            return copy.deepcopy(self.index.find(username, self._user_conversations(username), animal))
+
+    def _mutate(self, username, apply):
+        # Chaque opération est surchargée pour écrire son propre enregistrement
+        raise RuntimeError("Le journal enregistre chaque opération individuellement")
+
+    def get_or_create_conversation(self, username, animal):
+        with self._lock:
+            conversations = self._user_conversations(username)
+            conv = self.index.find(username, conversations, animal)
+            if conv is None:
+                conv = new_conversation(animal)
+                self._commit({"op": "create", "user": username, "conversation": conv})
+                self._created(username, self._user_conversations(username), conv)
+            return copy.deepcopy(conv)
+
+    def add_script(self, username, animal, content):
+        with self._lock:
+            conversations = self._user_conversations(username)
+            conv = self.index.find(username, conversations, animal)
+            if conv is None:
+                conv = new_conversation(animal)
+                self._commit({"op": "create", "user": username, "conversation": conv})
+                self._created(username, self._user_conversations(username), conv)
+            self._commit({"op": "add_script", "user": username, "id": conv["id"], "content": content})
+        return True
+
+    def add_hook(self, username, conversation_id, content, sources=None):
+        with self._lock:
+            if self.index.get(username, self._user_conversations(username), conversation_id) is None:
+                return False
+            record = {"op": "add_hook", "user": username, "id": conversation_id, "content": content}
+            if sources is not None:
+                record["sources"] = list(sources)
+            self._commit(record)
+        return True
+
+    def _edit_entry(self, op, key, username, conversation_id, index, content=None):
+        with self._lock:
+            conv = self.index.get(username, self._user_conversations(username), conversation_id)
+            if conv is None or not 0 <= index < len(conv.get(key, [])):
+                return False
+            record = {"op": op, "user": username, "id": conversation_id, "index": index}
+            if content is not None:
+                record["content"] = content
+            self._commit(record)
+        return True
+
+    def update_script(self, username, conversation_id, index, content):
+        return self._edit_entry("update_script", "scripts", username, conversation_id, index, content)
+
+    def update_hook(self, username, conversation_id, index, content):
+        return self._edit_entry("update_hook", "hooks", username, conversation_id, index, content)
+
+    def delete_script(self, username, conversation_id, index):
+        return self._edit_entry("delete_script", "scripts", username, conversation_id, index)
+
+    def delete_hook(self, username, conversation_id, index):
+        return self._edit_entry("delete_hook", "hooks", username, conversation_id, index)
+
+    def clear_user(self, username):
+        with self._lock:
+            if username in self._data:
+                self._commit({"op": "clear_user", "user": username})
+
+    def delete_user(self, username):
+        with self._lock:
+            if username in self._data:
+                self._commit({"op": "delete_user", "user": username})
+
+    def cleanup_expired(self):
+        with self._lock:
+            self._data = cleanup_conversations(self._data, self.ttl)
+        self.compact()
+
+    def remove_conversations(self, entries):
+        removed = 0
+        with self._lock:
+            for username, conversation_id in entries:
+                if self.index.get(username, self._user_conversations(username), conversation_id):
+                    self._commit({"op": "remove", "user": username, "id": conversation_id})
+                    removed += 1
+        return removed
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    animal TEXT NOT NULL,
+    animal_key TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    created_ts REAL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_animal ON conversations(username, animal_key);
+CREATE INDEX IF NOT EXISTS idx_conversations_created_ts ON conversations(created_ts);
+
+CREATE TABLE IF NOT EXISTS scripts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    char_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scripts_conversation ON scripts(conversation_id, id);
+
+CREATE TABLE IF NOT EXISTS hooks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    sources TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_hooks_conversation ON hooks(conversation_id, id);
+
+"""
+
+
+class SqliteDatabase:
+    """Connexion SQLite partagée par tous les stores d'un même fichier.
+
+    Un seul objet par fichier et par processus (`shared`), pour que les stores
+    utilisateurs et conversations puissent écrire dans la même transaction.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path):
+        key = os.path.abspath(path)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(path)
+            return cls._instances[key]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._after_commit = []
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE; une transaction imbriquée rejoint la transaction englobante"""
+        with self.lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self.conn
+                finally:
+                    self._depth -= 1
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._depth = 0
+                self._after_commit = []
+                self.conn.execute("ROLLBACK")
+                raise
+            self._depth = 0
+            callbacks, self._after_commit = self._after_commit, []
+            self.conn.execute("COMMIT")
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback):
+        """Appelle `callback` une fois la transaction en cours validée (jamais après un ROLLBACK)"""
+        with self.lock:
+            if self._depth:
+                self._after_commit.append(callback)
+                return
+        callback()
+
+    def executescript(self, script):
+        """Schéma ou migration: `executescript` commence par un COMMIT implicite,
+        il ne doit donc jamais tourner pendant la transaction d'un autre thread"""
+        with self.lock:
+            if self._depth:
+                raise RuntimeError("executescript dans une transaction ouverte")
+            self.conn.executescript(script)
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+class SqliteConversationStore(ConversationStore):
+    """Base SQLite embarquée: insertions et mises à jour ligne par ligne.
+
+    Les index (username, animal) et created_ts remplacent les parcours linéaires
+    et le nettoyage complet du fichier: l'expiration devient un DELETE indexé.
+    """
+
+    counts_io = False
+
+    def __init__(self, path, ttl):
+        super().__init__(ttl)
+        self.path = path
+        self.db = SqliteDatabase.shared(path)
+        self._lock = self.db.lock
+        self._conn = self.db.conn
+        self._transaction = self.db.transaction
+        self.db.executescript(SQLITE_SCHEMA)
+
+        # Bases créées avant l'ajout des sources de hooks
+        with self._lock:
+            columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(hooks)")]
+        if "sources" not in columns:
+            with self._transaction() as conn:
+                conn.execute("ALTER TABLE hooks ADD COLUMN sources TEXT")
+
+        # Les premières bases utilisaient lower() comme clé d'animal
+        if self.get_meta("animal_key") != "casefold":
+            with self._transaction() as conn:
+                rows = conn.execute("SELECT id, animal FROM conversations").fetchall()
+                conn.executemany(
+                    "UPDATE conversations SET animal_key = ? WHERE id = ?",
+                    [(animal_key(row["animal"]), row["id"]) for row in rows]
+                )
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('animal_key', 'casefold')")
+
+    def _cutoff(self):
+        return datetime.now().timestamp() - self.ttl
+
+    def _expire(self, conn):
+        if not self.cleanup_on_access:
+            # Le sweeper s'en charge, hors du chemin des requêtes
+            return 0
+        return self._delete_expired(conn)
+
+    def _delete_expired(self, conn):
+        return conn.execute(
+            "DELETE FROM conversations WHERE created_ts < ?", (self._cutoff(),)
+        ).rowcount
+
+    def _fetch(self, where, params):
+        """Reconstruit les conversations au format JSON pour une clause WHERE donnée"""
+        alive = "(c.created_ts IS NULL OR c.created_ts >= ?)"
+        params = tuple(params) + (self._cutoff(),)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT c.id, c.username, c.animal, c.created_at FROM conversations c "
+                f"WHERE {where} AND {alive} ORDER BY c.rowid", params
+            ).fetchall()
+            conversations = {}
+            for row in rows:
+                conversations[row["id"]] = (row["username"], {
+                    "id": row["id"],
+                    "animal": row["animal"],
+                    "scripts": [],
+                    "hooks": [],
+                    "created_at": row["created_at"]
+                })
+            if not conversations:
+                return []
+            for row in self._conn.execute(
+                f"SELECT s.conversation_id, s.content, s.char_count FROM scripts s "
+                f"JOIN conversations c ON c.id = s.conversation_id "
+                f"WHERE {where} AND {alive} ORDER BY s.id", params
+            ):
+                conversations[row["conversation_id"]][1]["scripts"].append(
+                    {"content": row["content"], "char_count": row["char_count"]}
+                )
+            for row in self._conn.execute(
+                f"SELECT h.conversation_id, h.content, h.sources FROM hooks h "
+                f"JOIN conversations c ON c.id = h.conversation_id "
+                f"WHERE {where} AND {alive} ORDER BY h.id", params
+            ):
+                conversations[row["conversation_id"]][1]["hooks"].append(
+                    make_hook(row["content"], json.loads(row["sources"]) if row["sources"] else None)
+                )
+        return list(conversations.values())
+
+    def _insert_conversation(self, conn, username, conv):
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations (id, username, animal, animal_key, created_at, created_ts) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (conv["id"], username, conv["animal"], animal_key(conv["animal"]),
+             conv["created_at"], parse_timestamp(conv["created_at"]))
+        )
+        conn.executemany(
+            "INSERT INTO scripts (conversation_id, content, char_count) VALUES (?, ?, ?)",
+            [(conv["id"], s["content"], s.get("char_count", len(s["content"]))) for s in conv.get("scripts", [])]
+        )
+        conn.executemany(
+            "INSERT INTO hooks (conversation_id, content, sources) VALUES (?, ?, ?)",
+            [
+                (conv["id"], h["content"], json.dumps(h["sources"]) if h.get("sources") is not None else None)
+                for h in conv.get("hooks", [])
+            ]
+        )
+
+    def _owned(self, conn, username, conversation_id):
+        return conn.execute(
+            "SELECT 1 FROM conversations WHERE id = ? AND username = ?",
+            (conversation_id, username)
+        ).fetchone() is not None
+
+    def _row_at(self, conn, table, conversation_id, index):
+        """Identifiant de la ligne à la position `index` (ordre d'insertion)"""
+        if index < 0:
+            return None
+        row = conn.execute(
+            f"SELECT id FROM {table} WHERE conversation_id = ? ORDER BY id LIMIT 1 OFFSET ?",
+            (conversation_id, index)
+        ).fetchone()
+        return row["id"] if row else None
+
+    def load_all(self):
+        data = {}
+        for username, conv in self._fetch("1 = 1", ()):
+            data.setdefault(username, {"conversations": []})["conversations"].append(conv)
+        return data
+
+    def _save_document(self, data):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM conversations")
+            self._import(conn, data)
+
+    def import_document(self, data):
+        """Ajoute le contenu d'un document au format conversations.json"""
+        with self._transaction() as conn:
+            self._import(conn, data)
+
+    def _import(self, conn, data):
+        for username, user_data in data.items():
+            for conv in user_data.get("conversations", []):
+                # Même règle que le nettoyage JSON: sans timestamp, on ignore
+                if "created_at" in conv:
+                    self._insert_conversation(conn, username, conv)
+
+    def get_conversations(self, username):
+        return [conv for _, conv in self._fetch("c.username = ?", (username,))]
+
+    def get_conversation(self, username, conversation_id):
+        found = self._fetch("c.username = ? AND c.id = ?", (username, conversation_id))
+        return found[0][1] if found else None
+
+    def find_conversation(self, username, animal):
+        found = self._fetch("c.username = ? AND c.animal_key = ?", (username, animal_key(animal)))
+        return found[0][1] if found else None
+
+    def _id_for_animal(self, conn, username, animal):
+        row = conn.execute(
+            "SELECT id FROM conversations WHERE username = ? AND animal_key = ? ORDER BY rowid LIMIT 1",
+            (username, animal_key(animal))
+        ).fetchone()
+        return row["id"] if row else None
+
+    def get_or_create_conversation(self, username, animal):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if self._id_for_animal(conn, username, animal) is None:
+                conv = new_conversation(animal)
+                self._insert_conversation(conn, username, conv)
+                self.db.after_commit(lambda: self._created(username, None, conv))
+        return self.find_conversation(username, animal)
+
+    def add_script(self, username, animal, content):
+        with self._transaction() as conn:
+            self._expire(conn)
+            conversation_id = self._id_for_animal(conn, username, animal)
+            if conversation_id is None:
+                conv = new_conversation(animal)
+                conv["scripts"].append(make_script(content))
+                self._insert_conversation(conn, username, conv)
+                self.db.after_commit(lambda: self._created(username, None, conv))
+            else:
+                conn.execute(
+                    "INSERT INTO scripts (conversation_id, content, char_count) VALUES (?, ?, ?)",
+                    (conversation_id, content, len(content))
+                )
+        return True
+
+    def add_hook(self, username, conversation_id, content, sources=None):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if not self._owned(conn, username, conversation_id):
+                return False
+            conn.execute(
+                "INSERT INTO hooks (conversation_id, content, sources) VALUES (?, ?, ?)",
+                (conversation_id, content, json.dumps(list(sources)) if sources is not None else None)
+            )
+        return True
+
+    def update_script(self, username, conversation_id, index, content):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if not self._owned(conn, username, conversation_id):
+                return False
+            row_id = self._row_at(conn, "scripts", conversation_id, index)
+            if row_id is None:
+                return False
+            conn.execute(
+                "UPDATE scripts SET content = ?, char_count = ? WHERE id = ?",
+                (content, len(content), row_id)
+            )
+        return True
+
+    def update_hook(self, username, conversation_id, index, content):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if not self._owned(conn, username, conversation_id):
+                return False
+            row_id = self._row_at(conn, "hooks", conversation_id, index)
+            if row_id is None:
+                return False
+            conn.execute("UPDATE hooks SET content = ? WHERE id = ?", (content, row_id))
+        return True
+
+    def delete_script(self, username, conversation_id, index):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if not self._owned(conn, username, conversation_id):
+                return False
+            row_id = self._row_at(conn, "scripts", conversation_id, index)
+            if row_id is None:
+                return False
+            conn.execute("DELETE FROM scripts WHERE id = ?", (row_id,))
+        return True
+
+    def delete_hook(self, username, conversation_id, index):
+        with self._transaction() as conn:
+            self._expire(conn)
+            if not self._owned(conn, username, conversation_id):
+                return False
+            row_id = self._row_at(conn, "hooks", conversation_id, index)
+            if row_id is None:
+                return False
+            conn.execute("DELETE FROM hooks WHERE id = ?", (row_id,))
+        return True
+
+    def clear_user(self, username):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM conversations WHERE username = ?", (username,))
+
+    def delete_user(self, username):
+        self.clear_user(username)
+
+    def cleanup_expired(self):
+        with self._transaction() as conn:
+            return self._delete_expired(conn)
+
+    def expiry_entries(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT username, id, created_at FROM conversations").fetchall()
+        return [(row["username"], row["id"], row["created_at"]) for row in rows]
+
+    def remove_conversations(self, entries):
+        with self._transaction() as conn:
+            return sum(
+                conn.execute(
+                    "DELETE FROM conversations WHERE username = ? AND id = ?", entry
+                ).rowcount
+                for entry in entries
+            )
+
+    def get_meta(self, key):
+        return self.db.get_meta(key)
+
+    def set_meta(self, key, value):
+        self.db.set_meta(key, value)
+
+
+class ExpirySweeper:
+    """Expiration des conversations en tâche de fond.
+
+    Garde un tas (min-heap) des échéances `created_at + ttl` et ne touche que
+    les conversations arrivées à échéance; les lectures et écritures des
+    sessions ne paient plus le nettoyage complet. `trigger()` force un passage
+    immédiat (bouton admin).
+    """
+
+    def __init__(self, store, max_sleep=300, reseed_interval=3600):
+        self.store = store
+        self.max_sleep = max_sleep
+        # Relecture périodique du store: conversations écrites par un autre processus (bulk.py sur SQLite)
+        self.reseed_interval = reseed_interval
+        self._seeded_at = 0.0
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.store.sweeper = self
+        self.store.cleanup_on_access = False
+        self.seed()
+        self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+        self._thread.start()
+        return self
+
+    def seed(self):
+        """Complète l'index des échéances depuis le contenu du store.
+
+        Fusionné avec le tas existant plutôt que de le remplacer: une
+        conversation planifiée pendant le parcours du store n'est pas perdue.
+        Une entrée dont la conversation n'existe plus ne coûte qu'une
+        suppression sans effet à son échéance.
+        """
+        entries = set()
+        for username, conversation_id, created_at in self.store.expiry_entries():
+            expires_at = self._expires_at(created_at)
+            if expires_at is not None:
+                entries.add((expires_at, username, conversation_id))
+        with self._lock:
+            heap = list(entries.union(self._heap))
+            heapq.heapify(heap)
+            self._heap = heap
+        self._seeded_at = time.time()
+        self._wake.set()
+
+    def _expires_at(self, created_at):
+        # Sans timestamp: ancien format, supprimé tout de suite; illisible: conservé
+        if created_at is None:
+            return 0
+        created_ts = parse_timestamp(created_at)
+        return None if created_ts is None else created_ts + self.store.ttl
+
+    def schedule(self, username, conversation_id, created_at):
+        expires_at = self._expires_at(created_at)
+        if expires_at is None:
+            return
+        with self._lock:
+            heapq.heappush(self._heap, (expires_at, username, conversation_id))
+            earliest = self._heap[0][2] == conversation_id
+        if earliest:
+            self._wake.set()
+
+    def trigger(self):
+        self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._heap)
+
+    def sweep(self, now=None):
+        """Supprime les conversations échues, renvoie le nombre supprimé"""
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, username, conversation_id = heapq.heappop(self._heap)
+                due.append((username, conversation_id))
+        return self.store.remove_conversations(due) if due else 0
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                if time.time() - self._seeded_at >= self.reseed_interval:
+                    self.seed()
+                self.sweep()
+            except Exception:
+                # Un échec d'écriture ne doit pas arrêter le thread; on réessaiera au prochain réveil
+                pass
+            with self._lock:
+                delay = self._heap[0][0] - time.time() if self._heap else self.max_sleep
+            self._wake.wait(timeout=min(max(delay, 0.0), self.max_sleep))
+
+
+def migrate_json_to_sqlite(json_path, store):
+    """Import unique de l'ancien conversations.json dans la base SQLite.
+
+    La migration est marquée dans la table meta: elle ne tourne qu'une fois,
+    même si le fichier JSON est conservé à côté de la base.
+    """
+    if store.get_meta("json_migrated_at") or not os.path.exists(json_path):
+        return False
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    store.import_document(data)
+    store.set_meta("json_migrated_at", datetime.now().isoformat())
+    return True
+
+
+def open_conversation_store(backend, ttl, json_path="conversations.json", sqlite_path="app.db",
+                            shard_dir="conversations", journal_compact_bytes=1024 * 1024):
+    """Construit le backend configuré (`json` par défaut, `sharded`, `journal` ou `sqlite`).
+
+    Les backends fichiers ne supportent qu'un processus écrivain: le premier
+    processus qui les ouvre (l'application, ou bulk.py) prend un verrou
+    `<chemin>.lock`, et un second lève StoreLockedError. SQLite gère lui-même
+    les accès concurrents.
+    """
+    lock_paths = {"json": json_path, "sharded": shard_dir, "journal": "conversations.journal"}
+    if backend in lock_paths and not hold_process_lock(lock_paths[backend] + ".lock"):
+        raise StoreLockedError(
+            f"Le store de conversations '{backend}' est déjà ouvert par un autre processus ({lock_paths[backend]}.lock)"
+        )
+    if backend == "journal":
+        return JournalConversationStore(
+            "conversations.snapshot.json", "conversations.journal", ttl,
+            compact_bytes=journal_compact_bytes, legacy_path=json_path
+        )
+    if backend == "sharded":
+        return ShardedJsonConversationStore(shard_dir, ttl, legacy_path=json_path)
+    if backend == "sqlite":
+        store = SqliteConversationStore(sqlite_path, ttl)
+        migrate_json_to_sqlite(json_path, store)
+        return store
+    if backend == "json":
+        return JsonConversationStore(json_path, ttl)
+    raise ValueError(f"Backend de conversations inconnu: {backend}")
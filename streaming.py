@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+from collections import deque
+
+from metrics import percentile
+
+
+class RenderStats:
+    """Totaux des flux rendus depuis le démarrage du process (partagés entre sessions)"""
+
+    def __init__(self):
+        self.streams = 0
+        self.chunks = 0
+        self.renders = 0
+        self._lock = threading.Lock()
+
+    def record(self, chunks, renders):
+        with self._lock:
+            self.streams += 1
+            self.chunks += chunks
+            self.renders += renders
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "streams": self.streams,
+                "chunks": self.chunks,
+                "renders": self.renders,
+                "saved": self.chunks - self.renders,
+            }
+
+
+class LatencyStats:
+    """Fenêtre glissante de durées (ex: time-to-first-token) pour le suivi admin"""
+
+    def __init__(self, size=200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return {"count": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0}
+        return {
+            "count": len(values),
+            "avg": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+        }
+
+
+class AttemptLog:
+    """Tentatives de streaming récentes (succès, reprise après erreur, échec)"""
+
+    def __init__(self, size=500):
+        self.attempts = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, kind, attempt, outcome, duration, chars, error=None):
+        with self._lock:
+            self.attempts.append({
+                "at": time.time(),
+                "kind": kind,
+                "attempt": attempt,
+                "outcome": outcome,
+                "duration": duration,
+                "chars": chars,
+                "error": error,
+            })
+
+    def summary(self):
+        with self._lock:
+            attempts = list(self.attempts)
+        return {
+            "attempts": len(attempts),
+            "retries": sum(1 for a in attempts if a["outcome"] == "retry"),
+            "resumed": sum(1 for a in attempts if a["outcome"] == "ok" and a["attempt"] > 1),
+            "failed": sum(1 for a in attempts if a["outcome"] == "failed"),
+        }
+
+
+def resilient_stream(open_stream, is_transient, kind="", attempts=3, base_delay=1.0, max_delay=20.0,
+                     log=None, sleep=time.sleep):
+    """Relaie `open_stream(partial)` en reprenant après les erreurs transitoires.
+
+    `partial` est le texte déjà reçu ("" au premier essai): la tentative
+    suivante doit le poursuivre au lieu de tout régénérer. Entre deux essais,
+    attente aléatoire dans [0, min(max_delay, base_delay * 2^n)] (full jitter).
+    Chaque tentative est enregistrée dans `log`.
+    """
+    received = []
+    for attempt in range(1, attempts + 1):
+        started = time.monotonic()
+        chars = 0
+        try:
+            for text in open_stream("".join(received)):
+                received.append(text)
+                chars += len(text)
+                yield text
+        except Exception as e:
+            retry = attempt < attempts and is_transient(e)
+            if log is not None:
+                log.record(kind, attempt, "retry" if retry else "failed", time.monotonic() - started, chars, repr(e))
+            if not retry:
+                raise
+            sleep(random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1))))
+            continue
+        if log is not None:
+            log.record(kind, attempt, "ok", time.monotonic() - started, chars)
+        return
+
+
+class StreamRenderer:
+    """Affiche un flux de texte dans un placeholder en regroupant les rendus.
+
+    Les morceaux reçus sont accumulés dans une liste (pas de concaténation
+    quadratique) et le texte n'est renvoyé au navigateur que lorsque
+    `interval` secondes se sont écoulées ou que `chars` caractères sont en
+    attente depuis le dernier rendu. `close()` fait toujours un dernier rendu
+    complet et renvoie le texte final.
+    """
+
+    def __init__(self, placeholder, interval=0.1, chars=200, stats=None, clock=time.monotonic):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.chars = chars
+        self.stats = stats
+        self.clock = clock
+        self.parts = []
+        self.chunks = 0
+        self.renders = 0
+        self._pending = 0
+        self._last_render = clock()
+        self._closed = False
+
+    def write(self, text):
+        if not text:
+            return
+        self.parts.append(text)
+        self.chunks += 1
+        self._pending += len(text)
+        if self._pending >= self.chars or self.clock() - self._last_render >= self.interval:
+            self._render()
+
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts[:] = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def _render(self):
+        self.placeholder.markdown(self.text())
+        self.renders += 1
+        self._pending = 0
+        self._last_render = self.clock()
+
+    def close(self):
+        """Dernier rendu (si du texte est en attente) et enregistrement des statistiques"""
+        if not self._closed:
+            self._closed = True
+            if self._pending:
+                self._render()
+            if self.stats is not None:
+                self.stats.record(self.chunks, self.renders)
+        return self.text()
+
+    @property
+    def saved_renders(self):
+        return self.chunks - self.renders
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # En cas d'erreur, on affiche quand même ce qui a été reçu
+        self.close()
+        return False
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import (  # noqa: E402
+    JournalConversationStore,
+    JsonConversationStore,
+    ShardedJsonConversationStore,
+    SqliteConversationStore,
+)
+
+TTL = 7 * 24 * 60 * 60
+BACKENDS = ("json", "sharded", "journal", "sqlite")
+
+
+def make_store(backend, directory, ttl=TTL):
+    """Backend de conversations dans `directory`, sans passer par le verrou de processus"""
+    directory = str(directory)
+    if backend == "json":
+        return JsonConversationStore(os.path.join(directory, "conversations.json"), ttl)
+    if backend == "sharded":
+        return ShardedJsonConversationStore(os.path.join(directory, "conversations"), ttl)
+    if backend == "journal":
+        return JournalConversationStore(
+            os.path.join(directory, "conversations.snapshot.json"),
+            os.path.join(directory, "conversations.journal"), ttl
+        )
+    return SqliteConversationStore(os.path.join(directory, "app.db"), ttl)
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def store(backend, tmp_path):
+    return make_store(backend, tmp_path)
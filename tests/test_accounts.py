@@ -0,0 +1,335 @@
+import json
+import threading
+import time
+
+import pytest
+
+import accounts
+from accounts import ActivityAggregator, CreditLedger, JsonUserStore, SqliteUserStore, UsernameIndex, new_user
+from conftest import TTL
+from storage import JsonConversationStore, SqliteConversationStore
+
+
+@pytest.fixture(params=("json", "sqlite"))
+def user_store(request, tmp_path):
+    if request.param == "json":
+        return JsonUserStore(str(tmp_path / "users.json"))
+    return SqliteUserStore(str(tmp_path / "app.db"))
+
+
+def _ledger(user_store, conversation_store=None):
+    # Pas de flush automatique: les tests lisent les compteurs en attente
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=10 ** 6)
+    return CreditLedger(user_store, activity, conversation_store), activity
+
+
+def _counter(user_store, activity, username, field):
+    return activity.merge(username, user_store.get_user(username))[field]
+
+
+def test_reserve_holds_credits_until_released(user_store):
+    user_store.add_user("alice", 5)
+    ledger, _ = _ledger(user_store)
+
+    first = ledger.reserve("alice", 2)
+    second = ledger.reserve("alice", 2)
+    assert ledger.available("alice") == 1
+    assert ledger.reserve("alice", 2) is None
+    assert ledger.reserve("inconnu", 1) is None
+
+    first.release()
+    first.release()
+    assert ledger.available("alice") == 3
+    second.release()
+    assert ledger.held("alice") == 0
+    # Une réservation n'écrit rien
+    assert user_store.get_user("alice")["credits"] == 5
+
+
+def test_reserve_batch_is_all_or_nothing(user_store):
+    user_store.add_user("alice", 5)
+    ledger, _ = _ledger(user_store)
+
+    assert ledger.reserve_batch("alice", 2, 3) is None
+    assert ledger.held("alice") == 0
+    reservations = ledger.reserve_batch("alice", 2, 2)
+    assert len(reservations) == 2 and ledger.available("alice") == 1
+
+
+def test_commit_debits_counts_and_writes(user_store):
+    user_store.add_user("alice", 5)
+    ledger, activity = _ledger(user_store)
+    written = []
+
+    reservation = ledger.reserve("alice", 2)
+    assert reservation.commit("total_scripts", lambda: written.append("script") or True)
+    assert written == ["script"]
+    assert user_store.get_user("alice")["credits"] == 3
+    assert _counter(user_store, activity, "alice", "total_scripts") == 1
+    assert ledger.held("alice") == 0
+
+
+def test_failed_write_restores_credits(user_store):
+    user_store.add_user("alice", 5)
+    ledger, activity = _ledger(user_store)
+
+    assert not ledger.reserve("alice", 2).commit("total_scripts", lambda: False)
+    assert user_store.get_user("alice")["credits"] == 5
+    assert _counter(user_store, activity, "alice", "total_scripts") == 0
+    assert ledger.held("alice") == 0
+
+
+def test_raising_write_restores_credits_and_propagates(user_store):
+    user_store.add_user("alice", 5)
+    ledger, activity = _ledger(user_store)
+
+    def write():
+        raise OSError("disque plein")
+
+    with pytest.raises(OSError):
+        ledger.reserve("alice", 2).commit("total_hooks", write)
+    assert user_store.get_user("alice")["credits"] == 5
+    assert _counter(user_store, activity, "alice", "total_hooks") == 0
+    assert ledger.held("alice") == 0
+
+
+def test_commit_refused_when_balance_dropped(user_store):
+    user_store.add_user("alice", 5)
+    ledger, _ = _ledger(user_store)
+    reservation = ledger.reserve("alice", 2)
+    # L'admin a retiré des crédits pendant la génération
+    user_store.set_credits("alice", 1)
+    written = []
+
+    assert not reservation.commit("total_scripts", lambda: written.append("script") or True)
+    assert written == []
+    assert user_store.get_user("alice")["credits"] == 1
+
+
+def test_shared_sqlite_commit_is_one_transaction(tmp_path):
+    path = str(tmp_path / "app.db")
+    user_store = SqliteUserStore(path)
+    conversations = SqliteConversationStore(path, TTL)
+    user_store.add_user("alice", 5)
+    ledger, _ = _ledger(user_store, conversations)
+
+    def write_then_fail():
+        conversations.add_script("alice", "Panda", "jamais enregistré")
+        raise OSError("échec après l'écriture")
+
+    with pytest.raises(OSError):
+        ledger.reserve("alice", 2).commit("total_scripts", write_then_fail)
+    assert user_store.get_user("alice")["credits"] == 5
+    assert user_store.get_user("alice")["total_scripts"] == 0
+    assert conversations.get_conversations("alice") == []
+
+    assert ledger.reserve("alice", 2).commit("total_scripts", lambda: conversations.add_script("alice", "Panda", "ok"))
+    assert user_store.get_user("alice")["credits"] == 3
+    assert user_store.get_user("alice")["total_scripts"] == 1
+    assert len(conversations.find_conversation("alice", "Panda")["scripts"]) == 1
+
+
+def test_separate_stores_restore_credits_on_write_failure(tmp_path):
+    user_store = JsonUserStore(str(tmp_path / "users.json"))
+    conversations = JsonConversationStore(str(tmp_path / "conversations.json"), TTL)
+    user_store.add_user("alice", 5)
+    ledger, _ = _ledger(user_store, conversations)
+
+    assert not ledger.reserve("alice", 2).commit("total_scripts", lambda: conversations.add_hook("alice", "inconnu", "h"))
+    assert user_store.get_user("alice")["credits"] == 5
+
+
+def _users(**credits):
+    return {username: dict(new_user(amount), total_scripts=len(username)) for username, amount in credits.items()}
+
+
+def test_username_index_prefix_and_substring_search():
+    index = UsernameIndex(_users(alice=1, Albert=2, bob=3, Malika=4))
+
+    assert index.matching("al") == ["Albert", "alice"]
+    assert index.matching("AL", mode="contains") == ["Albert", "alice", "Malika"]
+    assert index.matching("") == ["Albert", "alice", "bob", "Malika"]
+    assert index.matching("z") == []
+
+
+def test_username_index_sorts_and_paginates():
+    index = UsernameIndex(_users(alice=5, Albert=2, bob=9, Malika=1))
+
+    page, total = index.page(sort="credits", descending=True, offset=1, limit=2)
+    assert total == 4
+    assert [username for username, _ in page] == ["alice", "Albert"]
+    page, total = index.page("a", mode="contains", sort="total_scripts", limit=10)
+    assert total == 3 and [username for username, _ in page] == ["alice", "Albert", "Malika"]
+
+
+def test_list_users_matches_index(user_store):
+    for username, credits in (("alice", 5), ("Albert", 2), ("bob", 9), ("Malika", 1)):
+        user_store.add_user(username, credits)
+
+    page, total = user_store.list_users("AL")
+    assert total == 2 and [username for username, _ in page] == ["Albert", "alice"]
+    page, total = user_store.list_users("li", mode="contains", sort="credits", descending=True)
+    assert [username for username, _ in page] == ["alice", "Malika"]
+    page, total = user_store.list_users(offset=3, limit=2)
+    assert total == 4 and [username for username, _ in page] == ["Malika"]
+    assert page[0][1]["credits"] == 1
+    with pytest.raises(ValueError):
+        user_store.list_users(sort="password")
+
+
+def test_stats_follow_every_write(user_store):
+    user_store.add_user("alice", 5)
+    user_store.add_user("bob", 3)
+    user_store.deduct_credits("alice", 2)
+    user_store.increment_counter("bob", "total_hooks")
+    user_store.remove_user("bob")
+
+    assert user_store.get_stats() == {"users": 1, "credits": 3, "active_users": 0, "total_scripts": 0, "total_hooks": 0}
+    today = user_store.get_daily_stats(days=1)[-1]
+    assert today["new_users"] == 2 and today["removed_users"] == 1
+    assert today["credits_spent"] == 2 and today["hooks"] == 1
+
+
+def test_json_stats_are_served_without_reparsing(tmp_path, monkeypatch):
+    store = JsonUserStore(str(tmp_path / "users.json"))
+    store.add_user("alice", 5)
+    store.deduct_credits("alice", 1)
+
+    def no_read(path):
+        raise AssertionError(f"relecture de {path}")
+
+    monkeypatch.setattr(accounts, "read_json", no_read)
+    assert store.get_stats()["credits"] == 4
+    assert store.get_daily_stats()[-1]["credits_spent"] == 1
+    # Le résultat est une copie: le modifier ne touche pas au cache
+    store.get_stats()["credits"] = 0
+    assert store.get_stats()["credits"] == 4
+
+
+def test_json_stats_see_external_writes(tmp_path):
+    path = str(tmp_path / "users.json")
+    store = JsonUserStore(path)
+    store.add_user("alice", 5)
+    assert store.get_stats()["users"] == 1
+
+    JsonUserStore(path).add_user("bob", 7)
+    assert store.get_stats()["users"] == 2 and store.get_stats()["credits"] == 12
+
+
+def test_list_users_does_not_cache_index_under_a_newer_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "users.json")
+    store = JsonUserStore(path)
+    store.add_user("alice", 5)
+    load_document = store.load_document
+
+    def racing_load():
+        data = load_document()
+        # Écriture d'un autre processus entre la lecture et la mise en cache
+        JsonUserStore(path).add_user("bob", 7)
+        return data
+
+    monkeypatch.setattr(store, "load_document", racing_load)
+    assert [username for username, _ in store.list_users()[0]] == ["alice"]
+    monkeypatch.setattr(store, "load_document", load_document)
+    assert [username for username, _ in store.list_users()[0]] == ["alice", "bob"]
+
+
+def test_sqlite_user_store_imports_users_json_once(tmp_path):
+    legacy = tmp_path / "users.json"
+    legacy.write_text(json.dumps({"global_password": "secret", "users": {"alice": new_user(5)}}))
+    path = str(tmp_path / "app.db")
+
+    store = SqliteUserStore(path, legacy_path=str(legacy))
+    assert store.get_global_password() == "secret"
+    assert store.get_user("alice")["credits"] == 5
+    assert store.get_stats()["users"] == 1
+
+    # Le fichier n'est plus relu ni réécrit: débits et ajouts restent dans la base
+    store.deduct_credits("alice", 2)
+    store.add_user("bob", 1)
+    legacy.write_text(json.dumps({"global_password": "autre", "users": {}}))
+    reopened = SqliteUserStore(path, legacy_path=str(legacy))
+    assert reopened.get_user("alice")["credits"] == 3 and reopened.get_user("bob") is not None
+    assert reopened.get_global_password() == "secret"
+
+
+def test_concurrent_debits_never_overdraw(user_store):
+    user_store.add_user("alice", 50)
+    results = []
+
+    def debit():
+        for _ in range(20):
+            results.append(user_store.deduct_credits("alice", 1))
+
+    threads = [threading.Thread(target=debit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 50
+    assert user_store.get_user("alice")["credits"] == 0
+    assert user_store.get_stats()["credits"] == 0
+
+
+def test_activity_is_written_in_batches(user_store):
+    user_store.add_user("alice", 5)
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=10 ** 6)
+
+    activity.increment("alice", "total_scripts")
+    activity.increment("alice", "total_scripts")
+    activity.touch("alice", "last_login")
+    stored = user_store.get_user("alice")
+    assert stored["total_scripts"] == 0 and stored["last_login"] is None
+    merged = activity.merge("alice", stored)
+    assert merged["total_scripts"] == 2 and merged["last_login"] is not None
+    assert activity.pending_totals() == {"total_scripts": 2}
+
+    activity.flush()
+    assert user_store.get_user("alice")["total_scripts"] == 2
+    assert user_store.get_stats()["total_scripts"] == 2
+    assert activity.pending_totals() == {}
+    assert activity.merge("alice", user_store.get_user("alice"))["total_scripts"] == 2
+
+
+def test_activity_flushes_after_enough_events(user_store):
+    user_store.add_user("alice", 5)
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=3)
+
+    for _ in range(3):
+        activity.increment("alice", "total_hooks")
+    deadline = time.monotonic() + 5
+    while user_store.get_user("alice")["total_hooks"] != 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert user_store.get_user("alice")["total_hooks"] == 3
+
+
+def test_failed_activity_flush_keeps_the_batch(user_store, monkeypatch):
+    user_store.add_user("alice", 5)
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=10 ** 6)
+    activity.increment("alice", "total_scripts")
+
+    def unavailable(counters, timestamps):
+        raise OSError("disque plein")
+
+    monkeypatch.setattr(user_store, "apply_activity", unavailable)
+    with pytest.raises(OSError):
+        activity.flush()
+    activity.increment("alice", "total_scripts")
+    assert activity.pending_totals() == {"total_scripts": 2}
+
+    monkeypatch.undo()
+    activity.flush()
+    assert user_store.get_user("alice")["total_scripts"] == 2
+
+
+def test_removed_user_activity_is_discarded(user_store):
+    user_store.add_user("alice", 5)
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=10 ** 6)
+    activity.increment("alice", "total_scripts")
+    user_store.remove_user("alice")
+    activity.discard("alice")
+
+    activity.flush()
+    assert user_store.get_user("alice") is None
+    assert activity.pending_totals() == {}
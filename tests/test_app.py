@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_app(tmp_path, secrets, code):
+    """Exécute `code` après `import app` (mode bare) dans `tmp_path`, avec ces secrets; renvoie sa sortie JSON"""
+    os.makedirs(tmp_path / ".streamlit")
+    (tmp_path / ".streamlit" / "secrets.toml").write_text(
+        "".join(f"{key} = {json.dumps(value)}\n" for key, value in secrets.items())
+    )
+    (tmp_path / ".streamlit" / "config.toml").write_text('[logger]\nlevel = "error"\n')
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT!r})\nimport json, app\n{code}"],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_anthropic_client_is_shared_and_configured(tmp_path):
+    output = _run_app(tmp_path, {
+        "ANTHROPIC_API_KEY": "test", "ANTHROPIC_BASE_URL": "http://127.0.0.1:9", "ANTHROPIC_MAX_RETRIES": 5,
+        "ANTHROPIC_READ_TIMEOUT": 30, "EXPIRY_SWEEPER": False,
+    }, """
+first, second = app.ViralScriptGenerator("alice"), app.ViralScriptGenerator("bob")
+client = app.get_anthropic_client("test")
+print(json.dumps({
+    "shared": first.client is second.client is client,
+    "other_key": app.get_anthropic_client("autre") is not client,
+    "base_url": str(client.base_url),
+    "max_retries": client.max_retries,
+    "read_timeout": client.timeout.read,
+}))
+""")
+    assert output == {
+        "shared": True, "other_key": True, "base_url": "http://127.0.0.1:9", "max_retries": 5, "read_timeout": 30.0,
+    }
+
+
+def test_admin_sees_stored_balance_during_a_generation(tmp_path):
+    output = _run_app(tmp_path, {"EXPIRY_SWEEPER": False}, """
+auth = app.AuthManager()
+auth.add_user("alice", 10)
+reservation = auth.reserve_credits("alice", 2)
+print(json.dumps({"available": auth.get_user_credits("alice"), "stored": auth.get_stored_credits("alice")}))
+""")
+    assert output == {"available": 8, "stored": 10}
@@ -0,0 +1,41 @@
+import json
+
+import bench
+
+
+def _row(op, p95_ms):
+    return {"scale": 100, "store": "users", "backend": "json", "op": op, "p95_ms": p95_ms}
+
+
+def test_runner_measures_without_setup_time():
+    runner = bench.Runner(ops=3, max_seconds=10)
+    calls = []
+    runner.measure(
+        {"scale": 1, "store": "users", "backend": "json"}, "op", calls.append, [(1,), (2,), (3,), (4,)],
+        setup=lambda n: calls.append(-n)
+    )
+    assert calls == [-1, 1, -2, 2, -3, 3]
+    assert runner.results[0]["ops"] == 3
+
+
+def test_compare_flags_only_significant_regressions(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"meta": {}, "results": [_row("a", 1.0), _row("b", 1.0), _row("c", 0.01)]}))
+    results = [_row("a", 1.1), _row("b", 2.0), _row("c", 0.05), _row("d", 9.0)]
+    assert bench.compare(results, str(baseline), tolerance=0.2) == 1
+
+
+def test_bench_drives_the_app_managers(tmp_path):
+    output = tmp_path / "results.json"
+    assert bench.main([
+        "--scales", "40", "--ops", "3", "--max-seconds", "5", "--user-backends", "json",
+        "--conversation-backends", "sqlite", "--output", str(output),
+    ]) == 0
+
+    results = json.loads(output.read_text())["results"]
+    ops = {(row["store"], row["op"]) for row in results}
+    for op in ("get_admin_stats", "list_users (prefix)", "reserve + commit_generation", "activity flush (50 users)"):
+        assert ("users", op) in ops
+    for op in ("update_hook", "delete_hook", "clear_user", "remove_user (compte + conversations)", "force_cleanup (full)"):
+        assert ("conversations", op) in ops
+    assert all(row["ops"] for row in results)
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import bulk
+from storage import StoreLockedError, open_conversation_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_parse_animals_formats():
+    assert bulk.parse_animals(["chat", " Lion ", ""]) == ["Chat", "Lion"]
+    assert bulk.parse_animals('["panda", "koala"]') == ["Panda", "Koala"]
+    assert bulk.parse_animals("loup\n\n renard \n") == ["Loup", "Renard"]
+
+
+def test_load_secrets_accepts_toml_array(tmp_path, monkeypatch):
+    secrets = tmp_path / "secrets.toml"
+    secrets.write_text('ANIMALS_LIST = ["aigle", "dauphin"]\nSCRIPT_PROMPT = "Script sur {{ANIMAL}}"\n', encoding="utf-8")
+    monkeypatch.delenv("ANIMALS_LIST", raising=False)
+
+    loaded = bulk.load_secrets(str(secrets))
+    assert bulk.parse_animals(loaded["ANIMALS_LIST"]) == ["Aigle", "Dauphin"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="pas de verrou entre processus sous Windows")
+def test_file_store_refuses_a_second_process(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ANIMALS_LIST", '["chat"]')
+    holder = subprocess.Popen(
+        [sys.executable, "-c",
+         "import sys; sys.path.insert(0, sys.argv[1]); import storage; "
+         "storage.open_conversation_store('json', 60); print('prêt', flush=True); sys.stdin.read()", ROOT],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert holder.stdout.readline().strip() == "prêt"
+        with pytest.raises(StoreLockedError):
+            open_conversation_store("json", 60)
+        with pytest.raises(SystemExit):
+            bulk.main(["--user", "alice", "--backend", "fake", "--secrets", "absent.toml"])
+        assert "arrêtez l'application" in capsys.readouterr().err
+    finally:
+        holder.stdin.close()
+        holder.wait(timeout=10)
+    # SQLite gère lui-même les accès concurrents
+    assert open_conversation_store("sqlite", 60) is not None
+
+
+def _run_bulk(user, *extra):
+    return bulk.main(["--user", user, "--backend", "fake", "--secrets", "absent.toml", *extra])
+
+
+def test_progress_is_kept_per_user_and_prompt(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ANIMALS_LIST", '["chat", "lion"]')
+    monkeypatch.setenv("SCRIPT_PROMPT", "Script sur {{ANIMAL}}")
+
+    assert _run_bulk("alice") == 0
+    assert _run_bulk("bob") == 0
+    # Relancer pour le même utilisateur reprend sans rien régénérer
+    assert _run_bulk("alice") == 0
+    store = open_conversation_store("json", 60)
+    for user in ("alice", "bob"):
+        assert [len(store.find_conversation(user, animal)["scripts"]) for animal in ("Chat", "Lion")] == [1, 1]
+
+    # Un prompt modifié n'est pas considéré comme déjà fait
+    monkeypatch.setenv("SCRIPT_PROMPT", "Nouveau script sur {{ANIMAL}}")
+    assert _run_bulk("alice") == 0
+    assert len(store.find_conversation("alice", "Chat")["scripts"]) == 2
+    assert len(store.find_conversation("bob", "Chat")["scripts"]) == 1
+
+
+def test_request_id_is_batch_compatible():
+    first = bulk.request_id("script", "Éléphant", 3, "alice", "Script sur {{ANIMAL}}")
+    assert first == bulk.request_id("script", "éléphant", 3, "alice", "Script sur {{ANIMAL}}")
+    assert first != bulk.request_id("script", "Éléphant", 3, "bob", "Script sur {{ANIMAL}}")
+    assert len(first) <= 64 and first.replace("-", "").isalnum()
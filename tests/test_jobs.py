@@ -0,0 +1,108 @@
+import threading
+
+from accounts import ActivityAggregator, CreditLedger, JsonUserStore
+from jobs import FairQueue, GenerationJob, JobRunner
+
+
+def _drain(queue):
+    return [queue.get() for _ in range(len(queue))]
+
+
+def test_fair_queue_serves_users_in_turn():
+    queue = FairQueue()
+    for n in range(3):
+        queue.put("alice", f"a{n}")
+    queue.put("bob", "b0")
+    queue.put("carol", "c0")
+    queue.put("bob", "b1")
+
+    assert len(queue) == 6
+    assert _drain(queue) == ["a0", "b0", "c0", "a1", "b1", "a2"]
+    assert len(queue) == 0
+
+
+def test_fair_queue_burst_only_waits_behind_itself():
+    queue = FairQueue()
+    for n in range(10):
+        queue.put("alice", f"a{n}")
+    queue.put("bob", "b0")
+
+    assert queue.position("bob", "b0") == 1
+    assert queue.get() == "a0"
+    assert queue.get() == "b0"
+
+
+def test_fair_queue_position_matches_service_order():
+    queue = FairQueue()
+    items = [("alice", "a0"), ("alice", "a1"), ("bob", "b0"), ("alice", "a2"), ("carol", "c0"), ("bob", "b1")]
+    for username, item in items:
+        queue.put(username, item)
+
+    positions = {item: queue.position(username, item) for username, item in items}
+    served = _drain(queue)
+    assert positions == {item: served.index(item) for _, item in items}
+    assert queue.position("alice", "a0") is None
+
+
+def test_fair_queue_get_waits_for_an_item():
+    queue = FairQueue()
+    received = []
+    consumer = threading.Thread(target=lambda: received.append(queue.get()))
+    consumer.start()
+    consumer.join(timeout=0.05)
+    assert consumer.is_alive()
+
+    queue.put("alice", "a0")
+    consumer.join(timeout=5)
+    assert received == ["a0"]
+
+
+def test_job_wait_wakes_on_new_text_or_finish():
+    job = GenerationJob("alice", "script", "Panda")
+    assert job.wait(0, timeout=0.01) == ([], False)
+
+    threading.Timer(0.05, job.append, args=("début",)).start()
+    assert job.wait(0, timeout=5) == (["début"], False)
+
+    threading.Timer(0.05, job.set_status, args=("done",)).start()
+    assert job.wait(1, timeout=5) == ([], True)
+    assert job.text() == "début"
+
+
+def _wait_finished(jobs):
+    for job in jobs:
+        while not job.wait(0, timeout=5)[1]:
+            pass
+
+
+def test_variants_run_in_parallel_and_charge_only_successes(tmp_path):
+    user_store = JsonUserStore(str(tmp_path / "users.json"))
+    user_store.add_user("alice", 10)
+    activity = ActivityAggregator(user_store, flush_interval=3600, flush_events=10 ** 6)
+    ledger = CreditLedger(user_store, activity)
+    runner = JobRunner(str(tmp_path / "jobs"), max_workers=3, persist_interval=0)
+    # Chaque variante attend les deux autres: elles ne passent que si elles tournent ensemble
+    started = threading.Barrier(3, timeout=5)
+
+    def variant(n):
+        started.wait()
+        if n == 2:
+            raise RuntimeError("surcharge")
+        yield f"variante {n}"
+
+    reservations = ledger.reserve_batch("alice", 2, 3)
+    jobs = [
+        runner.submit("alice", "draft", "Panda", lambda n=n: variant(n),
+                      commit=lambda text, r=reservation: r.commit("total_scripts"),
+                      release=reservation.release, group="lot")
+        for n, reservation in enumerate(reservations)
+    ]
+    _wait_finished(jobs)
+
+    assert [job.status for job in jobs] == ["done", "done", "failed"]
+    assert user_store.get_user("alice")["credits"] == 6 and ledger.held("alice") == 0
+    assert activity.merge("alice", user_store.get_user("alice"))["total_scripts"] == 2
+
+    reloaded = JobRunner(str(tmp_path / "jobs"), max_workers=1)
+    assert {job.group for job in reloaded.jobs_for("alice", "draft")} == {"lot"}
+    assert sorted(job.text() for job in reloaded.jobs_for("alice", "draft")) == ["", "variante 0", "variante 1"]
@@ -0,0 +1,56 @@
+import anthropic
+import pytest
+
+from loadtest import FakeAnthropicServer, percentiles, widget_key
+
+
+@pytest.fixture
+def fake_server():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeAnthropicServer(token_rate=0, seed=1, **kwargs).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def _client(server):
+    return anthropic.Anthropic(api_key="test", base_url=server.url, max_retries=0)
+
+
+def test_widget_key_reads_user_key():
+    assert widget_key("$$ID-0123abcd-script_input") == "script_input"
+    assert widget_key("$$ID-0123abcd-hooks_42-abc") == "hooks_42-abc"
+    assert widget_key("$$ID-0123abcd-None") is None
+    assert widget_key("0123abcd") is None
+
+
+def test_percentiles_summary():
+    assert percentiles([]) == {"count": 0}
+    summary = percentiles([float(value) for value in range(100, 0, -1)])
+    assert summary == {"count": 100, "p50": 50.0, "p95": 95.0, "p99": 99.0, "max": 100.0}
+
+
+def test_fake_server_streams_messages(fake_server):
+    server = fake_server(tokens=5)
+    with _client(server).messages.stream(
+        model="model", max_tokens=3, messages=[{"role": "user", "content": "x" * 40}]
+    ) as stream:
+        text = "".join(stream.text_stream)
+        message = stream.get_final_message()
+
+    assert text.split() == ["voici", "le", "fait"]
+    assert message.usage.input_tokens == 10 and message.usage.output_tokens == 3
+    assert server.stats["requests"] == server.stats["completed"] == 1
+
+
+def test_fake_server_returns_overloaded_errors(fake_server):
+    server = fake_server(error_rate=1.0)
+    with pytest.raises(anthropic.APIStatusError) as error:
+        _client(server).messages.create(model="model", max_tokens=3, messages=[{"role": "user", "content": "x"}])
+
+    assert error.value.status_code == 529
+    assert server.stats["errors"] == 1 and server.stats["completed"] == 0
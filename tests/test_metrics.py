@@ -0,0 +1,72 @@
+import pytest
+
+from metrics import GenerationMetrics, GenerationTrace, percentile
+from streaming import LatencyStats
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _trace(kind, clock=None):
+    return GenerationTrace(kind, "alice", "Lion", "model", 1000, clock=clock or Clock())
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile([7], 0) == 7 and percentile([7], 99) == 7
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([], 95) is None
+
+
+def test_latency_stats_use_shared_percentile():
+    stats = LatencyStats()
+    for value in range(1, 21):
+        stats.record(float(value))
+    snapshot = stats.snapshot()
+    assert snapshot["p50"] == percentile(list(range(1, 21)), 50) == 10
+    assert snapshot["p95"] == 19
+
+
+@pytest.mark.parametrize("kind, task", [("scripts", "script"), ("hooks", "hook"), ("pool", "pool"), ("script", "script")])
+def test_trace_task_by_kind(kind, task):
+    assert _trace(kind).finish("ok")["task"] == task
+
+
+def test_trace_measures_stream():
+    clock = Clock()
+    trace = _trace("scripts", clock)
+    trace.attempt()
+    for at in (0.5, 0.6, 0.9):
+        clock.now = at
+        trace.chunk()
+    trace.output_tokens = 30
+    clock.now = 1.0
+
+    row = trace.finish("ok")
+    assert row["ttft"] == 0.5 and row["total_time"] == 1.0 and row["chunks"] == 3
+    assert row["gap_max"] == pytest.approx(0.3)
+    assert row["tokens_per_sec"] == pytest.approx(30 / 0.4)
+
+
+def test_pool_generations_stay_out_of_script_percentiles(tmp_path):
+    metrics = GenerationMetrics(str(tmp_path / "metrics.db"))
+    for kind, ttft in (("scripts", 1.0), ("scripts", 2.0), ("pool", 30.0), ("hooks", 3.0)):
+        clock = Clock()
+        trace = _trace(kind, clock)
+        clock.now = ttft
+        trace.chunk()
+        metrics.record(trace.finish("ok"))
+
+    rows = {row["task"]: row for row in metrics.daily_percentiles("ttft")}
+    assert rows["script"]["count"] == 2 and rows["script"]["p99"] == 2.0
+    assert rows["pool"]["count"] == 1 and rows["hook"]["count"] == 1
+    with pytest.raises(ValueError):
+        metrics.daily_percentiles("username")
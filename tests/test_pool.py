@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+
+import pool
+from pool import ScriptPool
+
+
+class BusyRunner:
+    """JobRunner qui a toujours une demande en attente: aucun remplissage n'est lancé"""
+
+    def queue_stats(self):
+        return {"queued": 1}
+
+
+def _pool(tmp_path, stock=(), **kwargs):
+    path = tmp_path / "script_pool.json"
+    scripts = [{"content": content, "created_at": time.time()} for content in stock]
+    path.write_text(json.dumps({"animals": {"panda": {
+        "animal": "Panda", "requests": 0, "hits": 0, "misses": 0, "scripts": scripts
+    }}}))
+    return ScriptPool(BusyRunner(), lambda animal: "", ["Panda", "Lion"], path=str(path), check_interval=3600, **kwargs)
+
+
+def test_take_serves_oldest_script_and_counts(tmp_path):
+    script_pool = _pool(tmp_path, stock=["premier", "second"])
+
+    assert script_pool.take("panda")["content"] == "premier"
+    assert script_pool.take("Lion") is None
+    assert script_pool.take("Licorne") is None
+    stats = script_pool.stats()
+    assert stats["hits"] == 1 and stats["served"] == 3
+    assert {row["animal"]: row["stock"] for row in stats["animals"]} == {"Panda": 1, "Lion": 0}
+
+
+def test_put_back_restores_stock_and_hits(tmp_path):
+    script_pool = _pool(tmp_path, stock=["premier"])
+    script = script_pool.take("Panda")
+    script_pool.put_back("Panda", script)
+
+    assert script_pool.stats()["hits"] == 0
+    assert script_pool.take("Panda") == script
+
+
+def test_state_is_written_by_the_pool_thread_only(tmp_path, monkeypatch):
+    writers = []
+    written = threading.Event()
+    write = pool.atomic_write_json
+
+    def recording_write(path, data):
+        writers.append(threading.current_thread().name)
+        write(path, data)
+        written.set()
+
+    monkeypatch.setattr(pool, "atomic_write_json", recording_write)
+    script_pool = _pool(tmp_path, stock=["premier"], save_interval=3600)
+
+    for _ in range(20):
+        script_pool.take("Lion")
+    assert writers == []
+    # Un changement de stock réveille le thread, qui persiste
+    script_pool.take("Panda")
+    assert written.wait(timeout=5)
+    assert set(writers) == {"script-pool"}
+
+    saved = json.loads((tmp_path / "script_pool.json").read_text())
+    assert saved["animals"]["panda"]["scripts"] == []
+    assert saved["animals"]["lion"]["requests"] == 20
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from conftest import make_store
+from profiling import RerunProfiler
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_spans_outside_a_rerun_are_not_recorded():
+    profiler = RerunProfiler()
+    with profiler.span("load", "users"):
+        pass
+    assert profiler.summary()["reruns"] == 0
+
+
+def test_rerun_records_spans_and_outcome():
+    profiler = RerunProfiler()
+    with profiler.rerun("main"):
+        for _ in range(2):
+            with profiler.span("show_main_page", "page"):
+                pass
+    with pytest.raises(Interrupted):
+        with profiler.rerun("lab"):
+            raise Interrupted()
+
+    summary = profiler.summary()
+    assert summary["reruns"] == 2
+    assert summary["last"]["page"] == "lab" and summary["last"]["outcome"] == "Interrupted"
+    (span,) = summary["spans"]
+    assert span["name"] == "show_main_page" and span["calls"] == 2 and span["reruns"] == 1
+
+
+def test_json_store_bytes_are_counted(tmp_path):
+    profiler = RerunProfiler()
+    store = profiler.instrument(make_store("json", tmp_path), "conversations")
+    with profiler.rerun("main"):
+        store.add_script("alice", "Lion", "script")
+
+    (span,) = profiler.summary()["spans"]
+    assert span["name"] == "add_script" and span["category"] == "conversations"
+    assert span["bytes_written"] > 0
+
+
+def test_sqlite_store_bytes_are_not_available(tmp_path):
+    profiler = RerunProfiler()
+    store = profiler.instrument(make_store("sqlite", tmp_path), "conversations")
+    with profiler.rerun("main"):
+        store.add_script("alice", "Lion", "script")
+        store.get_conversations("alice")
+
+    spans = profiler.summary()["spans"]
+    assert {span["name"] for span in spans} == {"add_script", "get_conversations"}
+    assert all(span["bytes_read"] is None and span["bytes_written"] is None for span in spans)
+
+
+def test_trace_is_appended_as_jsonl(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    profiler = RerunProfiler(window=2, trace_path=str(path))
+    for page in ("main", "lab", "admin"):
+        with profiler.rerun(page):
+            pass
+
+    assert [json.loads(line)["page"] for line in path.read_text().splitlines()] == ["main", "lab", "admin"]
+    assert profiler.summary()["reruns"] == 2
+    assert profiler.dump(str(tmp_path / "dump.jsonl")) == 2
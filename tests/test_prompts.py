@@ -0,0 +1,123 @@
+import pytest
+
+from prompts import CACHE_CONTROL, TRUNCATION_MARK, HookContextBuilder, PromptTemplate
+from storage import script_fingerprint
+
+
+def test_template_splits_static_prefix_for_caching():
+    template = PromptTemplate("Écris un script viral sur {{ANIMAL}}", "{{ANIMAL}}", "animal")
+
+    assert template.warnings == []
+    assert template.content("Panda") == [
+        {"type": "text", "text": "Écris un script viral sur ", "cache_control": CACHE_CONTROL},
+        {"type": "text", "text": "Panda"},
+    ]
+
+
+def test_template_repeats_value_in_short_suffix():
+    template = PromptTemplate("Sujet: {{ANIMAL}}. Titre: {{ANIMAL}} !", "{{ANIMAL}}", "animal")
+
+    assert template.warnings == []
+    assert template.content("Lion")[1]["text"] == "Lion. Titre: Lion !"
+
+
+def test_template_without_placeholder_warns():
+    template = PromptTemplate("Prompt figé", "{{ANIMAL}}", "animal")
+
+    assert template.warnings
+    assert template.content("Lion")[0]["text"] == "Prompt figé"
+
+
+def test_long_static_suffix_warns_or_is_rewritten():
+    consignes = "Consignes détaillées. " * 40
+    text = f"Script sur {{{{ANIMAL}}}}.\n{consignes}"
+
+    plain = PromptTemplate(text, "{{ANIMAL}}", "animal", max_static_suffix=100)
+    assert plain.warnings and not plain.rewritten
+    assert plain.content("Loup")[1]["text"].endswith(consignes)
+
+    rewritten = PromptTemplate(text, "{{ANIMAL}}", "animal", rewrite=True, max_static_suffix=100)
+    assert rewritten.warnings == [] and rewritten.rewritten
+    cached, variable = rewritten.content("Loup")
+    assert "<animal/>" in cached["text"] and cached["text"].rstrip().endswith(consignes.rstrip())
+    assert variable == {"type": "text", "text": "<animal>\nLoup\n</animal>"}
+
+
+def _conversation(*contents, hooks=()):
+    return {
+        "animal": "Panda",
+        "scripts": [{"content": content, "char_count": len(content)} for content in contents],
+        "hooks": list(hooks),
+    }
+
+
+def _hook_builder(budget, **kwargs):
+    return HookContextBuilder(PromptTemplate("Hooks pour:\n{{SCRIPT}}", "{{SCRIPT}}", "scripts"), budget, **kwargs)
+
+
+def test_hook_context_sends_every_script_within_budget():
+    conversation = _conversation("premier", "second")
+    content, sources, report = _hook_builder(10000).build(conversation)
+
+    assert content[1]["text"] == "SCRIPT 1:\npremier\n\nSCRIPT 2:\nsecond"
+    assert sources == [script_fingerprint("premier"), script_fingerprint("second")]
+    assert report["scripts_sent"] == 2 and not report["truncated"]
+
+
+def test_hook_context_prefers_newest_scripts():
+    conversation = _conversation("a" * 4000, "b" * 4000, "c" * 400)
+    content, sources, report = _hook_builder(1000, min_tokens=200).build(conversation)
+
+    text = content[1]["text"]
+    assert "a" * 10 not in text
+    assert text.startswith("SCRIPT 2:\n") and TRUNCATION_MARK in text and text.endswith("c" * 400)
+    # Le script 2, tronqué, n'est pas compté comme couvert par les hooks
+    assert sources == [script_fingerprint("c" * 400)]
+    assert report["truncated"] and report["estimated_tokens"] <= 1000
+
+
+def test_hook_context_always_sends_newest_script():
+    # Le prompt seul dépasse déjà le budget
+    conversation = _conversation("ancien", "x" * 5000)
+    content, sources, report = _hook_builder(5, min_tokens=50).build(conversation)
+
+    assert all(block["text"].strip() for block in content)
+    assert content[1]["text"].startswith("SCRIPT 2:\n" + "x" * 50)
+    assert content[1]["text"].endswith(TRUNCATION_MARK)
+    assert sources == []
+    assert report["scripts_sent"] == 1 and report["truncated"]
+
+
+def test_hook_context_requires_a_script():
+    with pytest.raises(ValueError):
+        _hook_builder(1000).build(_conversation())
+
+
+def test_hook_context_only_new_scripts():
+    covered = {"content": "hooks", "sources": [script_fingerprint("vu")]}
+    builder = _hook_builder(10000, only_new=True)
+
+    _, sources, report = builder.build(_conversation("vu", "nouveau", hooks=[covered]))
+    assert sources == [script_fingerprint("nouveau")] and report["mode"] == "new"
+
+    # Tout est déjà couvert: on renvoie quand même les scripts
+    _, sources, report = builder.build(_conversation("vu", hooks=[covered]))
+    assert sources == [script_fingerprint("vu")] and report["mode"] == "all"
+
+
+def test_template_skips_empty_variable_block():
+    template = PromptTemplate("Hooks pour:\n{{SCRIPT}}", "{{SCRIPT}}", "scripts")
+
+    assert template.content("") == [{"type": "text", "text": "Hooks pour:\n", "cache_control": CACHE_CONTROL}]
+
+
+def test_hook_context_only_new_resends_truncated_scripts():
+    builder = _hook_builder(1000, only_new=True, min_tokens=200)
+    conversation = _conversation("a" * 4000, "b" * 400)
+    _, sources, report = builder.build(conversation)
+    assert report["truncated"] and sources == [script_fingerprint("b" * 400)]
+
+    conversation["hooks"] = [{"content": "hooks", "sources": sources}]
+    content, sources, report = builder.build(conversation)
+    assert report["mode"] == "new" and report["scripts_candidates"] == 1
+    assert content[1]["text"].startswith("SCRIPT 1:\n")
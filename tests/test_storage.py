@@ -0,0 +1,390 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import storage
+from conftest import TTL, make_store
+from storage import ExpirySweeper, JournalConversationStore, ShardedJsonConversationStore, atomic_write_json, cleanup_conversations, new_conversation
+
+
+def test_add_script_creates_conversation(store):
+    assert store.add_script("alice", "Panda", "premier")
+    assert store.add_script("alice", "panda", "second")
+
+    conversations = store.get_conversations("alice")
+    assert len(conversations) == 1
+    assert conversations[0]["animal"] == "Panda"
+    assert [s["content"] for s in conversations[0]["scripts"]] == ["premier", "second"]
+    assert conversations[0]["scripts"][1]["char_count"] == len("second")
+    assert store.get_conversations("bob") == []
+
+
+def test_find_conversation_ignores_case(store):
+    store.add_script("alice", "Éléphant", "texte")
+
+    conv = store.find_conversation("alice", "ÉLÉPHANT")
+    assert conv is not None and conv["animal"] == "Éléphant"
+    assert store.get_conversation("alice", conv["id"])["id"] == conv["id"]
+    assert store.find_conversation("bob", "Éléphant") is None
+
+
+def test_get_or_create_conversation_is_idempotent(store):
+    first = store.get_or_create_conversation("alice", "Lion")
+    second = store.get_or_create_conversation("alice", "lion")
+    assert first["id"] == second["id"]
+    assert len(store.get_conversations("alice")) == 1
+
+
+def test_hooks_keep_sources(store):
+    store.add_script("alice", "Lion", "script")
+    conv = store.find_conversation("alice", "Lion")
+
+    assert store.add_hook("alice", conv["id"], "hooks", sources=["abc"])
+    assert not store.add_hook("alice", "inconnu", "hooks")
+    assert not store.add_hook("bob", conv["id"], "hooks")
+
+    hooks = store.find_conversation("alice", "Lion")["hooks"]
+    assert hooks == [{"content": "hooks", "sources": ["abc"]}]
+
+
+def test_update_and_delete_entries(store):
+    store.add_script("alice", "Loup", "un")
+    store.add_script("alice", "Loup", "deux")
+    conv_id = store.find_conversation("alice", "Loup")["id"]
+    store.add_hook("alice", conv_id, "h1")
+
+    assert store.update_script("alice", conv_id, 0, "modifié")
+    assert not store.update_script("alice", conv_id, 5, "hors limites")
+    assert store.update_hook("alice", conv_id, 0, "h1 bis")
+    assert store.delete_script("alice", conv_id, 1)
+    assert store.delete_hook("alice", conv_id, 0)
+    assert not store.delete_hook("alice", conv_id, 0)
+
+    conv = store.get_conversation("alice", conv_id)
+    assert conv["scripts"] == [{"content": "modifié", "char_count": len("modifié")}]
+    assert conv["hooks"] == []
+
+
+def test_clear_and_delete_user(store):
+    store.add_script("alice", "Chat", "a")
+    store.add_script("bob", "Chien", "b")
+
+    store.clear_user("alice")
+    assert store.get_conversations("alice") == []
+    assert store.find_conversation("alice", "Chat") is None
+
+    store.delete_user("bob")
+    assert "bob" not in store.load_all()
+
+
+def test_data_survives_reopening(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    store.add_script("alice", "Koala", "persisté")
+    conv_id = store.find_conversation("alice", "Koala")["id"]
+    store.add_hook("alice", conv_id, "hooks")
+
+    reopened = make_store(backend, tmp_path)
+    conv = reopened.find_conversation("alice", "Koala")
+    assert conv["id"] == conv_id
+    assert conv["scripts"][0]["content"] == "persisté"
+    assert conv["hooks"][0]["content"] == "hooks"
+
+
+def test_replace_all_and_cleanup_expired(store):
+    old = new_conversation("Aigle")
+    old["created_at"] = (datetime.now() - timedelta(seconds=TTL + 60)).isoformat()
+    old["scripts"].append({"content": "vieux", "char_count": 5})
+    recent = new_conversation("Renard")
+    recent["scripts"].append({"content": "récent", "char_count": 6})
+    store.replace_all({"alice": {"conversations": [old, recent]}})
+
+    store.cleanup_expired()
+    assert [conv["animal"] for conv in store.get_conversations("alice")] == ["Renard"]
+
+
+def test_remove_conversations(store):
+    store.add_script("alice", "Tigre", "a")
+    store.add_script("alice", "Panda", "b")
+    tiger = store.find_conversation("alice", "Tigre")
+
+    assert store.remove_conversations([("alice", tiger["id"]), ("alice", "inconnu")]) == 1
+    assert store.find_conversation("alice", "Tigre") is None
+    assert store.find_conversation("alice", "Panda") is not None
+
+
+def _expired_conversation(animal):
+    conv = new_conversation(animal)
+    conv["created_at"] = (datetime.now() - timedelta(seconds=TTL + 60)).isoformat()
+    return conv
+
+
+def test_sharded_migrates_legacy_file(tmp_path):
+    legacy = tmp_path / "conversations.json"
+    conv = new_conversation("Dauphin")
+    conv["scripts"].append({"content": "ancien", "char_count": 6})
+    legacy.write_text(json.dumps({"alice": {"conversations": [conv]}, "b/ob": {"conversations": []}}))
+
+    store = ShardedJsonConversationStore(str(tmp_path / "conversations"), TTL, legacy_path=str(legacy))
+    assert store.find_conversation("alice", "Dauphin")["scripts"][0]["content"] == "ancien"
+    assert sorted(store.load_all()) == ["alice", "b/ob"]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".tmp-")]
+
+
+def test_sharded_interrupted_migration_is_retried(tmp_path, monkeypatch):
+    legacy = tmp_path / "conversations.json"
+    legacy.write_text(json.dumps({
+        "alice": {"conversations": [new_conversation("Chat")]},
+        "bob": {"conversations": [new_conversation("Chien")]},
+    }))
+    directory = str(tmp_path / "conversations")
+    written = []
+
+    def crash_after_first(path, data):
+        if written:
+            raise OSError("disque plein")
+        written.append(path)
+        atomic_write_json(path, data)
+
+    monkeypatch.setattr(storage, "atomic_write_json", crash_after_first)
+    with pytest.raises(OSError):
+        ShardedJsonConversationStore(directory, TTL, legacy_path=str(legacy))
+    # Pas de répertoire à moitié rempli qui passerait pour déjà migré
+    assert not os.path.exists(directory)
+    assert os.listdir(tmp_path) == ["conversations.json"]
+
+    monkeypatch.undo()
+    store = ShardedJsonConversationStore(directory, TTL, legacy_path=str(legacy))
+    assert sorted(store.load_all()) == ["alice", "bob"]
+
+
+def test_sharded_cleanup_only_rewrites_expired_shards(tmp_path, monkeypatch):
+    store = ShardedJsonConversationStore(str(tmp_path / "conversations"), TTL)
+    store.replace_all({
+        "alice": {"conversations": [_expired_conversation("Lion"), new_conversation("Panda")]},
+        "bob": {"conversations": [new_conversation("Koala")]},
+    })
+    rewritten = []
+    write_shard = store._write_shard
+
+    def recording_write(username, shard):
+        rewritten.append(username)
+        write_shard(username, shard)
+
+    monkeypatch.setattr(store, "_write_shard", recording_write)
+
+    store.cleanup_expired()
+    assert rewritten == ["alice"]
+    assert [conv["animal"] for conv in store.get_conversations("alice")] == ["Panda"]
+    assert [conv["animal"] for conv in store.get_conversations("bob")] == ["Koala"]
+
+
+def _journal_store(tmp_path, **kwargs):
+    return JournalConversationStore(
+        str(tmp_path / "conversations.snapshot.json"), str(tmp_path / "conversations.journal"), TTL, **kwargs
+    )
+
+
+def test_journal_replays_after_crash_with_truncated_tail(tmp_path):
+    store = _journal_store(tmp_path)
+    store.add_script("alice", "Panda", "un")
+    conv_id = store.find_conversation("alice", "Panda")["id"]
+    store.add_hook("alice", conv_id, "hooks")
+    # Arrêt brutal au milieu de l'écriture d'un enregistrement
+    with open(tmp_path / "conversations.journal", "a", encoding="utf-8") as f:
+        f.write('{"op": "add_script", "user": "alice", "id": "')
+
+    reopened = _journal_store(tmp_path)
+    conv = reopened.find_conversation("alice", "Panda")
+    assert [s["content"] for s in conv["scripts"]] == ["un"]
+    assert [h["content"] for h in conv["hooks"]] == ["hooks"]
+
+    # L'enregistrement suivant ne se colle pas à la ligne tronquée
+    reopened.add_script("alice", "Panda", "deux")
+    again = _journal_store(tmp_path)
+    assert [s["content"] for s in again.find_conversation("alice", "Panda")["scripts"]] == ["un", "deux"]
+
+
+def test_journal_keeps_records_of_interrupted_compactions(tmp_path):
+    store = _journal_store(tmp_path)
+    store.add_script("alice", "Lion", "avant la première compaction")
+    # Deux compactions dont le snapshot n'a jamais été écrit
+    with store._lock:
+        store._rotate()
+    store.add_script("alice", "Lion", "entre les deux")
+    with store._lock:
+        store._rotate()
+    store.add_script("alice", "Lion", "après")
+
+    reopened = _journal_store(tmp_path)
+    assert [s["content"] for s in reopened.find_conversation("alice", "Lion")["scripts"]] == [
+        "avant la première compaction", "entre les deux", "après"
+    ]
+    # Le ".old" a été replié dans un snapshot au démarrage
+    assert not os.path.exists(tmp_path / "conversations.journal.old")
+
+
+def test_journal_compaction_folds_journal_into_snapshot(tmp_path):
+    store = _journal_store(tmp_path)
+    for n in range(20):
+        store.add_script("alice", "Koala", f"script {n}")
+    store.compact()
+
+    assert os.path.getsize(tmp_path / "conversations.journal") == 0
+    reopened = _journal_store(tmp_path)
+    assert len(reopened.find_conversation("alice", "Koala")["scripts"]) == 20
+
+
+def test_journal_rejects_generic_mutation(tmp_path):
+    store = _journal_store(tmp_path)
+    with pytest.raises(RuntimeError):
+        store._mutate("alice", lambda conversations: (True, None))
+
+
+def _manual_sweeper(store):
+    """Sweeper branché sur le store comme start(), sans thread de fond"""
+    sweeper = ExpirySweeper(store)
+    store.sweeper = sweeper
+    store.cleanup_on_access = False
+    return sweeper
+
+
+def test_sweeper_removes_only_due_conversations(store):
+    closing = new_conversation("Lion")
+    closing["created_at"] = (datetime.now() - timedelta(seconds=TTL - 3600)).isoformat()
+    store.replace_all({"alice": {"conversations": [closing, new_conversation("Panda")]}})
+    sweeper = _manual_sweeper(store)
+    sweeper.seed()
+    assert sweeper.pending() == 2
+
+    assert sweeper.sweep() == 0
+    assert sweeper.sweep(now=time.time() + 2 * 3600) == 1
+    assert [conv["animal"] for conv in store.get_conversations("alice")] == ["Panda"]
+    assert sweeper.sweep(now=time.time() + TTL + 1) == 1
+    assert store.get_conversations("alice") == []
+    assert sweeper.pending() == 0
+
+
+def test_sweeper_schedules_new_conversations(store):
+    sweeper = _manual_sweeper(store)
+    sweeper.seed()
+    store.add_script("alice", "Chat", "a")
+    store.get_or_create_conversation("alice", "Chien")
+    assert sweeper.pending() == 2
+
+    assert sweeper.sweep() == 0
+    assert sweeper.sweep(now=time.time() + TTL + 1) == 2
+
+
+def test_sweeper_seed_merges_with_scheduled_entries(tmp_path):
+    store = make_store("json", tmp_path)
+    sweeper = _manual_sweeper(store)
+    # Planifiée sans être (encore) visible dans le store, comme pendant un parcours concurrent
+    sweeper.schedule("alice", "pas-encore-écrite", datetime.now().isoformat())
+    store.add_script("bob", "Loup", "b")
+
+    sweeper.seed()
+    sweeper.seed()
+    assert sweeper.pending() == 2
+
+
+def test_sweeper_picks_up_conversations_written_by_another_process(tmp_path):
+    store = make_store("sqlite", tmp_path)
+    sweeper = _manual_sweeper(store)
+    sweeper.seed()
+    # bulk.py écrit avec son propre store, sans le sweeper de l'application
+    make_store("sqlite", tmp_path).replace_all({"bob": {"conversations": [_expired_conversation("Aigle")]}})
+    assert sweeper.pending() == 0
+
+    sweeper.seed()
+    assert sweeper.sweep() == 1
+    assert store.get_conversations("bob") == []
+
+
+def test_sqlite_schedules_only_after_commit(tmp_path):
+    store = make_store("sqlite", tmp_path)
+    sweeper = _manual_sweeper(store)
+
+    with pytest.raises(RuntimeError):
+        with store.db.transaction():
+            store.add_script("alice", "Tigre", "annulé")
+            assert sweeper.pending() == 0
+            raise RuntimeError("rollback")
+    assert sweeper.pending() == 0
+    assert store.get_conversations("alice") == []
+
+    with store.db.transaction():
+        store.add_script("alice", "Tigre", "validé")
+        assert sweeper.pending() == 0
+    assert sweeper.pending() == 1
+
+
+def test_cleanup_does_not_modify_the_shared_document():
+    expired, recent = _expired_conversation("Lion"), new_conversation("Panda")
+    data = {"alice": {"conversations": [expired, recent]}}
+
+    cleaned = cleanup_conversations(data, TTL)
+    assert cleaned["alice"]["conversations"] == [recent]
+    assert data["alice"]["conversations"] == [expired, recent]
+
+
+def test_json_reads_leave_cached_document_intact(tmp_path):
+    store = make_store("json", tmp_path)
+    store.replace_all({"alice": {"conversations": [_expired_conversation("Lion"), new_conversation("Panda")]}})
+
+    assert [conv["animal"] for conv in store.get_conversations("alice")] == ["Panda"]
+    assert len(store._read()["alice"]["conversations"]) == 2
+
+
+@pytest.mark.parametrize("backend", ["json", "sharded", "journal"])
+def test_index_is_not_rebuilt_between_lookups(backend, tmp_path, monkeypatch):
+    store = make_store(backend, tmp_path)
+    conv = store.get_or_create_conversation("alice", "Lion")
+    store.add_script("alice", conv["id"], "script")
+
+    rebuilds = []
+    build = storage.animal_key
+    monkeypatch.setattr(storage, "animal_key", lambda animal: rebuilds.append(animal) or build(animal))
+
+    assert store.find_conversation("alice", "Lion")["id"] == conv["id"]
+    rebuilds.clear()
+    assert store.find_conversation("alice", "lion")["id"] == conv["id"]
+    assert store.get_conversation("alice", conv["id"])["animal"] == "Lion"
+    # Seule la clé de la recherche est calculée: aucune reconstruction de l'index
+    assert rebuilds == ["lion"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sharded"])
+def test_failed_write_leaves_readers_and_cache_untouched(backend, tmp_path, monkeypatch):
+    store = make_store(backend, tmp_path)
+    store.add_script("alice", "Lion", "v1")
+    before = store.get_conversations("alice")
+
+    def failing_write(path, data):
+        raise OSError("disque plein")
+
+    monkeypatch.setattr(storage, "atomic_write_json", failing_write)
+    with pytest.raises(OSError):
+        store.add_script("alice", "Lion", "v2")
+    with pytest.raises(OSError):
+        store.get_or_create_conversation("alice", "Panda")
+
+    assert [script["content"] for script in before[0]["scripts"]] == ["v1"]
+    assert len(before) == 1
+    monkeypatch.undo()
+    assert [script["content"] for script in store.get_conversations("alice")[0]["scripts"]] == ["v1"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sharded"])
+def test_writes_do_not_change_lists_already_returned(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    store.add_script("alice", "Lion", "v1")
+    before = store.get_conversations("alice")
+
+    store.add_script("alice", "Lion", "v2")
+    store.get_or_create_conversation("alice", "Panda")
+
+    assert len(before) == 1 and len(before[0]["scripts"]) == 1
+    assert len(store.get_conversations("alice")) == 2
@@ -0,0 +1,124 @@
+import pytest
+
+from streaming import AttemptLog, RenderStats, StreamRenderer, resilient_stream
+
+
+class Dropped(Exception):
+    pass
+
+
+def _flaky(*runs):
+    """open_stream qui rejoue `runs` (listes de morceaux, terminées ou non par une exception)"""
+    partials = []
+    runs = iter(runs)
+
+    def open_stream(partial):
+        partials.append(partial)
+        for part in next(runs):
+            if isinstance(part, Exception):
+                raise part
+            yield part
+    return open_stream, partials
+
+
+def _is_transient(error):
+    return isinstance(error, Dropped)
+
+
+def test_stream_without_error():
+    open_stream, partials = _flaky(["un ", "deux"])
+    log = AttemptLog()
+
+    assert list(resilient_stream(open_stream, _is_transient, "script", log=log, sleep=pytest.fail)) == ["un ", "deux"]
+    assert partials == [""]
+    assert log.summary()["retries"] == 0
+
+
+def test_stream_resumes_from_partial_text():
+    open_stream, partials = _flaky(["un ", "deux ", Dropped()], ["trois"])
+    log = AttemptLog()
+    delays = []
+
+    parts = list(resilient_stream(open_stream, _is_transient, "script", base_delay=0.5, log=log, sleep=delays.append))
+    assert parts == ["un ", "deux ", "trois"]
+    assert partials == ["", "un deux "]
+    assert len(delays) == 1 and 0 <= delays[0] <= 0.5
+    summary = log.summary()
+    assert summary["retries"] == 1 and summary["resumed"] == 1 and summary["failed"] == 0
+
+
+def test_backoff_is_capped():
+    open_stream, _ = _flaky([Dropped()], [Dropped()], [Dropped()], ["fin"])
+    delays = []
+
+    assert list(resilient_stream(open_stream, _is_transient, attempts=4, base_delay=10, max_delay=15,
+                                 sleep=delays.append)) == ["fin"]
+    assert len(delays) == 3 and all(0 <= delay <= limit for delay, limit in zip(delays, (10, 15, 15)))
+
+
+def test_permanent_error_is_not_retried():
+    open_stream, partials = _flaky(["un ", ValueError("requête invalide")])
+    log = AttemptLog()
+    received = []
+
+    with pytest.raises(ValueError):
+        for part in resilient_stream(open_stream, _is_transient, log=log, sleep=pytest.fail):
+            received.append(part)
+    assert received == ["un "] and partials == [""]
+    assert log.summary()["failed"] == 1
+
+
+def test_gives_up_after_last_attempt():
+    open_stream, partials = _flaky(["a", Dropped()], ["b", Dropped()])
+    log = AttemptLog()
+
+    with pytest.raises(Dropped):
+        list(resilient_stream(open_stream, _is_transient, attempts=2, log=log, sleep=lambda delay: None))
+    assert partials == ["", "a"]
+    summary = log.summary()
+    assert summary["retries"] == 1 and summary["failed"] == 1
+
+
+class Placeholder:
+    def __init__(self):
+        self.rendered = []
+
+    def markdown(self, text):
+        self.rendered.append(text)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_renderer_batches_renders_by_time_and_size():
+    placeholder, clock, stats = Placeholder(), Clock(), RenderStats()
+    renderer = StreamRenderer(placeholder, interval=0.1, chars=10, stats=stats, clock=clock)
+
+    renderer.write("ab")
+    renderer.write("cd")
+    assert placeholder.rendered == []
+    clock.now = 0.2
+    renderer.write("ef")
+    renderer.write("0123456789")
+    renderer.write("")
+    assert placeholder.rendered == ["abcdef", "abcdef0123456789"]
+
+    renderer.write("fin")
+    assert renderer.close() == "abcdef0123456789fin"
+    assert renderer.close() == "abcdef0123456789fin"
+    assert placeholder.rendered[-1] == "abcdef0123456789fin" and len(placeholder.rendered) == 3
+    assert stats.snapshot()["chunks"] == 5 and stats.snapshot()["renders"] == 3
+
+
+def test_renderer_shows_partial_text_on_error():
+    placeholder = Placeholder()
+    with pytest.raises(Dropped):
+        with StreamRenderer(placeholder, interval=60, chars=1000, clock=Clock()) as renderer:
+            renderer.write("début")
+            raise Dropped()
+    assert placeholder.rendered == ["début"]